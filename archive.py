@@ -0,0 +1,229 @@
+import os
+import hashlib
+import logging
+import zlib
+import tarfile
+import threading
+import zipfile
+
+from collections import OrderedDict
+from datetime import datetime
+from contextlib import contextmanager
+from pathlib import Path, PurePosixPath
+from typing import IO, Dict, Iterator, List, Tuple
+
+import config
+import reader
+from file import File, FULL_HASH_ALGORITHM, QUICK_HASH_SIZE
+
+ZIP_SUFFIXES = (".zip",)
+TAR_SUFFIXES = (".tar", ".tar.gz", ".tgz", ".tar.bz2", ".tbz2", ".tar.xz", ".txz")
+
+# Errors reading a member, which only make that member unreadable. Encrypted
+# zip members and unsupported compression methods raise RuntimeError.
+MEMBER_ERRORS = (
+    OSError,
+    EOFError,
+    RuntimeError,
+    zlib.error,
+    zipfile.BadZipFile,
+    tarfile.TarError,
+)
+
+# Member digests of the tars hashed most recently, by (path, size, mtime_ns)
+_member_digests: Dict[tuple, Dict[str, Tuple[str, str]]] = OrderedDict()
+_member_digests_lock = threading.Lock()
+
+
+def is_archive(path: Path) -> bool:
+    return path.name.lower().endswith(ZIP_SUFFIXES + TAR_SUFFIXES)
+
+
+def is_tar(path: Path) -> bool:
+    return path.name.lower().endswith(TAR_SUFFIXES)
+
+
+def list_members(archive_path: Path) -> List[Tuple[str, int, int]]:
+    """
+    Reads (member name, size, mtime_ns) for each regular file in an archive from
+    its headers, without extracting anything. Hidden members and members whose
+    path would leave the archive dir are skipped.
+    """
+    members = []
+    if archive_path.name.lower().endswith(ZIP_SUFFIXES):
+        with zipfile.ZipFile(archive_path) as archive:
+            for info in archive.infolist():
+                if not info.is_dir():
+                    mtime = datetime(*info.date_time).timestamp()
+                    members.append((info.filename, info.file_size, int(mtime * 1e9)))
+    else:
+        with tarfile.open(archive_path, "r:*") as archive:
+            for info in archive:
+                if info.isfile():
+                    members.append((info.name, info.size, int(info.mtime * 1e9)))
+
+    return [member for member in members if _is_safe_member(member[0])]
+
+
+@contextmanager
+def open_member(archive_path: Path, member_name: str) -> Iterator[IO[bytes]]:
+    """Opens a member of an archive as a binary stream"""
+    if archive_path.name.lower().endswith(ZIP_SUFFIXES):
+        with zipfile.ZipFile(archive_path) as archive:
+            with archive.open(member_name) as member:
+                yield member
+    else:
+        with tarfile.open(archive_path, "r:*") as archive:
+            with archive.extractfile(member_name) as member:
+                yield member
+
+
+def _is_safe_member(member_name: str) -> bool:
+    member_path = PurePosixPath(member_name)
+    if member_path.is_absolute() or ".." in member_path.parts:
+        logging.warning(f"Skipping archive member outside of archive: {member_name}")
+        return False
+    return not any(part.startswith(".") for part in member_path.parts)
+
+
+def get_member_digests(archive_path: Path) -> Dict[str, Tuple[str, str]]:
+    """
+    The (quick hash, full hash) of every member of a tar, by member name. All
+    members are hashed in one sequential pass the first time any of them is
+    needed, since seeking to each member of a compressed tar decompresses the
+    archive from its start again. Zip members can be read directly, so they
+    are hashed on demand instead.
+
+    Only the digests of the last ARCHIVE_DIGEST_CACHE_SIZE tars are kept.
+    """
+    stat_result = archive_path.stat()
+    key = (archive_path, stat_result.st_size, stat_result.st_mtime_ns)
+    with _member_digests_lock:
+        digests = _member_digests.get(key)
+        if digests is None:
+            digests = _member_digests[key] = _hash_members(archive_path)
+            while len(_member_digests) > config.ARCHIVE_DIGEST_CACHE_SIZE:
+                _member_digests.popitem(last=False)
+        else:
+            _member_digests.move_to_end(key)
+    return digests
+
+
+def _hash_members(archive_path: Path) -> Dict[str, Tuple[str, str]]:
+    # A member that fails to read leaves the rest of the stream unreadable too,
+    # so hashing stops there and the members not reached have no digests
+    digests = {}
+    try:
+        for member_name, member in _iter_member_streams(archive_path):
+            digests[member_name] = _hash_stream(member)
+    except MEMBER_ERRORS as e:
+        logging.warning(
+            f"Failed to read {archive_path} after {len(digests)} members: {e}"
+        )
+    logging.debug("Hashed %d members of %s", len(digests), archive_path)
+    return digests
+
+
+def _hash_stream(member: IO[bytes]) -> Tuple[str, str]:
+    quick_hasher = hashlib.md5()
+    full_hasher = hashlib.new(FULL_HASH_ALGORITHM)
+    quick_remaining = QUICK_HASH_SIZE
+    for chunk in reader.iter_stream(member):
+        if quick_remaining:
+            quick_hasher.update(chunk[:quick_remaining])
+            quick_remaining -= min(quick_remaining, len(chunk))
+        full_hasher.update(chunk)
+    return quick_hasher.hexdigest(), full_hasher.hexdigest()
+
+
+def _iter_member_streams(archive_path: Path) -> Iterator[Tuple[str, IO[bytes]]]:
+    """Yields (member name, stream) for each regular file of a tar, in order"""
+    # Stream mode reads the archive once from start to end
+    with tarfile.open(archive_path, "r|*") as archive:
+        for info in archive:
+            if info.isfile():
+                with archive.extractfile(info) as member:
+                    yield info.name, member
+
+
+class ArchiveFile(File):
+    """
+    A file inside a zip or tar archive, indexed as if the archive were a
+    directory. Data is streamed from the archive when it is hashed or copied.
+    """
+
+    def __init__(
+        self,
+        base_path: Path,
+        archive_path: Path,
+        member_name: str,
+        size: int,
+        mtime_ns: int,
+        file_id: int = None,
+    ):
+        # Archive members are never hardlinks of other files
+        self._init_traits(
+            base_path, archive_path / member_name, file_id, size, mtime_ns, None
+        )
+        self.archive_path = archive_path
+        self.member_name = member_name
+
+    def __repr__(self):
+        return (
+            f"ArchiveFile(name={self.name!r}, rel_path={self.rel_path!r}, "
+            f"archive={self.archive_path.name!r}, size={self.size}, "
+            f"quick_hash={self.quick_hash!r}, full_hash={self.full_hash!r})"
+        )
+
+    def to_tuple(self) -> tuple:
+        return super().to_tuple() + (str(self.archive_path), self.member_name)
+
+    @classmethod
+    def from_tuple(cls, file_tuple: tuple) -> "ArchiveFile":
+        file = super().from_tuple(file_tuple)
+        file.archive_path = Path(file_tuple[8])
+        file.member_name = file_tuple[9]
+        return file
+
+    def open(self):
+        return open_member(self.archive_path, self.member_name)
+
+    def read_chunks(self) -> Iterator[memoryview]:
+        with self.open() as member:
+            yield from reader.iter_stream(member)
+
+    def read_head(self, length: int) -> bytes:
+        with self.open() as member:
+            return reader.read_stream_head(member, length)
+
+    def _create_quick_hash(self, chunk_size=QUICK_HASH_SIZE):
+        return self._get_digest(0, super()._create_quick_hash, chunk_size)
+
+    def _create_full_hash(self, algorithm=FULL_HASH_ALGORITHM):
+        return self._get_digest(1, super()._create_full_hash, algorithm)
+
+    def _get_digest(self, index: int, create_hash, *args) -> str:
+        """
+        Gets a digest from the single pass over a tar, or hashes a zip member
+        with create_hash. An unreadable member gets a digest of its own path,
+        so it matches no other file.
+        """
+        try:
+            if is_tar(self.archive_path):
+                digests = get_member_digests(self.archive_path).get(self.member_name)
+                if digests is not None:
+                    return digests[index]
+            else:
+                return create_hash(*args)
+        except MEMBER_ERRORS as e:
+            logging.warning(f"Failed to read archive member {self.abs_path}: {e}")
+        return f"unreadable:{self.abs_path}"
+
+    def copy_to(self, output_path: Path):
+        with open(output_path, "wb") as dst:
+            for chunk in self.read_chunks():
+                dst.write(chunk)
+        self.copy_stat_to(output_path)
+
+    def copy_stat_to(self, output_path: Path):
+        os.utime(output_path, ns=(self.mtime_ns, self.mtime_ns))
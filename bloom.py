@@ -0,0 +1,406 @@
+import os
+import math
+import struct
+import sqlite3
+import hashlib
+import logging
+
+from pathlib import Path
+from typing import Iterable, List, Optional
+
+import config
+import utils
+from file import File
+from dir_index import DirIndex
+from walk_filter import WalkFilter
+from comparison import Comparison
+from comparison_manager import ComparisonManager
+
+# Starts a filter file, followed by the signature of the walk filter it was built with
+FILE_MAGIC = b"DMBLOOM2"
+# Capacity, error rate, hash count, bit count and item count of each filter
+FILTER_HEADER = struct.Struct("<QdIQQ")
+FILTER_NAMES = ("sizes", "names", "contents")
+
+CATALOG_SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (rel_path TEXT, name TEXT, size INTEGER);
+CREATE TABLE IF NOT EXISTS dirs (rel_path TEXT, mtime_ns INTEGER);
+"""
+CATALOG_INDEXES = """
+CREATE INDEX files_name ON files (name);
+CREATE INDEX files_size ON files (size);
+"""
+# Rows written to a catalog at a time while it is built
+CATALOG_BATCH_SIZE = 10000
+
+
+class BloomFilter:
+    """
+    A fixed size set of bits answering whether an item may have been added.
+    There are no false negatives, and false positives happen at about
+    error_rate once `capacity` items have been added.
+    """
+
+    def __init__(self, capacity: int, error_rate: float):
+        self.capacity = max(1, capacity)
+        self.error_rate = error_rate
+        self.bit_count = math.ceil(
+            -self.capacity * math.log(error_rate) / math.log(2) ** 2
+        )
+        self.hash_count = max(1, round(self.bit_count / self.capacity * math.log(2)))
+        self.bits = bytearray((self.bit_count + 7) // 8)
+        self.count = 0
+
+    def __contains__(self, item: bytes) -> bool:
+        return all(
+            self.bits[position >> 3] & (1 << (position & 7))
+            for position in self._get_positions(item)
+        )
+
+    def add(self, item: bytes):
+        for position in self._get_positions(item):
+            self.bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def _get_positions(self, item: bytes):
+        # Double hashing, k positions from the two halves of one digest
+        digest = hashlib.blake2b(item, digest_size=16).digest()
+        hash_a = int.from_bytes(digest[:8], "little")
+        hash_b = int.from_bytes(digest[8:], "little") | 1
+        return ((hash_a + i * hash_b) % self.bit_count for i in range(self.hash_count))
+
+
+class ScalableBloomFilter:
+    """
+    A Bloom filter for an unknown number of items. When the newest filter is
+    full, a filter twice as large with half the error rate is added, so the
+    overall error rate stays below twice the initial one.
+    """
+
+    def __init__(
+        self,
+        initial_capacity=config.BLOOM_INITIAL_CAPACITY,
+        error_rate=config.BLOOM_ERROR_RATE,
+    ):
+        self.filters: List[BloomFilter] = [BloomFilter(initial_capacity, error_rate)]
+
+    def __contains__(self, item: bytes) -> bool:
+        return any(item in bloom_filter for bloom_filter in self.filters)
+
+    def __len__(self):
+        return sum(bloom_filter.count for bloom_filter in self.filters)
+
+    def add(self, item: bytes):
+        newest = self.filters[-1]
+        if newest.count >= newest.capacity:
+            newest = BloomFilter(newest.capacity * 2, newest.error_rate / 2)
+            self.filters.append(newest)
+        newest.add(item)
+
+    def write(self, stream):
+        stream.write(struct.pack("<I", len(self.filters)))
+        for bloom_filter in self.filters:
+            stream.write(
+                FILTER_HEADER.pack(
+                    bloom_filter.capacity,
+                    bloom_filter.error_rate,
+                    bloom_filter.hash_count,
+                    bloom_filter.bit_count,
+                    bloom_filter.count,
+                )
+            )
+            stream.write(bloom_filter.bits)
+
+    @classmethod
+    def read(cls, stream) -> "ScalableBloomFilter":
+        scalable_filter = cls.__new__(cls)
+        scalable_filter.filters = []
+        (filter_count,) = struct.unpack("<I", stream.read(4))
+        for _ in range(filter_count):
+            capacity, error_rate, hash_count, bit_count, count = FILTER_HEADER.unpack(
+                stream.read(FILTER_HEADER.size)
+            )
+            bloom_filter = BloomFilter.__new__(BloomFilter)
+            bloom_filter.capacity = capacity
+            bloom_filter.error_rate = error_rate
+            bloom_filter.hash_count = hash_count
+            bloom_filter.bit_count = bit_count
+            bloom_filter.count = count
+            bloom_filter.bits = bytearray(stream.read((bit_count + 7) // 8))
+            scalable_filter.filters.append(bloom_filter)
+        return scalable_filter
+
+
+def size_key(size: int) -> bytes:
+    return str(size).encode()
+
+
+def name_key(name: str) -> bytes:
+    return name.encode("utf-8", "surrogateescape")
+
+
+def content_key(size: int, quick_hash: str) -> bytes:
+    return f"{size}:{quick_hash}".encode()
+
+
+class PathCatalog:
+    """
+    The relative path, name and size of every file under a root, and the mtime
+    of every dir, saved in SQLite beside the root's filters. The files that may
+    match are looked up here, so only they are stat'ed, and the dir mtimes tell
+    whether files were added, removed or renamed since it was built.
+    """
+
+    def __init__(self, db_path: Path):
+        self.db_path = Path(db_path)
+        self.connection = sqlite3.connect(self.db_path)
+        self.connection.executescript(CATALOG_SCHEMA)
+        self.file_rows = []
+        self.dir_rows = []
+
+    def __repr__(self):
+        return f"PathCatalog(db_path={str(self.db_path)!r})"
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.connection.close()
+
+    @classmethod
+    def create(cls, db_path: Path) -> "PathCatalog":
+        Path(db_path).unlink(missing_ok=True)
+        return cls(db_path)
+
+    def add_dir(self, dir_path: Path, rel_dir: str):
+        self.dir_rows.append((rel_dir, os.stat(dir_path).st_mtime_ns))
+
+    def add_file(self, file: File):
+        self.file_rows.append((file.rel_path.as_posix(), file.name, file.size))
+        if len(self.file_rows) >= CATALOG_BATCH_SIZE:
+            self._write_rows()
+
+    def finish(self):
+        self._write_rows()
+        self.connection.executescript(CATALOG_INDEXES)
+        self.connection.commit()
+
+    def _write_rows(self):
+        self.connection.executemany(
+            "INSERT INTO files VALUES (?, ?, ?)", self.file_rows
+        )
+        self.connection.executemany("INSERT INTO dirs VALUES (?, ?)", self.dir_rows)
+        self.file_rows.clear()
+        self.dir_rows.clear()
+
+    def find_changed_dir(self, root_path: Path) -> Optional[str]:
+        """The first dir removed or modified since the catalog was built, if any"""
+        for rel_dir, mtime_ns in self.connection.execute("SELECT * FROM dirs"):
+            try:
+                if os.stat(Path(root_path) / rel_dir).st_mtime_ns != mtime_ns:
+                    return rel_dir
+            except FileNotFoundError:
+                return rel_dir
+        return None
+
+    def find_paths(self, names: Iterable[str], sizes: Iterable[int]) -> List[str]:
+        """The relative paths of the files with one of the names or sizes, in walk order"""
+        self.connection.executescript("""
+            CREATE TEMP TABLE IF NOT EXISTS wanted_names (name TEXT PRIMARY KEY);
+            CREATE TEMP TABLE IF NOT EXISTS wanted_sizes (size INTEGER PRIMARY KEY);
+            DELETE FROM wanted_names;
+            DELETE FROM wanted_sizes;
+            """)
+        self.connection.executemany(
+            "INSERT OR IGNORE INTO wanted_names VALUES (?)", ((name,) for name in names)
+        )
+        self.connection.executemany(
+            "INSERT OR IGNORE INTO wanted_sizes VALUES (?)", ((size,) for size in sizes)
+        )
+        rows = self.connection.execute(
+            "SELECT rel_path FROM files "
+            "WHERE name IN (SELECT name FROM wanted_names) "
+            "OR size IN (SELECT size FROM wanted_sizes) ORDER BY rowid"
+        )
+        return [rel_path for (rel_path,) in rows]
+
+
+class RootFilter:
+    """
+    Bloom filters over the sizes, names and (size, quick hash) contents of
+    every file under a root, built in one streaming pass and saved to disk so
+    the root is only read once. The filters are rebuilt when they were built
+    with another walk filter, or when a dir of the root changed since, as
+    recorded in the root's PathCatalog. Files edited in place do not change
+    their dir, so --rebuild-prefilter is still needed to pick those up.
+    """
+
+    def __init__(self, root_path: Path, signature: str = None):
+        self.root_path = Path(root_path)
+        # Signature of the walk filter the filters were built with
+        self.signature = signature
+        self.sizes = ScalableBloomFilter()
+        self.names = ScalableBloomFilter()
+        self.contents = ScalableBloomFilter()
+
+    def __repr__(self):
+        return (
+            f"RootFilter(root={str(self.root_path)!r}, files={len(self.names)}, "
+            f"filters={sum(len(bloom.filters) for bloom in self._get_filters())})"
+        )
+
+    def _get_filters(self) -> List[ScalableBloomFilter]:
+        return [getattr(self, name) for name in FILTER_NAMES]
+
+    @staticmethod
+    def get_filter_path(root_path: Path) -> Path:
+        root_id = hashlib.blake2b(
+            str(Path(root_path).resolve()).encode(), digest_size=8
+        ).hexdigest()
+        return config.BLOOM_DIR_PATH / f"{Path(root_path).name}-{root_id}.bloom"
+
+    @classmethod
+    def get_catalog_path(cls, root_path: Path) -> Path:
+        filter_path = cls.get_filter_path(root_path)
+        return filter_path.parent / f"{filter_path.stem}.paths.db"
+
+    @classmethod
+    def build(cls, root_path: Path, walk_filter: WalkFilter = None) -> "RootFilter":
+        walk_filter = walk_filter or WalkFilter()
+        root_filter = cls(root_path, walk_filter.signature)
+        catalog_path = cls.get_catalog_path(root_path)
+        utils.ensure_path_exists(catalog_path.parent)
+        with PathCatalog.create(catalog_path) as catalog:
+            dir_index = DirIndex(walk_filter=walk_filter)
+            for file in dir_index.iter_files(root_path, on_dir=catalog.add_dir):
+                root_filter.sizes.add(size_key(file.size))
+                root_filter.names.add(name_key(file.name))
+                root_filter.contents.add(content_key(file.size, file.get_quick_hash()))
+                catalog.add_file(file)
+            catalog.finish()
+        logging.info(f"Built {repr(root_filter)}")
+        return root_filter
+
+    @classmethod
+    def load_or_build(
+        cls, root_path: Path, walk_filter: WalkFilter = None, rebuild=False
+    ) -> "RootFilter":
+        filter_path = cls.get_filter_path(root_path)
+        if filter_path.exists() and not rebuild:
+            root_filter = cls.load(root_path, filter_path)
+            stale_reason = root_filter.get_stale_reason(walk_filter)
+            if stale_reason is None:
+                logging.info(f"Loaded {repr(root_filter)} from {filter_path}")
+                return root_filter
+            logging.info(f"Rebuilding {filter_path}: {stale_reason}")
+
+        # Removed first, so filters left by an interrupted build are never loaded
+        filter_path.unlink(missing_ok=True)
+        root_filter = cls.build(root_path, walk_filter)
+        root_filter.save(filter_path)
+        return root_filter
+
+    @classmethod
+    def load(cls, root_path: Path, filter_path: Path) -> "RootFilter":
+        """Loads saved filters, leaving the signature None for an unknown format"""
+        root_filter = cls(root_path)
+        with open(filter_path, "rb") as stream:
+            if stream.read(len(FILE_MAGIC)) != FILE_MAGIC:
+                return root_filter
+            (signature_size,) = struct.unpack("<I", stream.read(4))
+            root_filter.signature = stream.read(signature_size).decode()
+            for name in FILTER_NAMES:
+                setattr(root_filter, name, ScalableBloomFilter.read(stream))
+        return root_filter
+
+    def get_stale_reason(self, walk_filter: WalkFilter = None) -> Optional[str]:
+        """Why the filters no longer describe the root, or None if they still do"""
+        if self.signature is None:
+            return "saved in an older format"
+        if self.signature != (walk_filter or WalkFilter()).signature:
+            return "built with a different walk filter"
+        catalog_path = self.get_catalog_path(self.root_path)
+        if not catalog_path.exists():
+            return "its path catalog is missing"
+        with PathCatalog(catalog_path) as catalog:
+            changed_dir = catalog.find_changed_dir(self.root_path)
+        if changed_dir is not None:
+            return f"{self.root_path / changed_dir} changed since it was built"
+        return None
+
+    def find_paths(self, names: Iterable[str], sizes: Iterable[int]) -> List[str]:
+        with PathCatalog(self.get_catalog_path(self.root_path)) as catalog:
+            return catalog.find_paths(names, sizes)
+
+    def save(self, filter_path: Path):
+        utils.ensure_path_exists(filter_path.parent)
+        with open(filter_path, "wb") as stream:
+            signature = self.signature.encode()
+            stream.write(FILE_MAGIC + struct.pack("<I", len(signature)) + signature)
+            for bloom_filter in self._get_filters():
+                bloom_filter.write(stream)
+        logging.info(f"Saved {repr(self)} to {filter_path}")
+
+    def may_match_name(self, name: str) -> bool:
+        return name_key(name) in self.names
+
+    def may_match_content(self, size: int, quick_hash_getter) -> bool:
+        """Only reads the quick hash when the size may match"""
+        if size_key(size) not in self.sizes:
+            return False
+        return content_key(size, quick_hash_getter()) in self.contents
+
+
+def prefilter_index(dir_index: DirIndex, root_filter: RootFilter) -> DirIndex:
+    """
+    Adds to dir_index the files under the filtered root that may match one of
+    its files, found by exact lookups in the root's PathCatalog, so only they
+    are stat'ed. Files of dir_index that miss every filter are unique to the
+    filtered root, and are left without candidates. Returns dir_index.
+    """
+    names, sizes = set(), set()
+    for file in dir_index.file_list:
+        if root_filter.may_match_name(file.name):
+            names.add(file.name)
+        if root_filter.may_match_content(file.size, file.get_quick_hash):
+            sizes.add(file.size)
+
+    logging.info(
+        f"{len(dir_index.file_list)} files checked against {repr(root_filter)}: "
+        f"{len(names)} names and {len(sizes)} sizes may match"
+    )
+    if names or sizes:
+        dir_index.index_paths(
+            root_filter.root_path, root_filter.find_paths(names, sizes)
+        )
+    return dir_index
+
+
+def get_new_files(
+    dir_index: DirIndex, comparison_manager: ComparisonManager, root_path: Path
+) -> List[File]:
+    """Files outside root_path with no copy of their content under root_path"""
+    root_path = Path(root_path)
+    file_list = dir_index.file_list
+    has_copy = bytearray(len(file_list))
+    for file_a_id, file_b_id, comp_type in map(
+        Comparison.unpack_record, comparison_manager.comparison_cache
+    ):
+        in_root_a = file_list[file_a_id].base_path == root_path
+        in_root_b = file_list[file_b_id].base_path == root_path
+        if comp_type.value["content"] and in_root_a != in_root_b:
+            has_copy[file_a_id] = has_copy[file_b_id] = 1
+    return [
+        file
+        for file in file_list
+        if file.base_path != root_path and not has_copy[file.file_id]
+    ]
+
+
+def write_new_files(new_files: List[File], root_path: Path, output_dir: Path):
+    msg = [f"Files with no copy in {root_path}: {len(new_files)}\n"]
+    for file in new_files:
+        msg.append(f"\t{file.name} ({file.rel_path})\n\t\t{file.abs_path}\n")
+    utils.write_to_file(
+        "NEW_FILES", output_dir / "NEW_FILES", "".join(msg), is_timestamped=True
+    )
@@ -0,0 +1,391 @@
+import sqlite3
+import hashlib
+import logging
+
+from array import array
+from itertools import combinations
+from pathlib import Path
+from typing import IO, Dict, Iterable, Iterator, List, Optional, Tuple
+
+import config
+import reader
+import utils
+from file import File
+from comparison import CompType
+from comparison_manager import ComparisonManager
+
+try:
+    import numpy
+
+    HAS_NUMPY = True
+except ImportError:
+    HAS_NUMPY = False
+
+# Random 32-bit value per byte for the Gear rolling hash, fixed so chunk
+# boundaries are the same between runs
+GEAR = [
+    int.from_bytes(hashlib.blake2b(bytes([i]), digest_size=4).digest(), "big")
+    for i in range(256)
+]
+GEAR_ARRAY = numpy.array(GEAR, dtype=numpy.uint32) if HAS_NUMPY else None
+HASH_BITS = 32
+HASH_MASK = (1 << HASH_BITS) - 1
+# Each byte is shifted out of the hash after this many more bytes
+HASH_WINDOW = HASH_BITS
+DIGEST_SIZE = 16
+
+# Versions differ in content, so these are the groups that can share chunks
+CHUNKED_COMP_TYPES = (CompType.PATH_NAME_DUP, CompType.NAME_DUP)
+
+
+def get_masks(avg_size: int) -> Tuple[int, int]:
+    """
+    The masks used before and after avg_size into a chunk, as in FastCDC.
+    They test the high bits of the hash, which depend on the whole window,
+    and the stricter mask before avg_size narrows the spread of chunk sizes.
+    """
+    bits = avg_size.bit_length() - 1
+
+    def high_bits(count: int) -> int:
+        return ((1 << count) - 1) << (HASH_BITS - count)
+
+    return (
+        high_bits(bits + config.CHUNK_NORMALIZATION),
+        high_bits(bits - config.CHUNK_NORMALIZATION),
+    )
+
+
+def get_chunker_id() -> str:
+    """Identifies the chunk boundaries iter_chunks places, for cached chunk lists"""
+    return (
+        f"gear{HASH_BITS}-nc{config.CHUNK_NORMALIZATION}-{config.CHUNK_MIN_SIZE}-"
+        f"{config.CHUNK_AVG_SIZE}-{config.CHUNK_MAX_SIZE}"
+    )
+
+
+def iter_chunks(
+    stream: IO[bytes],
+    min_size=config.CHUNK_MIN_SIZE,
+    avg_size=config.CHUNK_AVG_SIZE,
+    max_size=config.CHUNK_MAX_SIZE,
+) -> Iterator[bytes]:
+    """
+    Splits a stream into content-defined chunks. A boundary is placed after a
+    byte where the Gear hash of the last 32 bytes has its masked bits clear,
+    so an insert or delete only changes the chunks around it.
+
+    Boundaries are found with numpy when it is installed, at over 100 MiB/s.
+    Without it they are found byte by byte, at only a few MiB/s.
+    """
+    return iter_block_chunks(reader.iter_stream(stream), min_size, avg_size, max_size)
+
+
+def iter_block_chunks(
+    blocks: Iterable[bytes],
+    min_size=config.CHUNK_MIN_SIZE,
+    avg_size=config.CHUNK_AVG_SIZE,
+    max_size=config.CHUNK_MAX_SIZE,
+) -> Iterator[bytes]:
+    """
+    Splits data that has already been read in blocks, such as the views from
+    File.read_chunks, into content-defined chunks as iter_chunks does. Each
+    block is copied before the next is read.
+    """
+    masks = get_masks(avg_size)
+    find_cut = _find_cut_vectorized if HAS_NUMPY else _find_cut
+    blocks = iter(blocks)
+    buffer = bytearray()
+    is_eof = False
+    while not is_eof:
+        data = next(blocks, None)
+        is_eof = data is None
+        if not is_eof:
+            buffer += data
+
+        start = 0
+        for cut in find_cut(buffer, min_size, avg_size, max_size, masks, is_eof):
+            yield bytes(buffer[start:cut])
+            start = cut
+        del buffer[:start]
+
+
+def _iter_cuts(
+    buffer: bytearray,
+    min_size: int,
+    avg_size: int,
+    max_size: int,
+    is_eof: bool,
+    scan_cut,
+) -> Iterator[int]:
+    """
+    Yields the end of each chunk in buffer whose end no later data can change.
+    scan_cut(start) returns the first boundary of the chunk at start, if the
+    buffer has one before start + max_size.
+    """
+    start = 0
+    while start < len(buffer):
+        cut = scan_cut(start)
+        if cut is None:
+            if start + max_size <= len(buffer):
+                cut = start + max_size
+            elif is_eof:
+                cut = len(buffer)
+            else:
+                return
+        yield cut
+        start = cut
+
+
+def _find_cut(
+    buffer: bytearray,
+    min_size: int,
+    avg_size: int,
+    max_size: int,
+    masks: Tuple[int, int],
+    is_eof: bool,
+) -> Iterator[int]:
+    """Finds boundaries one byte at a time"""
+    mask_small, mask_large = masks
+
+    def scan_cut(start: int) -> Optional[int]:
+        # Byte i ends a chunk of i + 1 - start bytes
+        first = start + min_size - 1
+        normal = start + avg_size - 1
+        end = min(len(buffer), start + max_size - 1)
+        rolling_hash = 0
+        for i in range(max(start, first - HASH_WINDOW + 1), min(first, end)):
+            rolling_hash = ((rolling_hash << 1) + GEAR[buffer[i]]) & HASH_MASK
+        for i in range(first, min(normal, end)):
+            rolling_hash = ((rolling_hash << 1) + GEAR[buffer[i]]) & HASH_MASK
+            if not rolling_hash & mask_small:
+                return i + 1
+        for i in range(max(first, normal), end):
+            rolling_hash = ((rolling_hash << 1) + GEAR[buffer[i]]) & HASH_MASK
+            if not rolling_hash & mask_large:
+                return i + 1
+        return None
+
+    return _iter_cuts(buffer, min_size, avg_size, max_size, is_eof, scan_cut)
+
+
+def _find_cut_vectorized(
+    buffer: bytearray,
+    min_size: int,
+    avg_size: int,
+    max_size: int,
+    masks: Tuple[int, int],
+    is_eof: bool,
+) -> Iterator[int]:
+    """
+    Finds the same boundaries as _find_cut, hashing the whole buffer with numpy.
+    The hash of the 32 bytes ending at each byte is built by doubling, from
+    windows of 1 byte to 2, 4 and up to 32, in 5 passes over the buffer.
+    """
+    hashes = GEAR_ARRAY.take(numpy.frombuffer(buffer, dtype=numpy.uint8))
+    shifted = numpy.empty_like(hashes)
+    size = len(hashes)
+    span = 1
+    while span < min(HASH_WINDOW, size):
+        numpy.left_shift(hashes[:-span], span, out=shifted[: size - span])
+        numpy.add(hashes[span:], shifted[: size - span], out=hashes[span:])
+        span *= 2
+    # A hash passes a high bit mask when it is at most the mask's complement,
+    # and the small mask's bits include the large mask's. Byte i ends a chunk
+    # at i + 1
+    mask_small, mask_large = masks
+    large_cuts = numpy.flatnonzero(hashes <= (~mask_large & HASH_MASK))
+    small_cuts = large_cuts[hashes[large_cuts] <= (~mask_small & HASH_MASK)] + 1
+    large_cuts += 1
+
+    def scan_cut(start: int) -> Optional[int]:
+        first = start + min_size
+        index = numpy.searchsorted(small_cuts, first)
+        if index < len(small_cuts) and small_cuts[index] < start + avg_size:
+            return int(small_cuts[index])
+        index = numpy.searchsorted(large_cuts, max(first, start + avg_size))
+        if index < len(large_cuts) and large_cuts[index] < start + max_size:
+            return int(large_cuts[index])
+        return None
+
+    return _iter_cuts(buffer, min_size, avg_size, max_size, is_eof, scan_cut)
+
+
+class ChunkStore:
+    """
+    Chunk digests and sizes for each chunked file, cached in a SQLite database
+    by path, size, mtime and chunker so unchanged files are not chunked again.
+    """
+
+    def __init__(self, db_path: Path = config.CHUNK_DB_PATH):
+        utils.ensure_path_exists(Path(db_path).parent)
+        self.connection = sqlite3.connect(db_path)
+        self.chunker_id = get_chunker_id()
+        columns = [
+            row[1] for row in self.connection.execute("PRAGMA table_info(chunk_lists)")
+        ]
+        if columns and "chunker" not in columns:
+            # Cached before boundaries depended on the chunker, so can't be reused
+            self.connection.execute("DROP TABLE chunk_lists")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS chunk_lists ("
+            "path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, "
+            "chunker TEXT, digests BLOB, sizes BLOB)"
+        )
+        self.chunked_count = 0
+        self.cached_count = 0
+
+    def __repr__(self):
+        return f"ChunkStore(chunked={self.chunked_count}, cached={self.cached_count})"
+
+    def close(self):
+        self.connection.commit()
+        self.connection.close()
+
+    def get_chunks(self, file: File) -> Dict[bytes, int]:
+        """Returns the size of each distinct chunk of a file, keyed by digest"""
+        row = self.connection.execute(
+            "SELECT digests, sizes FROM chunk_lists "
+            "WHERE path = ? AND size = ? AND mtime_ns = ? AND chunker = ?",
+            (str(file.abs_path), file.size, file.mtime_ns, self.chunker_id),
+        ).fetchone()
+        if row:
+            self.cached_count += 1
+            digests, sizes = row[0], array("I", row[1])
+        else:
+            self.chunked_count += 1
+            digests, sizes = self._chunk_file(file)
+            self.connection.execute(
+                "INSERT OR REPLACE INTO chunk_lists VALUES (?, ?, ?, ?, ?, ?)",
+                (
+                    str(file.abs_path),
+                    file.size,
+                    file.mtime_ns,
+                    self.chunker_id,
+                    digests,
+                    sizes.tobytes(),
+                ),
+            )
+
+        return {
+            digests[i * DIGEST_SIZE : (i + 1) * DIGEST_SIZE]: size
+            for i, size in enumerate(sizes)
+        }
+
+    def _chunk_file(self, file: File) -> Tuple[bytes, array]:
+        logging.debug("Chunking %s", file.abs_path)
+        digests = bytearray()
+        sizes = array("I")
+        # Read with the read policy and throttled, like hashing and copying
+        for chunk in iter_block_chunks(file.read_chunks()):
+            digests += hashlib.blake2b(chunk, digest_size=DIGEST_SIZE).digest()
+            sizes.append(len(chunk))
+        return bytes(digests), sizes
+
+
+class ChunkReport:
+    """
+    Shared chunk ratios between the differing versions of large files in the
+    PATH_NAME_DUP and NAME_DUP groups, and the bytes deduplicating them would save.
+    """
+
+    def __init__(
+        self,
+        comparison_manager: ComparisonManager,
+        chunk_store: ChunkStore,
+        min_file_size: int,
+    ):
+        self.min_file_size = min_file_size
+        # Without numpy, larger files would take minutes each to chunk
+        self.max_file_size = None if HAS_NUMPY else config.CHUNK_PURE_PYTHON_MAX_SIZE
+        self.skipped_files: List[File] = []
+        # (comp_type, group key, pair ratios, group bytes, deduplicated bytes)
+        self.groups: List[tuple] = []
+        self.build(comparison_manager, chunk_store)
+
+    def __str__(self):
+        total_bytes = sum(group[3] for group in self.groups)
+        dedup_bytes = sum(group[4] for group in self.groups)
+        msg = [
+            f"ChunkReport: {len(self.groups)} groups of files over "
+            f"{self.min_file_size} bytes\n",
+            f"Estimated dedupe savings: {total_bytes - dedup_bytes} of "
+            f"{total_bytes} bytes\n",
+        ]
+        if self.skipped_files:
+            msg.append(
+                f"Skipped {len(self.skipped_files)} files over {self.max_file_size} "
+                f"bytes, install numpy to chunk them\n"
+            )
+            for file in self.skipped_files:
+                msg.append(f"\t{file.abs_path}\n")
+        for comp_type, key, pair_ratios, group_bytes, group_dedup_bytes in self.groups:
+            msg.append(
+                f"{comp_type.name} Key: {key} "
+                f"(saves {group_bytes - group_dedup_bytes} of {group_bytes} bytes)\n"
+            )
+            for file_a, file_b, ratio in pair_ratios:
+                msg.append(
+                    f"\t{ratio:.1%} shared: {file_a.rel_path} <-> {file_b.rel_path}\n"
+                )
+                msg.append(f"\t\t{file_a.abs_path}\n\t\t{file_b.abs_path}\n")
+        return "".join(msg)
+
+    def write_to_file(self, output_dir: Path):
+        utils.write_to_file(
+            "CHUNK_OVERLAP",
+            output_dir / "CHUNK_OVERLAP",
+            str(self),
+            is_timestamped=True,
+        )
+
+    def build(self, comparison_manager: ComparisonManager, chunk_store: ChunkStore):
+        for comp_type in CHUNKED_COMP_TYPES:
+            comparison_index = comparison_manager.comparisons[comp_type]
+            for key, file_list in comparison_index.index.items():
+                large_files = [
+                    file for file in file_list if file.size >= self.min_file_size
+                ]
+                if self.max_file_size is not None:
+                    self.skipped_files.extend(
+                        file for file in large_files if file.size > self.max_file_size
+                    )
+                    large_files = [
+                        file for file in large_files if file.size <= self.max_file_size
+                    ]
+                if len(large_files) < 2:
+                    continue
+
+                chunks = {
+                    file.file_id: chunk_store.get_chunks(file) for file in large_files
+                }
+                pair_ratios = [
+                    (file_a, file_b, self._get_shared_ratio(file_a, file_b, chunks))
+                    for file_a, file_b in combinations(large_files, 2)
+                ]
+                group_bytes = sum(file.size for file in large_files)
+                dedup_chunks = {}
+                for file_chunks in chunks.values():
+                    dedup_chunks.update(file_chunks)
+                self.groups.append(
+                    (
+                        comp_type,
+                        key,
+                        pair_ratios,
+                        group_bytes,
+                        sum(dedup_chunks.values()),
+                    )
+                )
+        if self.skipped_files:
+            logging.warning(
+                f"Skipped chunking {len(self.skipped_files)} files over "
+                f"{self.max_file_size} bytes, install numpy to chunk them"
+            )
+        logging.info(f"Built chunk report with {repr(chunk_store)}")
+
+    @staticmethod
+    def _get_shared_ratio(file_a: File, file_b: File, chunks: Dict[int, dict]) -> float:
+        chunks_a, chunks_b = chunks[file_a.file_id], chunks[file_b.file_id]
+        shared_bytes = sum(
+            size for digest, size in chunks_a.items() if digest in chunks_b
+        )
+        return shared_bytes / max(file_a.size, file_b.size, 1)
@@ -1,10 +1,14 @@
 import shutil
+import tempfile
 import subprocess
-from typing import List
+from typing import Iterator, List
 from enum import Enum
+from pathlib import Path
+from contextlib import contextmanager
 
 import utils
 from file import File
+from archive import ArchiveFile
 from prompts import SelectSinglePrompt, SelectMultiPrompt
 
 
@@ -33,6 +37,59 @@ def prompt_keep_options(file_list: List[File]):
     return view_prompt.send_prompt()
 
 
+class ClusterOptions(Enum):
+    APPLY_TO_CLUSTER = "Make one decision for every group in this cluster"
+    RESOLVE_INDIVIDUALLY = "Resolve each group in this cluster individually"
+
+
+class ClusterReviewOptions(Enum):
+    KEEP = "Keep this decision"
+    UNDO = "Undo this decision and choose again"
+
+
+def make_dir_options(signature: List[tuple]) -> dict[str:tuple]:
+    return {
+        f"Dir {i + 1}: {rel_dir} \n            in {base_path}": (base_path, rel_dir)
+        for i, (base_path, rel_dir) in enumerate(signature)
+    }
+
+
+def display_cluster(msg, signature: List[tuple], group_count: int):
+    msg = [f"{msg} ({group_count} groups share these directories)"]
+    for i, (base_path, rel_dir) in enumerate(signature, 1):
+        msg.append(f"{i}) {rel_dir}\n\tin {base_path}")
+    print("\n".join(msg))
+
+
+# Prompt the user to choose whether a cluster is resolved with one decision
+def prompt_cluster_options():
+    view_prompt = SelectSinglePrompt(
+        msg="Choose how to resolve this cluster",
+        options=ClusterOptions,
+    )
+    return view_prompt.send_prompt()
+
+
+# Prompt the user to choose which directories of a cluster to keep files from
+def prompt_keep_dirs(signature: List[tuple]):
+    view_prompt = SelectMultiPrompt(
+        msg="Choose one or more directories to keep files from",
+        options=make_dir_options(signature),
+        min_choices=0,
+        max_choices=len(signature),
+    )
+    return view_prompt.send_prompt()
+
+
+# Prompt the user to keep or undo the decision just applied to a cluster
+def prompt_review_cluster():
+    view_prompt = SelectSinglePrompt(
+        msg="Review the decision for this cluster",
+        options=ClusterReviewOptions,
+    )
+    return view_prompt.send_prompt()
+
+
 class DiffViewOptions(Enum):
     DIFF_EDITOR = "Open in diff editor"
     DIFF_UNIFIED = "View unified diff"
@@ -40,6 +97,25 @@ class DiffViewOptions(Enum):
     CONTINUE = "Skip viewing and continue"
 
 
+@contextmanager
+def diff_paths(file_list: List[File]) -> Iterator[List[Path]]:
+    """
+    Paths on disk to diff the files at. Archive members have no path of their
+    own, so they are extracted to a temporary dir that is removed afterwards.
+    """
+    with tempfile.TemporaryDirectory(prefix="dir_merge_diff_") as temp_dir:
+        paths = []
+        for i, file in enumerate(file_list):
+            if isinstance(file, ArchiveFile):
+                path = Path(temp_dir) / str(i) / file.name
+                path.parent.mkdir()
+                file.copy_to(path)
+            else:
+                path = file.abs_path.resolve()
+            paths.append(path)
+        yield paths
+
+
 def prompt_build_diff(file_list: List[File]):
     view_prompt = SelectSinglePrompt(
         msg="Choose how to view the files",
@@ -59,35 +135,31 @@ def prompt_build_diff(file_list: List[File]):
         )
         to_compare = compare_prompt.send_prompt()
 
-        match user_selection:
-            # TODO: Add alternative options for non-VSCode users
-            case DiffViewOptions.DIFF_EDITOR:
-                print("Opening diff editor...")
-                if shutil.which("code") is None:
-                    print("Need VSCode cmd-line 'code' to open diff editor")
-                else:
-                    subprocess.run(
-                        'code --new-window --diff "{}" "{}"'.format(
-                            to_compare[0].abs_path.resolve(),
-                            to_compare[1].abs_path.resolve(),
-                        ),
-                        shell=True,
-                    )
-            case DiffViewOptions.DIFF_UNIFIED:
-                diff_log = utils.make_unified_diff(
-                    to_compare[0].abs_path, to_compare[1].abs_path
-                )
-                for line in diff_log:
-                    print(line)
-            case DiffViewOptions.DIFF_SIDE_BY_SIDE:
-                if shutil.which("code") is None:
-                    print("Need VSCode cmd-line 'code' to view unified diff")
-                else:
-                    subprocess.run(
-                        'diff --side-by-side "{}" "{}"'.format(
-                            to_compare[0].abs_path.resolve(),
-                            to_compare[1].abs_path.resolve(),
-                        ),
-                        shell=True,
-                    )
-                    print("\n")
+        with diff_paths(to_compare) as (path_a, path_b):
+            # The editor must be waited on before extracted members are removed
+            has_members = any(isinstance(file, ArchiveFile) for file in to_compare)
+            wait = " --wait" if has_members else ""
+            match user_selection:
+                # TODO: Add alternative options for non-VSCode users
+                case DiffViewOptions.DIFF_EDITOR:
+                    print("Opening diff editor...")
+                    if shutil.which("code") is None:
+                        print("Need VSCode cmd-line 'code' to open diff editor")
+                    else:
+                        subprocess.run(
+                            f'code --new-window{wait} --diff "{path_a}" "{path_b}"',
+                            shell=True,
+                        )
+                case DiffViewOptions.DIFF_UNIFIED:
+                    diff_log = utils.make_unified_diff(path_a, path_b)
+                    for line in diff_log:
+                        print(line)
+                case DiffViewOptions.DIFF_SIDE_BY_SIDE:
+                    if shutil.which("code") is None:
+                        print("Need VSCode cmd-line 'code' to view unified diff")
+                    else:
+                        subprocess.run(
+                            f'diff --side-by-side "{path_a}" "{path_b}"',
+                            shell=True,
+                        )
+                        print("\n")
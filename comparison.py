@@ -35,6 +35,31 @@ class Comparison:
             f"fileB={repr(self.fileB)})"
         )
 
+    def to_record(self) -> int:
+        """Packs this comparison into a single integer of (fileA, fileB, comp_type)"""
+        for file in (self.fileA, self.fileB):
+            if file.file_id is None or file.file_id > MAX_FILE_ID:
+                raise ValueError(f"Cannot pack comparison of {repr(file)}")
+        return (
+            (self.fileA.file_id << FILE_ID_BITS + COMP_TYPE_BITS)
+            | (self.fileB.file_id << COMP_TYPE_BITS)
+            | COMP_TYPE_CODES[self.comp_type]
+        )
+
+    @staticmethod
+    def unpack_record(record: int) -> tuple:
+        """Unpacks a record made by to_record into (fileA id, fileB id, comp_type)"""
+        file_a_id = record >> FILE_ID_BITS + COMP_TYPE_BITS
+        file_b_id = (record >> COMP_TYPE_BITS) & MAX_FILE_ID
+        comp_type = COMP_TYPES[record & (1 << COMP_TYPE_BITS) - 1]
+        return file_a_id, file_b_id, comp_type
+
+    @classmethod
+    def from_record(cls, record: int, file_list: list) -> "Comparison":
+        """Unpacks a record made by to_record using the file_list it was built from"""
+        file_a_id, file_b_id, comp_type = cls.unpack_record(record)
+        return cls(file_list[file_a_id], file_list[file_b_id], comp_type)
+
     def __str__(self):
         return (
             f"Comparison Type: {self.comp_type.name}\n"
@@ -45,3 +70,10 @@ class Comparison:
 
 # Define alias
 CompType = Comparison.CompType
+
+# Packed comparison records: 28 bits per file id and 8 bits for the CompType
+FILE_ID_BITS = 28
+COMP_TYPE_BITS = 8
+MAX_FILE_ID = (1 << FILE_ID_BITS) - 1
+COMP_TYPES = list(CompType)
+COMP_TYPE_CODES = {comp_type: code for code, comp_type in enumerate(COMP_TYPES)}
@@ -1,7 +1,7 @@
 import logging
 from pathlib import Path
 from collections import defaultdict
-from typing import Dict
+from typing import Dict, Optional
 
 import utils
 from comparison import Comparison, CompType
@@ -9,9 +9,22 @@ from file import File
 
 
 class ComparisonIndex:
-    def __init__(self, comparison_type: CompType):
+    def __init__(
+        self, comparison_type: CompType, trust_metadata=False, hash_fallback=False
+    ):
         self.comp_type: CompType = comparison_type
+        # Content is keyed by (size, mtime_ns) when it was assumed from metadata
+        self.trust_metadata = trust_metadata
+        self.hash_fallback = hash_fallback
         self.index: Dict[tuple:list] = defaultdict(list[File])
+        # File ids in each group, for O(1) membership checks
+        self.member_ids: Dict[tuple:set] = defaultdict(set)
+        # File ids placed in this index by a comparison decided from metadata
+        self.assumed_ids = set()
+        # Key of the group holding each compared file id. A group keeps the key
+        # it was made with even when its files' own key traits differ, as for
+        # files of different mtimes matched by hash with hash_fallback
+        self.group_keys: Dict[int:tuple] = {}
 
     def __repr__(self):
         return (
@@ -24,12 +37,18 @@ class ComparisonIndex:
         msg = [
             f"ComparisonIndex: {self.comp_type.name}\n",
         ]
+        if self.trust_metadata:
+            msg.append(
+                "Content compared by size and mtime, files marked [assumed] were "
+                "placed here without being read\n"
+            )
         for key, file_list in self.index.items():
             msg.append(f"Key: {key}\n")
             for file in file_list:
                 file: File
 
-                msg.append(f"\t{file.name} ({file.rel_path})\n")
+                mark = " [assumed]" if file.file_id in self.assumed_ids else ""
+                msg.append(f"\t{file.name} ({file.rel_path}){mark}\n")
                 msg.append(f"\t\t{file.abs_path}\n")
         return "".join(msg)
 
@@ -46,28 +65,80 @@ class ComparisonIndex:
     def add_file(self, file: File):
         key_traits = self._get_key_traits(file)
         self.index[key_traits].append(file)
+        self.member_ids[key_traits].add(file.file_id)
 
     def add_comparison(self, comparison: Comparison):
         if comparison.comp_type != self.comp_type:
             raise ValueError(
                 f"Attempted to add {comparison.comp_type} to index of {self.comp_type}"
             )
-        logging.info(str(comparison))
+        logging.debug("%s", comparison)
+
+        self.mark_if_assumed(comparison)
+        key_a = self.group_keys.get(comparison.fileA.file_id)
+        key_b = self.group_keys.get(comparison.fileB.file_id)
+        key_traits = key_a if key_a is not None else key_b
+        if key_traits is None:
+            key_traits = self._get_key_traits(comparison.fileA)
+        if key_b is not None and key_b != key_traits:
+            self._merge_groups(key_b, key_traits)
 
-        key_traits = self._get_key_traits(comparison.fileA)
+        member_ids = self.member_ids[key_traits]
         for file in [comparison.fileA, comparison.fileB]:
-            if file not in self.index[key_traits]:
+            if file.file_id not in member_ids:
+                member_ids.add(file.file_id)
                 self.index[key_traits].append(file)
+                self.group_keys[file.file_id] = key_traits
+
+    def _merge_groups(self, from_key: tuple, into_key: tuple):
+        """Moves the files of one group into another, for a pair joining them"""
+        member_ids = self.member_ids[into_key]
+        for file in self.index.pop(from_key):
+            if file.file_id not in member_ids:
+                member_ids.add(file.file_id)
+                self.index[into_key].append(file)
+            self.group_keys[file.file_id] = into_key
+        del self.member_ids[from_key]
+
+    def mark_if_assumed(self, comparison: Comparison):
+        """
+        Marks both files when their content was judged from size and mtime
+        alone: the same when neither was hashed by a spot check, or different
+        when their mtimes differ and hash_fallback is off
+        """
+        file_a, file_b = comparison.fileA, comparison.fileB
+        if not self.trust_metadata or file_a.size != file_b.size:
+            return
+        if file_a.mtime_ns == file_b.mtime_ns:
+            is_assumed = file_a.full_hash is None or file_b.full_hash is None
+        else:
+            is_assumed = not self.hash_fallback
+        if is_assumed:
+            self.assumed_ids.update((file_a.file_id, file_b.file_id))
+
+    def get_group(self, file: File) -> Optional[list]:
+        """The group holding the file, or None if the file isn't in this index"""
+        key_traits = self._get_group_key(file)
+        if file.file_id in self.member_ids.get(key_traits, ()):
+            return self.index[key_traits]
+        return None
 
     def set_comparisons(self, file_list: list[Comparison]):
         if not isinstance(file_list, list):
             file_list = [file_list]
         key_file = file_list[0]
-        key_traits = self._get_key_traits(key_file)
+        key_traits = self._get_group_key(key_file)
         self.index[key_traits] = file_list
+        self.member_ids[key_traits] = {file.file_id for file in file_list}
 
     def remove_comparisons(self, file: File):
-        del self.index[self._get_key_traits(file)]
+        key_traits = self._get_group_key(file)
+        del self.index[key_traits]
+        del self.member_ids[key_traits]
+
+    def _get_group_key(self, file: File) -> tuple:
+        key_traits = self.group_keys.get(file.file_id)
+        return self._get_key_traits(file) if key_traits is None else key_traits
 
     def _get_key_traits(self, file: File) -> tuple:
         key_traits = []
@@ -78,6 +149,8 @@ class ComparisonIndex:
                         key_traits.append(file.rel_path.parent)
                     case "name":
                         key_traits.append(file.name)
+                    case "content" if self.trust_metadata:
+                        key_traits.append((file.size, file.mtime_ns))
                     case "content":
                         key_traits.append(file.quick_hash)
         return tuple(key_traits)
@@ -1,23 +1,52 @@
+import zlib
+import hashlib
 import logging
+import multiprocessing
+from array import array
 from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
 from typing import List, Dict, Tuple
 from pathlib import Path
 
 import cli
+import config
+import reader
+import governor
 from file import File
+from archive import ArchiveFile
 from dir_index import DirIndex
 from comparison_index import ComparisonIndex
-from comparison import Comparison, CompType
+from comparison import Comparison, CompType, COMP_TYPE_BITS, FILE_ID_BITS
+
+# Codes of the CompTypes of same name pairs, which are compared before the
+# same size pairs of each file
+NAME_COMP_TYPE_CODES = {
+    code for code, comp_type in enumerate(CompType) if comp_type.value["name"]
+}
 
 
 class ComparisonManager:
-    def __init__(self):
+    def __init__(self, trust_metadata=False, spot_check_rate=0.0, hash_fallback=False):
         # Create a ComparisonIndex for each CompType
         self.comparisons: Dict[CompType:Comparison] = {}
         for type in CompType:
-            self.comparisons[type] = ComparisonIndex(type)
+            self.comparisons[type] = ComparisonIndex(
+                type, trust_metadata, hash_fallback
+            )
 
-        self.comparison_cache: Dict[Tuple[File, File] : Comparison] = defaultdict()
+        # Treat files with the same size and mtime as copies, hashing a random
+        # sample of them to estimate how often that is wrong. With hash_fallback,
+        # files of the same size with different mtimes are hashed, not assumed
+        # to differ
+        self.trust_metadata = trust_metadata
+        self.spot_check_rate = spot_check_rate
+        self.hash_fallback = hash_fallback
+        self.spot_checks = 0
+        self.spot_check_failures = 0
+
+        # Comparisons packed as (fileA id, fileB id, CompType) integer records
+        self.comparison_cache = array("Q")
+        self.has_dup = bytearray()
 
     def __repr__(self):
         return (
@@ -40,62 +69,223 @@ class ComparisonManager:
 
     # Given a valid DirIndex, compare the files within that DirIndex and
     # add the comparisons to the manager
-    def add_dir_index(self, dir_index: DirIndex):
+    def add_dir_index(self, dir_index: DirIndex, workers=1):
+        # One flag per file id, set once a file is part of any non-unique comparison
+        self.has_dup = bytearray(len(dir_index.file_list))
+        if (
+            workers > 1
+            and len(dir_index.file_list) >= config.COMPARE_PARALLEL_MIN_FILES
+        ):
+            self._add_dir_index_parallel(dir_index, workers)
+        else:
+            self._add_dir_index_serial(dir_index)
+        logging.info(
+            "Compared %d files, %d comparisons made",
+            len(dir_index.file_list),
+            len(self.comparison_cache),
+        )
+        if self.trust_metadata:
+            logging.info(self.get_spot_check_msg())
+
+    def _add_dir_index_serial(self, dir_index: DirIndex):
         for file in dir_index.file_list:
-            logging.info(f"\nAnalyzing {file}")
+            logging.debug("\nAnalyzing %s", file)
 
             # Test against other files with the same name
-            logging.info("Comparing against same name:")
+            logging.debug("Comparing against same name:")
             same_name_files = dir_index.name_index[file.name]
             name_comparisons = self._compare_file_against_group(file, same_name_files)
             found_name_compare = self._add_comparisons(name_comparisons)
             if not found_name_compare:
-                logging.info("No same name comparisons found")
+                logging.debug("No same name comparisons found")
 
-            # Test against other files with the same size
+            # Test against other files with the same size, skipping those
+            # already compared as part of the same name group
             same_size_files = dir_index.size_index[file.size]
-            size_comparisons = self._compare_file_against_group(file, same_size_files)
+            size_comparisons = self._compare_file_against_group(
+                file, same_size_files, skip_name=file.name
+            )
             found_size_compare = self._add_comparisons(size_comparisons)
             if not found_size_compare:
-                logging.info("No same size comparisons found")
+                logging.debug("No same size comparisons found")
+
+            # If no comparison was found with any file, mark as unique
+            if not self.has_dup[file.file_id]:
+                logging.debug("Unique file")
+                self.comparisons[CompType.UNIQUE].add_file(file)
+
+    def _add_dir_index_parallel(self, dir_index: DirIndex, workers: int):
+        """
+        Compares the pairs of each shard on a process pool, then adds the
+        comparisons in the same order as _add_dir_index_serial, so the indexes
+        and reports are the same as a serial run.
 
-            # If no comparison was found across either groups, mark as unique
-            if not found_name_compare and not found_size_compare:
-                logging.info("Unique file")
+        Only files of the same size are read to compare them, so same size
+        groups are sharded by size. Same name pairs of different sizes are
+        sharded by name.
+        """
+        shards = self._make_shards(dir_index, workers * config.SHARDS_PER_WORKER)
+        current_governor = governor.get_governor()
+        # Workers are spawned rather than forked, since forking copies locks
+        # held by other threads, such as the logging listener's
+        pool = ProcessPoolExecutor(
+            max_workers=workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_compare_worker,
+            initargs=(
+                reader.get_read_policy(),
+                current_governor.bytes_per_sec,
+                current_governor.iops,
+                current_governor.cpu_workers,
+                current_governor.all_cpus,
+                current_governor.control_file,
+                workers,
+            ),
+        )
+        records = []
+        file_list = dir_index.file_list
+        with pool:
+            futures = [
+                pool.submit(
+                    _compare_shard,
+                    size_groups,
+                    name_groups,
+                    self.trust_metadata,
+                    self.spot_check_rate,
+                    self.hash_fallback,
+                )
+                for size_groups, name_groups in shards
+                if size_groups or name_groups
+            ]
+            for future in futures:
+                shard_records, hashes, spot_checks, spot_check_failures = (
+                    future.result()
+                )
+                records.extend(shard_records)
+                self.spot_checks += spot_checks
+                self.spot_check_failures += spot_check_failures
+                for file_id, quick_hash, full_hash in hashes:
+                    for file in file_list[file_id].hardlinks:
+                        file.quick_hash = file.quick_hash or quick_hash
+                        file.full_hash = file.full_hash or full_hash
+        logging.info(
+            f"Compared {len(records)} pairs in {len(futures)} shards "
+            f"on {workers} workers"
+        )
+
+        records.sort(key=_get_serial_order)
+        position = 0
+        for file in file_list:
+            comparisons = []
+            while (
+                position < len(records)
+                and records[position] >> FILE_ID_BITS + COMP_TYPE_BITS == file.file_id
+            ):
+                comparisons.append(Comparison.from_record(records[position], file_list))
+                position += 1
+            self._add_comparisons(comparisons)
+            if not self.has_dup[file.file_id]:
                 self.comparisons[CompType.UNIQUE].add_file(file)
 
-    def _compare_file_against_group(self, file: File, group: List[File]):
+    @staticmethod
+    def _make_shards(
+        dir_index: DirIndex, shard_count: int
+    ) -> List[Tuple[List[list], List[list]]]:
+        """
+        Buckets the same size groups by size and same name groups by name. Files
+        are sent to the workers as tuples from File.to_tuple
+        """
+        shards = [([], []) for _ in range(shard_count)]
+        for size, group in dir_index.size_index.items():
+            if len(group) > 1:
+                shards[size % shard_count][0].append(
+                    [file.to_tuple() for file in group]
+                )
+        for name, group in dir_index.name_index.items():
+            if len(group) > 1 and len({file.size for file in group}) > 1:
+                shard_id = zlib.crc32(name.encode("utf-8", "surrogateescape"))
+                shards[shard_id % shard_count][1].append(
+                    [file.to_tuple() for file in group]
+                )
+        return shards
+
+    def get_spot_check_msg(self) -> str:
+        error_rate = self.spot_check_failures / max(self.spot_checks, 1)
+        return (
+            f"Spot checked {self.spot_checks} content matches assumed from metadata, "
+            f"{self.spot_check_failures} differed (estimated error rate {error_rate:.2%})"
+        )
+
+    def get_comparisons(self, dir_index: DirIndex) -> List[Comparison]:
+        """Unpacks the cached comparison records made from the given DirIndex"""
+        return [
+            Comparison.from_record(record, dir_index.file_list)
+            for record in self.comparison_cache
+        ]
+
+    def _compare_file_against_group(
+        self, file: File, group: List[File], skip_name: str = None
+    ):
+        # Each pair is compared once, by the file with the lower id
         comparisons = []
         for other_file in group:
-            if file is not other_file and not (
-                self.comparison_cache.get((self, other_file))
-                or self.comparison_cache.get((self, other_file))
-            ):
-                new_comparison = file.compare_to(other_file)
-                comparisons.append(new_comparison)
+            if other_file.file_id > file.file_id and other_file.name != skip_name:
+                comparisons.append(self._compare(file, other_file))
 
         return comparisons
 
+    def _compare(self, file: File, other_file: File) -> Comparison:
+        comparison = file.compare_to(
+            other_file, self.trust_metadata, self.hash_fallback
+        )
+        if (
+            self.trust_metadata
+            and comparison.comp_type.value["content"]
+            and file.mtime_ns == other_file.mtime_ns
+        ):
+            comparison = self._spot_check(comparison)
+        return comparison
+
+    def _spot_check(self, comparison: Comparison) -> Comparison:
+        """
+        Hashes a random sample of the content matches assumed from metadata. A
+        pair whose content differs is compared again by hash and reclassified.
+        Pairs are picked by a hash of their ids, so the same pairs are checked
+        however the comparisons are sharded.
+        """
+        file_a, file_b = comparison.fileA, comparison.fileB
+        pick = hashlib.blake2b(
+            f"{config.SPOT_CHECK_SEED}:{file_a.file_id}:{file_b.file_id}".encode(),
+            digest_size=8,
+        ).digest()
+        if int.from_bytes(pick, "big") / (1 << 64) >= self.spot_check_rate:
+            return comparison
+
+        self.spot_checks += 1
+        if file_a.get_full_hash() == file_b.get_full_hash():
+            return comparison
+
+        self.spot_check_failures += 1
+        logging.warning(
+            f"Spot check found different content with the same size and mtime: "
+            f"{file_a.abs_path} <-> {file_b.abs_path}"
+        )
+        return file_a.compare_to(file_b)
+
     def _add_comparisons(self, comparisons: List[Comparison]):
         non_unique_added = False
         for comparison in comparisons:
-            self.comparison_cache[(comparison.fileA, comparison.fileB)] = comparison
-            if comparison.comp_type != CompType.UNIQUE:
+            self.comparison_cache.append(comparison.to_record())
+            if comparison.comp_type == CompType.UNIQUE:
+                # Marks the files in case they end up unique
+                self.comparisons[CompType.UNIQUE].mark_if_assumed(comparison)
+            else:
                 non_unique_added = True
+                self.has_dup[comparison.fileA.file_id] = 1
+                self.has_dup[comparison.fileB.file_id] = 1
                 self.comparisons[comparison.comp_type].add_comparison(comparison)
         return non_unique_added
 
-    def _compare_files(self, file_a: File, file_b: File):
-        """Compares two files and caches the result"""
-        logging.info(f"Comparing two files:\n\t{file_a}\n\t{file_b}")
-
-        # Create comparison and cache it
-        comparison = Comparison(file_a, file_b)
-        self.comparisons[comparison.comp_type].add_comparison(comparison)
-        print(type(self.comparisons[comparison.comp_type]))
-        self.comparison_cache[(file_a, file_b)] = comparison
-        return
-
     def resolve_all(self):
         for type in CompType:
             if type == CompType.MATCH:
@@ -118,18 +308,185 @@ class ComparisonManager:
     def resolve_dups(self, type: CompType):
         comparison_index: ComparisonIndex = self.comparisons[type]
         to_remove = []
-        for key, dup_list in comparison_index.index.items():
-            logging.info(f"Resolving {type.name} dup: {repr(dup_list)}")
+        for signature, keys in self._cluster_by_dir_signature(comparison_index).items():
+            # Groups sharing the same directories can be resolved with one decision
+            if len(keys) > 1 and self._resolve_cluster(
+                type, comparison_index, signature, keys
+            ):
+                continue
 
-            cli.display_files(msg=f"Resolving {type.name} dup", file_list=dup_list)
-            if not type.value["content"]:
-                cli.prompt_build_diff(dup_list)
+            for key in keys:
+                dup_list = comparison_index.index[key]
+                logging.info(f"Resolving {type.name} dup: {repr(dup_list)}")
 
-            user_choice = cli.prompt_keep_options(dup_list)
-            if len(user_choice) == 0:
-                to_remove.append(dup_list[0])
-            else:
-                comparison_index.set_comparisons(user_choice)
+                cli.display_files(msg=f"Resolving {type.name} dup", file_list=dup_list)
+                if not type.value["content"]:
+                    cli.prompt_build_diff(dup_list)
+
+                user_choice = cli.prompt_keep_options(dup_list)
+                if len(user_choice) == 0:
+                    to_remove.append(dup_list[0])
+                else:
+                    comparison_index.set_comparisons(user_choice)
 
         for file in to_remove:
             comparison_index.remove_comparisons(file)
+
+    def _cluster_by_dir_signature(
+        self, comparison_index: ComparisonIndex
+    ) -> Dict[tuple, List[tuple]]:
+        """Groups the keys of an index by the (base path, parent dir) of their files"""
+        clusters: Dict[tuple, List[tuple]] = defaultdict(list)
+        for key, dup_list in comparison_index.index.items():
+            signature = tuple(
+                sorted({(file.base_path, file.rel_path.parent) for file in dup_list})
+            )
+            clusters[signature].append(key)
+        return clusters
+
+    def _resolve_cluster(
+        self,
+        type: CompType,
+        comparison_index: ComparisonIndex,
+        signature: tuple,
+        keys: List[tuple],
+    ) -> bool:
+        """
+        Resolves every group in a cluster with a single choice of directories.
+        Returns False if the user chose to resolve the groups individually.
+        """
+        while True:
+            logging.info(
+                f"Resolving {type.name} cluster of {len(keys)} groups: {signature}"
+            )
+            cli.display_cluster(
+                msg=f"Resolving {type.name} cluster",
+                signature=list(signature),
+                group_count=len(keys),
+            )
+            sample_list = comparison_index.index[keys[0]]
+            cli.display_files(msg="Example group:", file_list=sample_list)
+            if not type.value["content"]:
+                cli.prompt_build_diff(sample_list)
+
+            if cli.prompt_cluster_options() is cli.ClusterOptions.RESOLVE_INDIVIDUALLY:
+                return False
+
+            keep_dirs = set(cli.prompt_keep_dirs(list(signature)))
+            snapshot = {key: comparison_index.index[key] for key in keys}
+            to_remove = []
+            for key in keys:
+                user_choice = [
+                    file
+                    for file in snapshot[key]
+                    if (file.base_path, file.rel_path.parent) in keep_dirs
+                ]
+                if len(user_choice) == 0:
+                    to_remove.append(snapshot[key][0])
+                else:
+                    comparison_index.set_comparisons(user_choice)
+            logging.info(f"Kept {sorted(keep_dirs)} for {len(keys)} groups")
+
+            if cli.prompt_review_cluster() is cli.ClusterReviewOptions.KEEP:
+                for file in to_remove:
+                    comparison_index.remove_comparisons(file)
+                return True
+
+            # Restore every group in the cluster and ask again
+            logging.info(f"Undoing decision for cluster: {signature}")
+            for dup_list in snapshot.values():
+                comparison_index.set_comparisons(dup_list)
+
+
+def _get_serial_order(record: int) -> int:
+    """Sorts records by fileA, then same name pairs before same size pairs, then fileB"""
+    file_a_id = record >> FILE_ID_BITS + COMP_TYPE_BITS
+    file_b_id = (record >> COMP_TYPE_BITS) & (1 << FILE_ID_BITS) - 1
+    is_size_pair = (record & (1 << COMP_TYPE_BITS) - 1) not in NAME_COMP_TYPE_CODES
+    return ((file_a_id << 1 | is_size_pair) << FILE_ID_BITS) | file_b_id
+
+
+def _init_compare_worker(
+    read_policy: reader.ReadPolicy,
+    bytes_per_sec,
+    iops,
+    cpu_workers,
+    all_cpus,
+    control_file,
+    workers,
+):
+    # Each worker gets an equal share of the read budgets, follows the same
+    # control file, and is pinned to the same CPUs as the main process, since
+    # affinity is per process
+    logging.basicConfig(level=logging.WARNING, force=True)
+    reader.set_read_policy(read_policy)
+    governor.set_governor(
+        governor.Governor(
+            bytes_per_sec=bytes_per_sec,
+            iops=iops,
+            cpu_workers=cpu_workers,
+            control_file=control_file,
+            all_cpus=all_cpus,
+            share=workers,
+        )
+    )
+
+
+def _compare_shard(
+    size_groups: List[List[tuple]],
+    name_groups: List[List[tuple]],
+    trust_metadata: bool,
+    spot_check_rate: float,
+    hash_fallback: bool,
+) -> tuple:
+    """
+    Compares every pair in each same size group, and the pairs of different
+    sizes in each same name group. Returns the comparison records, the hashes
+    computed along the way and the spot check counts.
+    """
+    comparison_manager = ComparisonManager(
+        trust_metadata, spot_check_rate, hash_fallback
+    )
+    # One File per file id, for files in both a size and a name group
+    files: Dict[int:File] = {}
+    size_groups = [_get_shard_files(files, group) for group in size_groups]
+    name_groups = [_get_shard_files(files, group) for group in name_groups]
+    records = array("Q")
+    for group in size_groups:
+        for i, file in enumerate(group):
+            for other_file in group[i + 1 :]:
+                records.append(
+                    comparison_manager._compare(file, other_file).to_record()
+                )
+    for group in name_groups:
+        for i, file in enumerate(group):
+            for other_file in group[i + 1 :]:
+                if other_file.size != file.size:
+                    comparison = comparison_manager._compare(file, other_file)
+                    records.append(comparison.to_record())
+
+    hashes = [
+        (file.file_id, file.quick_hash, file.full_hash)
+        for group in size_groups
+        for file in group
+        if file.quick_hash or file.full_hash
+    ]
+    return (
+        records,
+        hashes,
+        comparison_manager.spot_checks,
+        comparison_manager.spot_check_failures,
+    )
+
+
+def _get_shard_files(files: Dict[int, File], group: List[tuple]) -> List[File]:
+    """Rebuilds a group of files sent as tuples, reusing those already rebuilt"""
+    group_files = []
+    for file_tuple in group:
+        file = files.get(file_tuple[0])
+        if file is None:
+            # Archive members also have their archive path and member name
+            file_class = ArchiveFile if len(file_tuple) > 8 else File
+            file = files[file_tuple[0]] = file_class.from_tuple(file_tuple)
+        group_files.append(file)
+    return group_files
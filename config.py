@@ -10,3 +10,57 @@ KEY_PATH = Path("testing/keys")
 OUTPUT_DIR_PATH = Path("./.results")
 
 LOG_PATH = Path(OUTPUT_DIR_PATH / "logs")
+
+INDEX_DB_PATH = Path(OUTPUT_DIR_PATH / "INDEX")
+
+# Bloom filters of large roots, sized for BLOOM_ERROR_RATE false positives
+BLOOM_DIR_PATH = Path(OUTPUT_DIR_PATH / "BLOOM")
+BLOOM_INITIAL_CAPACITY = 1 << 20
+BLOOM_ERROR_RATE = 0.01
+
+DAEMON_SOCKET_PATH = Path(OUTPUT_DIR_PATH / "dir_merge.sock")
+
+# Per-file detail is logged at DEBUG, so INFO keeps hot loops cheap
+LOG_LEVEL = "INFO"
+LOG_SAMPLE_RATE = 1
+
+# Verified merge copies
+COPY_CHUNK_SIZE = 1024 * 1024
+VERIFY_COPY_ATTEMPTS = 3
+# Most files written before they are synced and journaled together
+MERGE_FSYNC_BATCH_SIZE = 1000
+# Sync each batch with one syncfs call on Linux instead of an fsync per file
+# and dir. It is faster on a dedicated disk, but flushes every dirty page of the
+# whole filesystem, including other processes', which can stall a shared host
+MERGE_SYNC_FILESYSTEM = False
+
+# Reads for hashing and copying, DIRECT_IO_MIN_SIZE of None never uses O_DIRECT
+READ_BUFFER_SIZE = 1024 * 1024
+READ_USE_FADVISE = True
+DIRECT_IO_MIN_SIZE = None
+# Tars whose member digests are kept after their single hashing pass
+ARCHIVE_DIGEST_CACHE_SIZE = 8
+
+# Fraction of content matches assumed from size and mtime that are hashed to
+# check them, and the seed that picks them so reruns check the same pairs
+SPOT_CHECK_RATE = 0.0
+SPOT_CHECK_SEED = 0
+
+# Comparisons run on a process pool once there are this many files, split
+# into SHARDS_PER_WORKER shards per worker to balance uneven groups
+COMPARE_PARALLEL_MIN_FILES = 10000
+SHARDS_PER_WORKER = 4
+
+# Seconds between checks of the throttling control file for changes
+GOVERNOR_CONTROL_CHECK_INTERVAL = 1.0
+
+# Content-defined chunking of large files, CHUNK_AVG_SIZE must be a power of 2
+# and CHUNK_MIN_SIZE at least the 32 byte rolling hash window
+CHUNK_MIN_SIZE = 16 * 1024
+CHUNK_AVG_SIZE = 64 * 1024
+CHUNK_MAX_SIZE = 256 * 1024
+# Mask bits added before, and removed after, CHUNK_AVG_SIZE to narrow chunk sizes
+CHUNK_NORMALIZATION = 2
+# Largest file chunked without numpy, where chunking runs at only a few MiB/s
+CHUNK_PURE_PYTHON_MAX_SIZE = 64 * 1024 * 1024
+CHUNK_DB_PATH = Path(OUTPUT_DIR_PATH / "chunks.sqlite")
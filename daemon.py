@@ -0,0 +1,248 @@
+import os
+import json
+import socket
+import logging
+import threading
+import socketserver
+
+from pathlib import Path
+from typing import Dict, List
+
+import config
+import utils
+from file import File
+from dir_index import DirIndex
+from walk_filter import WalkFilter
+from comparison_manager import ComparisonManager
+
+COMMANDS = ("status", "lookup", "contains", "rescan", "report", "shutdown")
+
+
+class IndexState:
+    """A DirIndex and the ComparisonManager built from it, with path lookups"""
+
+    def __init__(self, dir_index: DirIndex, comparison_manager: ComparisonManager):
+        self.dir_index = dir_index
+        self.comparison_manager = comparison_manager
+        self.abs_paths: Dict[str:File] = {}
+        self.rel_paths: Dict[str : List[File]] = {}
+        for file in dir_index.file_list:
+            self.abs_paths[str(file.abs_path.resolve())] = file
+            self.rel_paths.setdefault(file.rel_path.as_posix(), []).append(file)
+
+    def find(self, path: str) -> List[File]:
+        """Files at an absolute path, or at a relative path in any root"""
+        file = self.abs_paths.get(str(Path(path).resolve()))
+        if file is not None and Path(path).is_absolute():
+            return [file]
+        return self.rel_paths.get(Path(path).as_posix(), [])
+
+
+class IndexDaemon:
+    """
+    Builds the index of a set of dirs once and serves lookups against it on a
+    Unix socket. Requests and responses are JSON objects, one per line, and
+    each connection is handled on its own thread.
+
+    Lookups read whichever IndexState is current. A rescan builds a new state
+    and swaps it in, reusing the hashes of files that have not changed.
+    """
+
+    def __init__(
+        self,
+        dir_paths: List[Path],
+        walk_filter: WalkFilter = None,
+        index_archives=False,
+        trust_metadata=False,
+        spot_check_rate=0.0,
+        hash_fallback=False,
+    ):
+        self.dir_paths = [Path(path) for path in dir_paths]
+        self.walk_filter = walk_filter
+        self.index_archives = index_archives
+        self.trust_metadata = trust_metadata
+        self.spot_check_rate = spot_check_rate
+        self.hash_fallback = hash_fallback
+        self.rescan_lock = threading.Lock()
+        self.server: socketserver.ThreadingUnixStreamServer = None
+        self.state = self._build_state()
+
+    def __repr__(self):
+        return (
+            f"IndexDaemon(dirs={[str(path) for path in self.dir_paths]}, "
+            f"files={len(self.state.dir_index.file_list)})"
+        )
+
+    def _build_state(self, previous: IndexState = None, rescan_path: Path = None):
+        dir_index = DirIndex(
+            walk_filter=self.walk_filter, index_archives=self.index_archives
+        )
+        for path in self.dir_paths:
+            dir_index.index_dir(path)
+        if previous is not None:
+            self._reuse_hashes(dir_index, previous, rescan_path)
+
+        comparison_manager = ComparisonManager(
+            self.trust_metadata, self.spot_check_rate, self.hash_fallback
+        )
+        comparison_manager.add_dir_index(dir_index)
+        logging.info(f"Built index of {len(dir_index.file_list)} files")
+        return IndexState(dir_index, comparison_manager)
+
+    @staticmethod
+    def _reuse_hashes(dir_index: DirIndex, previous: IndexState, rescan_path: Path):
+        """
+        Copies the hashes of unchanged files from the previous state, except
+        for files under rescan_path, which are hashed again when needed
+        """
+        for file in dir_index.file_list:
+            abs_path = file.abs_path.resolve()
+            if rescan_path is not None and abs_path.is_relative_to(rescan_path):
+                continue
+            old_file = previous.abs_paths.get(str(abs_path))
+            if (
+                old_file is not None
+                and old_file.size == file.size
+                and old_file.mtime_ns == file.mtime_ns
+            ):
+                file.quick_hash = old_file.quick_hash
+                file.full_hash = old_file.full_hash
+
+    def serve(self, socket_path: Path = config.DAEMON_SOCKET_PATH):
+        socket_path = Path(socket_path)
+        if socket_path.exists():
+            if is_listening(socket_path):
+                raise RuntimeError(f"A daemon is already serving on {socket_path}")
+            socket_path.unlink()
+
+        daemon = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                for line in self.rfile:
+                    response = daemon.handle_request(line)
+                    self.wfile.write(json.dumps(response).encode() + b"\n")
+                    self.wfile.flush()
+
+        utils.ensure_path_exists(socket_path.parent)
+        # Only the user running the daemon may connect, as any client can shut
+        # it down or have it write reports. The socket is created without group
+        # or other permissions, so no one else can connect before the chmod
+        old_umask = os.umask(0o177)
+        try:
+            server = socketserver.ThreadingUnixStreamServer(str(socket_path), Handler)
+        finally:
+            os.umask(old_umask)
+        os.chmod(socket_path, 0o600)
+        with server:
+            server.daemon_threads = True
+            self.server = server
+            msg = f"Serving {repr(self)} on {socket_path}"
+            print(msg)
+            logging.info(msg)
+            try:
+                server.serve_forever()
+            finally:
+                socket_path.unlink(missing_ok=True)
+                logging.info(f"Stopped serving on {socket_path}")
+
+    def handle_request(self, line: bytes) -> dict:
+        try:
+            request = json.loads(line)
+            command = request.get("command")
+            if command not in COMMANDS:
+                raise ValueError(f"Unknown command {command!r}, expected {COMMANDS}")
+            result = getattr(self, f"_{command}")(request)
+            return {"ok": True, "result": result}
+        except Exception as e:
+            logging.exception(f"Failed request: {line!r}")
+            return {"ok": False, "error": f"{type(e).__name__}: {e}"}
+
+    def _status(self, request: dict) -> dict:
+        state = self.state
+        return {
+            "dirs": [str(path) for path in self.dir_paths],
+            "files": len(state.dir_index.file_list),
+            "groups": {
+                comp_type.name: len(index.index)
+                for comp_type, index in state.comparison_manager.comparisons.items()
+            },
+        }
+
+    def _lookup(self, request: dict) -> List[dict]:
+        """The CompType groups holding each indexed file at a path"""
+        state = self.state
+        results = []
+        for file in state.find(request["path"]):
+            groups = {}
+            for comp_type, index in state.comparison_manager.comparisons.items():
+                group = index.get_group(file)
+                if group is not None:
+                    groups[comp_type.name] = [
+                        describe_file(other) for other in group if other is not file
+                    ]
+            results.append({**describe_file(file), "groups": groups})
+        return results
+
+    def _contains(self, request: dict) -> List[dict]:
+        """Indexed files with the same content as a file anywhere on disk"""
+        path = Path(request["path"]).resolve()
+        probe = File(path.parent, path)
+        state = self.state
+        return [
+            describe_file(file)
+            for file in state.dir_index.size_index.get(probe.size, [])
+            if file.abs_path.resolve() == path
+            or file.compare_content(probe, self.trust_metadata, self.hash_fallback)
+        ]
+
+    def _rescan(self, request: dict) -> dict:
+        """Rebuilds the index, hashing files under `path` again if it is given"""
+        rescan_path = Path(request["path"]).resolve() if request.get("path") else None
+        with self.rescan_lock:
+            self.state = self._build_state(self.state, rescan_path)
+        return self._status(request)
+
+    def _report(self, request: dict) -> dict:
+        """Writes the reports to output_dir, which must be inside OUTPUT_DIR_PATH"""
+        output_root = config.OUTPUT_DIR_PATH.resolve()
+        output_dir = Path(request.get("output_dir") or output_root).resolve()
+        if not output_dir.is_relative_to(output_root):
+            raise ValueError(f"output_dir must be inside {output_root}")
+        state = self.state
+        state.dir_index.print_trait_indexes_to_file(output_dir)
+        state.comparison_manager.write_to_file(output_dir)
+        return {"output_dir": str(output_dir)}
+
+    def _shutdown(self, request: dict) -> dict:
+        # shutdown() waits for serve_forever to return, so it can't run on a handler thread
+        threading.Thread(target=self.server.shutdown).start()
+        return {}
+
+
+def describe_file(file: File) -> dict:
+    return {
+        "abs_path": str(file.abs_path),
+        "rel_path": file.rel_path.as_posix(),
+        "size": file.size,
+        "full_hash": file.full_hash,
+    }
+
+
+def is_listening(socket_path: Path) -> bool:
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+        try:
+            client.connect(str(socket_path))
+            return True
+        except OSError:
+            return False
+
+
+def send_request(socket_path: Path, request: dict) -> dict:
+    """Sends one request to a running IndexDaemon and returns its response"""
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+        client.connect(str(socket_path))
+        with client.makefile("rwb") as stream:
+            stream.write(json.dumps(request).encode() + b"\n")
+            stream.flush()
+            return json.loads(stream.readline())
@@ -1,17 +1,32 @@
+import os
 import logging
+import tarfile
+import zipfile
 
-from pathlib import Path
+from pathlib import Path, PurePosixPath
 from collections import defaultdict
-from typing import List, Dict
+from typing import Callable, List, Dict, Iterable, Iterator, Tuple
 
 import utils
+import archive
 from file import File
+from archive import ArchiveFile
+from walk_filter import WalkFilter
 
 
 class DirIndex:
-    def __init__(self, name_index=None, size_index=None):
+    def __init__(
+        self, name_index=None, size_index=None, walk_filter=None, index_archives=False
+    ):
         self.logger = logging.getLogger(__name__)
         self.base_dir_paths = []
+        self.walk_filter: WalkFilter = walk_filter or WalkFilter()
+
+        # Index the members of zip and tar archives instead of the archives
+        self.index_archives = index_archives
+
+        # Number of dirs, files and file bytes skipped by the walk filter
+        self.excluded_counts: Dict[str:int] = defaultdict(int)
 
         # List all files in index
         self.file_list: List[File] = []
@@ -20,6 +35,9 @@ class DirIndex:
         self.name_index: Dict[str : List[File]] = name_index or defaultdict(list)
         self.size_index: Dict[int : List[File]] = size_index or defaultdict(list)
 
+        # First file seen for each (st_dev, st_ino) with several hardlinks
+        self.inode_index: Dict[tuple:File] = {}
+
     def __repr__(self):
         return (
             f"file_count={len(self.file_list)}, "
@@ -64,25 +82,176 @@ class DirIndex:
         # Recursively iterate over filetree and add to index
         base_dir_path = Path(base_dir_path)
         self.base_dir_paths.append(base_dir_path)
-        for abs_path in base_dir_path.rglob("*"):
-            if not utils.is_hidden(abs_path):
-                if abs_path.is_file():
-                    self.logger.info(
-                        f"Indexing file: \n\tName: {abs_path.name}\n\tPath: {abs_path}"
-                    )
-
-                    # Convert to lf for diff comparison
-                    if abs_path.suffix.lower() == ".md" and normalize_line_endings:
-                        self.logger.info(f"Normalizing line endings to lf...")
-                        self._convert_to_lf(abs_path)
-
-                    # Create file object and add to indexes
-                    file = File(base_dir_path, abs_path)
-                    self.file_list.append(file)
-                    self.name_index[file.name].append(file)
-                    self.size_index[file.size].append(file)
-                elif abs_path.is_dir():
-                    self.logger.info(f"Indexing directory: {abs_path}")
+        start_count = len(self.file_list)
+        for abs_path, stat_result in self._walk(base_dir_path):
+            if self.index_archives and archive.is_archive(abs_path):
+                self._index_archive(base_dir_path, abs_path)
+                continue
+
+            self.logger.debug(
+                "Indexing file: \n\tName: %s\n\tPath: %s", abs_path.name, abs_path
+            )
+
+            # Convert to lf for diff comparison
+            if abs_path.suffix.lower() == ".md" and normalize_line_endings:
+                self.logger.debug("Normalizing line endings to lf...")
+                self._convert_to_lf(abs_path)
+                stat_result = None
+
+            # Create file object and add to indexes
+            try:
+                file = File(base_dir_path, abs_path, len(self.file_list), stat_result)
+            except FileNotFoundError:
+                self.logger.warning("Skipping removed file: %s", abs_path)
+                continue
+            self._add_file(file)
+        self.logger.info(
+            "Indexed %d files from %s", len(self.file_list) - start_count, base_dir_path
+        )
+
+    def iter_files(
+        self, base_dir_path, on_dir: Callable[[Path, str], None] = None
+    ) -> Iterator[File]:
+        """
+        Yields a File for each file under base_dir_path that passes the walk
+        filter, without indexing it, so a tree can be scanned in one pass
+        without holding every File in memory. on_dir is called with the path
+        and relative path of each dir walked, before it is listed.
+        """
+        base_dir_path = Path(base_dir_path)
+        for abs_path, stat_result in self._walk(base_dir_path, on_dir):
+            yield File(base_dir_path, abs_path, stat_result=stat_result)
+
+    def index_paths(self, base_dir_path, rel_paths: Iterable[str]):
+        """
+        Indexes only the given files under base_dir_path, without walking it,
+        so only those files are stat'ed. Files removed since are skipped.
+        """
+        base_dir_path = Path(base_dir_path)
+        self.base_dir_paths.append(base_dir_path)
+        start_count = len(self.file_list)
+        for rel_path in rel_paths:
+            abs_path = base_dir_path / rel_path
+            try:
+                file = File(base_dir_path, abs_path, len(self.file_list))
+            except FileNotFoundError:
+                self.logger.warning("Skipping removed file: %s", abs_path)
+                continue
+            self._add_file(file)
+        self.logger.info(
+            "Indexed %d matching files from %s",
+            len(self.file_list) - start_count,
+            base_dir_path,
+        )
+
+    def _add_file(self, file: File):
+        self.file_list.append(file)
+        self.name_index[file.name].append(file)
+        self.size_index[file.size].append(file)
+        if file.inode is not None:
+            self._add_hardlink(file)
+
+    # Add the members of an archive as files under the archive's path
+    def _index_archive(self, base_dir_path: Path, archive_path: Path):
+        self.logger.debug("Indexing archive: %s", archive_path)
+        try:
+            members = archive.list_members(archive_path)
+        except (OSError, tarfile.TarError, zipfile.BadZipFile) as e:
+            # Unreadable archives are indexed as plain files
+            self.logger.warning(f"Failed to read archive {archive_path}: {e}")
+            self._add_file(File(base_dir_path, archive_path, len(self.file_list)))
+            return
+
+        archive_rel_dir = f"{archive_path.relative_to(base_dir_path).as_posix()}/"
+        for member_name, size, mtime_ns in members:
+            member_path = PurePosixPath(member_name)
+            if self.walk_filter.exclude_file(
+                f"{archive_rel_dir}{member_path}", member_path.name
+            ) or self.walk_filter.exclude_size(size):
+                self.excluded_counts["files"] += 1
+                continue
+            self._add_file(
+                ArchiveFile(
+                    base_dir_path,
+                    archive_path,
+                    member_name,
+                    size,
+                    mtime_ns,
+                    len(self.file_list),
+                )
+            )
+
+    def _walk(
+        self, base_dir_path: Path, on_dir: Callable[[Path, str], None] = None
+    ) -> Iterator[Tuple[Path, os.stat_result]]:
+        """
+        Yields (abs_path, stat_result) for each file under base_dir_path that
+        passes the walk filter. Directories are visited depth first, in the same
+        order as Path.rglob, and excluded directories are never entered.
+        stat_result is None when the filter did not need to stat the file.
+
+        As with Path.rglob, symlinks to directories are not followed, while
+        symlinks to files are yielded. Hidden entries are skipped below
+        base_dir_path, so a base dir inside a hidden dir is still indexed.
+        """
+        walk_filter = self.walk_filter
+        to_visit = [(base_dir_path, "")]
+        while to_visit:
+            dir_path, rel_dir = to_visit.pop()
+            if on_dir is not None:
+                on_dir(dir_path, rel_dir)
+            try:
+                with os.scandir(dir_path) as scandir_it:
+                    entries = list(scandir_it)
+            except OSError as e:
+                # Such as a dir that is unreadable, or was removed mid-walk
+                self.logger.warning("Skipping unreadable directory %s: %s", dir_path, e)
+                continue
+
+            sub_dirs = []
+            for entry in entries:
+                if entry.name.startswith("."):
+                    continue
+                rel_path = f"{rel_dir}{entry.name}"
+                if entry.is_dir(follow_symlinks=False):
+                    if walk_filter.exclude_dir(rel_path, entry.name):
+                        self.logger.debug("Excluding directory: %s", entry.path)
+                        self.excluded_counts["dirs"] += 1
+                        continue
+                    self.logger.debug("Indexing directory: %s", entry.path)
+                    sub_dirs.append((Path(entry.path), f"{rel_path}/"))
+                elif entry.is_file():
+                    if walk_filter.exclude_file(rel_path, entry.name):
+                        self.excluded_counts["files"] += 1
+                        continue
+                    stat_result = None
+                    if walk_filter.needs_size:
+                        try:
+                            stat_result = entry.stat()
+                        except FileNotFoundError:
+                            self.logger.warning("Skipping removed file: %s", entry.path)
+                            continue
+                        if walk_filter.exclude_size(stat_result.st_size):
+                            self.excluded_counts["files"] += 1
+                            self.excluded_counts["bytes"] += stat_result.st_size
+                            continue
+                    yield Path(entry.path), stat_result
+
+            to_visit.extend(reversed(sub_dirs))
+
+    def _add_hardlink(self, file: File):
+        # Share one hardlinks list between every file with the same inode
+        first_file = self.inode_index.setdefault(file.inode, file)
+        if first_file is not file:
+            file.hardlinks = first_file.hardlinks
+            file.hardlinks.append(file)
+
+    def get_excluded_msg(self) -> str:
+        return (
+            f"Excluded {self.excluded_counts['dirs']} directories and "
+            f"{self.excluded_counts['files']} files "
+            f"({self.excluded_counts['bytes']} bytes excluded by size)"
+        )
 
     def _convert_to_lf(self, file_path):
         """MODIFIES FILE CONTENT!"""
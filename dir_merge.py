@@ -1,8 +1,24 @@
+import sys
 import argparse
 from pathlib import Path
 
-from dir_merge_runner import index_from_paths, index_from_prompt
+import config
+import utils
+from comparison import CompType
+from daemon import COMMANDS
+from dir_merge_runner import (
+    RunOptions,
+    index_from_paths,
+    index_from_prompt,
+    query_index,
+    request_daemon,
+    serve_index,
+)
+from governor import Governor, set_governor
 from log_config import setup_logging
+from reader import ReadPolicy, set_read_policy
+from union_builder import ViewMode
+from walk_filter import WalkFilter
 
 
 def main():
@@ -11,13 +27,105 @@ def main():
 
     If directory paths are provided as arguments, index those directories.
     Otherwise, prompt the user interactively to input directories for indexing.
+    If the first argument is "query", answer a lookup against an exported index.
+    If the first argument is "client", send a request to a running daemon.
     """
-    setup_logging()
+    if sys.argv[1:2] == ["query"]:
+        args = parse_query_args(sys.argv[2:])
+        query_index(
+            db_path=args.db,
+            path=args.path,
+            name=args.name,
+            file_hash=args.hash,
+            copies=args.copies,
+            comp_type=args.type,
+            top_dirs=args.top_dirs,
+        )
+        return
+    if sys.argv[1:2] == ["client"]:
+        args = parse_client_args(sys.argv[2:])
+        request_daemon(
+            args.command,
+            socket_path=args.socket,
+            path=args.path,
+            output_dir=args.output_dir,
+        )
+        return
+
     args = parse_args()
+    setup_logging(
+        level=args.log_level,
+        sample_rate=args.log_sample_rate,
+        json_format=args.log_json,
+    )
+    set_read_policy(
+        ReadPolicy(
+            buffer_size=args.read_buffer_size,
+            use_fadvise=not args.no_fadvise,
+            direct_io_min_size=args.direct_io_min_size,
+        )
+    )
+    set_governor(
+        Governor(
+            bytes_per_sec=args.max_bytes_per_sec,
+            iops=args.max_iops,
+            cpu_workers=args.cpu_workers,
+            control_file=args.control_file,
+        )
+    )
+    walk_filter = build_walk_filter(args)
+    if args.serve:
+        serve_index(
+            args.dirs,
+            walk_filter,
+            socket_path=args.socket,
+            index_archives=args.index_archives,
+            trust_metadata=args.trust_metadata,
+            spot_check_rate=args.spot_check_rate,
+            hash_fallback=args.hash_fallback,
+        )
+        return
+
+    options = RunOptions(
+        walk_filter=walk_filter,
+        index_archives=args.index_archives,
+        preserve_hardlinks=args.preserve_hardlinks,
+        verify=args.verify,
+        update_merge=args.update_merge,
+        view=args.view,
+        export_index=args.export_index,
+        nway=args.nway,
+        chunk_min_size=args.chunk_min_size,
+        prefilter_root=args.prefilter_root,
+        rebuild_prefilter=args.rebuild_prefilter,
+        trust_metadata=args.trust_metadata,
+        spot_check_rate=args.spot_check_rate,
+        hash_fallback=args.hash_fallback,
+        compare_workers=args.compare_workers,
+    )
     if not args.dirs:
-        index_from_prompt()
+        index_from_prompt(options)
     else:
-        index_from_paths(args.dirs)
+        index_from_paths(args.dirs, options)
+
+
+def build_walk_filter(args) -> WalkFilter:
+    """
+    Build the WalkFilter used while indexing from the filter config file, if
+    given, and the filter options on the command line.
+    """
+    options = {
+        "exclude": args.exclude,
+        "include": args.include,
+        "ignore_files": args.ignore_file,
+        "extensions": args.ext,
+        "exclude_extensions": args.exclude_ext,
+        "min_size": args.min_size,
+        "max_size": args.max_size,
+    }
+    if args.filter_config:
+        return WalkFilter.from_config_file(args.filter_config, **options)
+    return WalkFilter(**options)
 
 
 def parse_args():
@@ -28,14 +136,310 @@ def parse_args():
         argparse.Namespace: An object containing the parsed command-line arguments.
             - dirs (list of str): List of directory paths provided by the user.
               May be empty if no directories were specified.
+            - log_level (str): Minimum level written to the log file.
+            - log_sample_rate (int): Keep 1 of every N DEBUG log records.
+            - log_json (bool): Write structured JSON log records.
+            - exclude, include (list of str): Glob patterns to skip or require.
+            - ignore_file (list of Path): .gitignore-style files of exclude patterns.
+            - ext, exclude_ext (list of str): File extensions to require or skip.
+            - min_size, max_size (int): Size limits in bytes for indexed files.
+            - filter_config (Path): JSON file with any of the filter options above.
+            - preserve_hardlinks (bool): Hardlink merged files that share a source inode.
+            - verify (bool): Hash files while copying and record hashes in the manifest.
+            - update_merge (Path): Previous merge dir to update instead of making a new one.
+            - index_archives (bool): Index the members of zip and tar archives.
+            - export_index (bool): Export files and comparisons to a SQLite index.
+            - nway (bool): Report consensus, outliers and missing files across all dirs.
+            - chunk_min_size (int): Report shared chunks of differing files this large.
+            - trust_metadata (bool): Assume files with the same size and mtime are copies.
+            - spot_check_rate (float): Fraction of assumed copies to check by hashing.
+            - hash_fallback (bool): Hash files of the same size with different mtimes.
+            - prefilter_root (Path): Large root to find the new files of the dirs against.
+            - rebuild_prefilter (bool): Rebuild the saved filters of prefilter_root.
+            - view (str): Build a hardlink, symlink or manifest view instead of copying.
+            - compare_workers (int): Processes to compare files on.
+            - serve (bool): Serve lookups on a Unix socket instead of merging.
+            - socket (Path): Unix socket to serve on.
+            - read_buffer_size (int): Bytes per read when hashing and copying.
+            - no_fadvise (bool): Leave read files in the page cache.
+            - direct_io_min_size (int): Read files this large with O_DIRECT.
+            - max_bytes_per_sec, max_iops (int): Read budgets for hashing and copying.
+            - cpu_workers (int): CPUs the run may use.
+            - control_file (Path): JSON file of limits, re-read while running.
     """
     parser = argparse.ArgumentParser(
         prog="DirMerge", description="Compare and merge several directories"
     )
     parser.add_argument("dirs", nargs="*", type=Path, help="Directories to be merged")
+    parser.add_argument(
+        "--log-level",
+        default=config.LOG_LEVEL,
+        choices=["DEBUG", "INFO", "WARNING", "ERROR"],
+        help="Minimum level to log, DEBUG includes per-file detail",
+    )
+    parser.add_argument(
+        "--log-sample-rate",
+        default=config.LOG_SAMPLE_RATE,
+        type=int,
+        help="Only log 1 of every N DEBUG records",
+    )
+    parser.add_argument(
+        "--log-json", action="store_true", help="Write log records as JSON lines"
+    )
+    parser.add_argument(
+        "--preserve-hardlinks",
+        action="store_true",
+        help="Hardlink merged files that are hardlinks of each other in the source",
+    )
+    parser.add_argument(
+        "--verify",
+        action="store_true",
+        help="Verify copied files against their hashes, recorded in the merge manifest",
+    )
+    parser.add_argument(
+        "--update-merge",
+        type=Path,
+        help="Update this previous merge dir in place, copying only changed files",
+    )
+    parser.add_argument(
+        "--index-archives",
+        action="store_true",
+        help="Index the files inside zip and tar archives instead of the archives",
+    )
+    parser.add_argument(
+        "--export-index",
+        action="store_true",
+        help=f"Export files and comparisons to a SQLite index in {config.INDEX_DB_PATH}",
+    )
+    parser.add_argument(
+        "--nway",
+        action="store_true",
+        help="Compare all dirs at once and report consensus versions, outliers "
+        "and missing files per dir, instead of merging pairwise",
+    )
+    parser.add_argument(
+        "--chunk-min-size",
+        type=utils.parse_size,
+        help="Chunk differing versions of files at least this large, e.g. 64M, "
+        "and report how much of their content they share. Without numpy, "
+        "files over 64M are skipped",
+    )
+
+    parser.add_argument(
+        "--trust-metadata",
+        action="store_true",
+        help="Assume files with the same size and mtime have the same content "
+        "without reading them, marked [assumed] in the reports",
+    )
+    parser.add_argument(
+        "--spot-check-rate",
+        default=config.SPOT_CHECK_RATE,
+        type=float,
+        help="With --trust-metadata, hash this fraction of assumed matches, e.g. "
+        "0.01, to estimate the error rate",
+    )
+    parser.add_argument(
+        "--hash-fallback",
+        action="store_true",
+        help="With --trust-metadata, hash files of the same size with different "
+        "mtimes instead of assuming they differ",
+    )
+
+    parser.add_argument(
+        "--view",
+        choices=[mode.value for mode in ViewMode],
+        help="Build the merge as hardlinks or symlinks to the sources, or only "
+        "its manifest, instead of copying",
+    )
+    parser.add_argument(
+        "--compare-workers",
+        type=int,
+        help="Processes to compare files on once there are at least "
+        f"{config.COMPARE_PARALLEL_MIN_FILES} files, defaults to 1",
+    )
+    parser.add_argument(
+        "--prefilter-root",
+        type=Path,
+        help="Large root to check the dirs against using Bloom filters of it, "
+        "saved in {}, and report the files with no copy in it".format(
+            config.BLOOM_DIR_PATH
+        ),
+    )
+    parser.add_argument(
+        "--rebuild-prefilter",
+        action="store_true",
+        help="Rebuild the saved Bloom filters of --prefilter-root",
+    )
+    parser.add_argument(
+        "--serve",
+        action="store_true",
+        help="Index the dirs once and serve lookups on a Unix socket instead of "
+        "merging, see the client command",
+    )
+    parser.add_argument(
+        "--socket",
+        default=config.DAEMON_SOCKET_PATH,
+        type=Path,
+        help="Unix socket to serve on with --serve",
+    )
+
+    reads = parser.add_argument_group("reads")
+    reads.add_argument(
+        "--read-buffer-size",
+        default=config.READ_BUFFER_SIZE,
+        type=utils.parse_size,
+        help="Bytes per read when hashing and copying, e.g. 4M",
+    )
+    reads.add_argument(
+        "--no-fadvise",
+        action="store_true",
+        help="Don't advise sequential reads or drop read files from the page cache",
+    )
+    reads.add_argument(
+        "--direct-io-min-size",
+        default=config.DIRECT_IO_MIN_SIZE,
+        type=utils.parse_size,
+        help="Read files at least this large with O_DIRECT, e.g. 1G",
+    )
+
+    throttling = parser.add_argument_group("throttling")
+    throttling.add_argument(
+        "--max-bytes-per-sec",
+        type=utils.parse_size,
+        help="Average bytes read per second when hashing and copying, e.g. 50M",
+    )
+    throttling.add_argument(
+        "--max-iops", type=int, help="Average reads per second when hashing and copying"
+    )
+    throttling.add_argument(
+        "--cpu-workers", type=int, help="Number of CPUs the run may use"
+    )
+    throttling.add_argument(
+        "--control-file",
+        type=Path,
+        help='JSON file of limits, e.g. {"bytes_per_sec": 10000000, "iops": 200, '
+        '"cpu_workers": 2}, re-read when it changes or on SIGUSR1',
+    )
+
+    filters = parser.add_argument_group("filters")
+    filters.add_argument(
+        "--exclude",
+        action="append",
+        default=[],
+        help="Glob of files or dirs to skip, trailing '/' for dirs only (repeatable)",
+    )
+    filters.add_argument(
+        "--include",
+        action="append",
+        default=[],
+        help="Only index files matching one of these globs (repeatable)",
+    )
+    filters.add_argument(
+        "--ignore-file",
+        action="append",
+        default=[],
+        type=Path,
+        help=".gitignore-style file of exclude patterns (repeatable)",
+    )
+    filters.add_argument(
+        "--ext",
+        action="append",
+        default=[],
+        help="Only index files with this extension (repeatable)",
+    )
+    filters.add_argument(
+        "--exclude-ext",
+        action="append",
+        default=[],
+        help="Skip files with this extension (repeatable)",
+    )
+    filters.add_argument(
+        "--min-size",
+        type=utils.parse_size,
+        help="Skip files smaller than this, e.g. 1K",
+    )
+    filters.add_argument(
+        "--max-size", type=utils.parse_size, help="Skip files larger than this, e.g. 4G"
+    )
+    filters.add_argument(
+        "--filter-config", type=Path, help="JSON file of filter options"
+    )
 
     return parser.parse_args()
 
 
+def parse_query_args(argv):
+    """
+    Parse the arguments of the query command.
+
+    Returns:
+        argparse.Namespace: An object containing the parsed query arguments.
+            - db (Path): Exported index to query, defaults to the most recent.
+            - path, name, hash, copies (str): The lookup to make, one of these or type.
+            - type (str): CompType to list the groups of.
+            - top_dirs (int): With type, list the N dirs with the most files instead.
+    """
+    parser = argparse.ArgumentParser(
+        prog="DirMerge query", description="Look up files in an exported index"
+    )
+    parser.add_argument("--db", type=Path, help="Exported index, defaults to newest")
+    lookup = parser.add_mutually_exclusive_group(required=True)
+    lookup.add_argument("--path", help="Files at this relative or absolute path")
+    lookup.add_argument("--name", help="Files with this name")
+    lookup.add_argument(
+        "--hash",
+        help="Files with this quick or full hash, and unhashed files of their size",
+    )
+    lookup.add_argument("--copies", help="Files with the same content as this path")
+    lookup.add_argument(
+        "--type", choices=[comp_type.name for comp_type in CompType], help="CompType"
+    )
+    parser.add_argument(
+        "--top-dirs", type=int, help="With --type, the N dirs with the most files"
+    )
+
+    args = parser.parse_args(argv)
+    if args.top_dirs is not None and args.type is None:
+        parser.error("--top-dirs requires --type")
+    return args
+
+
+def parse_client_args(argv):
+    """
+    Parse the arguments of the client command.
+
+    Returns:
+        argparse.Namespace: An object containing the parsed client arguments.
+            - command (str): Request to send to the daemon.
+            - path (str): Path to look up, check or rescan.
+            - output_dir (Path): Where the report command writes its reports,
+              inside the daemon's output dir.
+            - socket (Path): Unix socket the daemon is serving on.
+    """
+    parser = argparse.ArgumentParser(
+        prog="DirMerge client", description="Send a request to a running daemon"
+    )
+    parser.add_argument(
+        "command",
+        choices=COMMANDS,
+        help="status, lookup PATH's groups, whether the index contains PATH's "
+        "content, rescan (under PATH), write reports, or shutdown",
+    )
+    parser.add_argument("--path", help="Path for lookup, contains and rescan")
+    parser.add_argument(
+        "--output-dir",
+        type=Path,
+        help=f"Output dir for report, inside the daemon's {config.OUTPUT_DIR_PATH}",
+    )
+    parser.add_argument(
+        "--socket",
+        default=config.DAEMON_SOCKET_PATH,
+        type=Path,
+        help="Unix socket the daemon is serving on",
+    )
+
+    return parser.parse_args(argv)
+
+
 if __name__ == "__main__":
     main()
@@ -1,39 +1,223 @@
 import sys
+import json
+from dataclasses import dataclass
 from typing import List
 from pathlib import Path
 
 import config
 import utils
 import cli
+import index_db
+import daemon
+import bloom
+from comparison import CompType
 from dir_index import DirIndex
+from walk_filter import WalkFilter
 from comparison_manager import ComparisonManager
 from merge_builder import MergeBuilder
+from union_builder import UnionBuilder, ViewMode
+from presence_matrix import PresenceMatrix
+from chunking import ChunkStore, ChunkReport
 
 
-def index_from_prompt():
+@dataclass
+class RunOptions:
+    """How one run indexes, compares and merges its dirs"""
+
+    walk_filter: WalkFilter = None
+    index_archives: bool = False
+    # Merge output
+    preserve_hardlinks: bool = False
+    verify: bool = False
+    update_merge: Path = None
+    view: str = None
+    # Reports instead of, or alongside, a merge
+    export_index: bool = False
+    nway: bool = False
+    chunk_min_size: int = None
+    prefilter_root: Path = None
+    rebuild_prefilter: bool = False
+    # Comparison
+    trust_metadata: bool = False
+    spot_check_rate: float = 0.0
+    hash_fallback: bool = False
+    compare_workers: int = None
+
+
+def index_from_prompt(options: RunOptions = None):
     input_dirs = cli.prompt_input_dirs()
-    index_from_paths(input_dirs)
+    index_from_paths(input_dirs, options)
 
 
-def index_from_paths(dir_paths: List[Path]):
-    check_dirs_exist(dir_paths)
+def index_from_paths(dir_paths: List[Path], options: RunOptions = None):
+    options = options or RunOptions()
+    check_dirs_exist(
+        dir_paths + ([options.prefilter_root] if options.prefilter_root else [])
+    )
     print("All target dirs exist, beginning indexing...\n")
 
-    index = DirIndex()
+    index = DirIndex(
+        walk_filter=options.walk_filter, index_archives=options.index_archives
+    )
     for path in dir_paths:
         index.index_dir(path, normalize_line_endings=True)
+    if options.prefilter_root:
+        root_filter = bloom.RootFilter.load_or_build(
+            options.prefilter_root,
+            options.walk_filter,
+            rebuild=options.rebuild_prefilter,
+        )
+        bloom.prefilter_index(index, root_filter)
+    print(index.get_excluded_msg())
     index.print_trait_indexes_to_file(config.OUTPUT_DIR_PATH)
 
-    comparison_manager = ComparisonManager()
-    comparison_manager.add_dir_index(index)
+    # Compare all roots at once instead of pairwise
+    if options.nway:
+        presence_matrix = PresenceMatrix(index)
+        presence_matrix.write_to_file(config.OUTPUT_DIR_PATH)
+        print(repr(presence_matrix))
+        return
+
+    comparison_manager = ComparisonManager(
+        options.trust_metadata, options.spot_check_rate, options.hash_fallback
+    )
+    comparison_manager.add_dir_index(index, workers=options.compare_workers or 1)
+    if options.trust_metadata:
+        print(comparison_manager.get_spot_check_msg())
     comparison_manager.write_to_file(config.OUTPUT_DIR_PATH)
+    if options.chunk_min_size is not None:
+        chunk_store = ChunkStore()
+        ChunkReport(
+            comparison_manager, chunk_store, options.chunk_min_size
+        ).write_to_file(config.OUTPUT_DIR_PATH)
+        chunk_store.close()
+
+    # Only the possible matches in the prefiltered root are indexed, so only
+    # report what is new instead of merging
+    if options.prefilter_root:
+        new_files = bloom.get_new_files(
+            index, comparison_manager, options.prefilter_root
+        )
+        bloom.write_new_files(new_files, options.prefilter_root, config.OUTPUT_DIR_PATH)
+        print(f"{len(new_files)} files have no copy in {options.prefilter_root}")
+        if options.export_index:
+            index_db.export_index(config.INDEX_DB_PATH, index, comparison_manager)
+        return
+
+    # Exported after resolving, so the groups are the ones that are merged
     comparison_manager.resolve_all()
+    if options.export_index:
+        index_db.export_index(config.INDEX_DB_PATH, index, comparison_manager)
 
     merge_builder = MergeBuilder(comparison_manager)
     merge_builder.write_to_file(config.OUTPUT_DIR_PATH)
-    merge_builder.write_merge_to_disk(
-        config.OUTPUT_DIR_PATH / "COMPLETE_MERGES" / "MERGE"
+    if options.view:
+        UnionBuilder(merge_builder, ViewMode(options.view)).build_view(
+            config.OUTPUT_DIR_PATH / "MERGE_VIEWS" / "VIEW"
+        )
+    elif options.update_merge:
+        merge_builder.update_merge_on_disk(
+            options.update_merge,
+            preserve_hardlinks=options.preserve_hardlinks,
+            verify=options.verify,
+        )
+    else:
+        merge_builder.write_merge_to_disk(
+            config.OUTPUT_DIR_PATH / "COMPLETE_MERGES" / "MERGE",
+            preserve_hardlinks=options.preserve_hardlinks,
+            verify=options.verify,
+        )
+
+
+def query_index(
+    db_path: Path = None,
+    path: str = None,
+    name: str = None,
+    file_hash: str = None,
+    copies: str = None,
+    comp_type: str = None,
+    top_dirs: int = None,
+):
+    """Prints the answer to one lookup against an exported index"""
+    if top_dirs and not comp_type:
+        raise ValueError("top_dirs needs a comp_type to count the groups of")
+    db = index_db.IndexDB(
+        db_path or index_db.get_most_recent_export(config.INDEX_DB_PATH)
+    )
+    if path:
+        rows = db.find_by_path(path)
+    elif name:
+        rows = db.find_by_name(name)
+    elif file_hash:
+        rows = db.find_by_hash(file_hash)
+        # Files never fully hashed are not matched, but those the size of a
+        # match may still be copies of it
+        result_ids = {row[0] for row in rows}
+        unhashed = [
+            row
+            for row in db.find_unhashed({row[3] for row in rows})
+            if row[0] not in result_ids
+        ]
+        unhashed_count = db.count_unhashed()
+    elif copies:
+        rows = db.find_copies(copies)
+    elif comp_type and top_dirs:
+        rows = db.top_dirs(CompType[comp_type], top_dirs)
+    else:
+        rows = db.find_by_comp_type(CompType[comp_type])
+    db.close()
+
+    for row in rows:
+        print("\t".join(str(value) for value in row))
+    print(f"{len(rows)} results from {db.db_path}")
+    if file_hash:
+        for row in unhashed:
+            print("\t".join(str(value) for value in row))
+        print(
+            f"{len(unhashed)} unhashed files the size of a result may also match, "
+            f"of {unhashed_count} files never hashed"
+        )
+
+
+def serve_index(
+    dir_paths: List[Path],
+    walk_filter: WalkFilter = None,
+    socket_path: Path = None,
+    index_archives=False,
+    trust_metadata=False,
+    spot_check_rate=0.0,
+    hash_fallback=False,
+):
+    """Indexes the dirs once, then serves lookups on a Unix socket until shut down"""
+    check_dirs_exist(dir_paths)
+    print("All target dirs exist, beginning indexing...\n")
+    index_daemon = daemon.IndexDaemon(
+        dir_paths,
+        walk_filter,
+        index_archives=index_archives,
+        trust_metadata=trust_metadata,
+        spot_check_rate=spot_check_rate,
+        hash_fallback=hash_fallback,
     )
+    index_daemon.serve(socket_path or config.DAEMON_SOCKET_PATH)
+
+
+def request_daemon(
+    command: str,
+    socket_path: Path = None,
+    path: str = None,
+    output_dir: Path = None,
+):
+    """Prints the response of a running daemon to one request"""
+    request = {"command": command}
+    if path:
+        request["path"] = path
+    if output_dir:
+        request["output_dir"] = str(Path(output_dir).resolve())
+    response = daemon.send_request(socket_path or config.DAEMON_SOCKET_PATH, request)
+    print(json.dumps(response, indent=2))
+    if not response["ok"]:
+        sys.exit(1)
 
 
 # Ensure that the output directories exist
@@ -1,20 +1,94 @@
+import os
+import shutil
 import hashlib
 from pathlib import Path
+from typing import Iterator, List
 
+import reader
+from governor import get_governor
 from utils import make_link
 from urllib.parse import quote
 from comparison import Comparison, CompType
 
+FULL_HASH_ALGORITHM = "sha256"
+# Bytes from the start of a file hashed into its quick hash
+QUICK_HASH_SIZE = 4096
+
 
 class File:
-    def __init__(self, base_path: Path, abs_path: Path):
+    def __init__(
+        self,
+        base_path: Path,
+        abs_path: Path,
+        file_id: int = None,
+        stat_result: os.stat_result = None,
+    ):
+        stat_result = stat_result or abs_path.stat()
+        # (st_dev, st_ino) when the file has several hardlinks, otherwise None.
+        # Files sharing an inode share one `hardlinks` list, set by DirIndex
+        inode = None
+        if stat_result.st_nlink > 1 and stat_result.st_ino:
+            inode = (stat_result.st_dev, stat_result.st_ino)
+        self._init_traits(
+            base_path,
+            abs_path,
+            file_id,
+            stat_result.st_size,
+            stat_result.st_mtime_ns,
+            inode,
+        )
+
+    def _init_traits(
+        self,
+        base_path: Path,
+        abs_path: Path,
+        file_id: int,
+        size: int,
+        mtime_ns: int,
+        inode: tuple,
+    ):
+        """Sets the traits every kind of file has, whether or not it can be stat'ed"""
+        self.file_id = file_id
         self.name = abs_path.name
+        self.base_path = base_path
         self.rel_path = abs_path.relative_to(base_path)
         self.dir_path = abs_path.parent
         self.abs_path = abs_path
-        self.size = abs_path.stat().st_size
+        self.size = size
+        self.mtime_ns = mtime_ns
         self.quick_hash = None
         self.full_hash = None
+        self.inode = inode
+        self.hardlinks: List["File"] = [self]
+
+    def to_tuple(self) -> tuple:
+        """
+        The traits needed to compare this file in another process, which pickle
+        smaller than the File, as its hardlinks are left out
+        """
+        return (
+            self.file_id,
+            str(self.base_path),
+            str(self.abs_path),
+            self.size,
+            self.mtime_ns,
+            self.inode,
+            self.quick_hash,
+            self.full_hash,
+        )
+
+    @classmethod
+    def from_tuple(cls, file_tuple: tuple) -> "File":
+        file_id, base_path, abs_path, size, mtime_ns, inode, quick_hash, full_hash = (
+            file_tuple[:8]
+        )
+        file = cls.__new__(cls)
+        file._init_traits(
+            Path(base_path), Path(abs_path), file_id, size, mtime_ns, inode
+        )
+        file.quick_hash = quick_hash
+        file.full_hash = full_hash
+        return file
 
     def __repr__(self):
         return (
@@ -49,14 +123,16 @@ class File:
         else:
             raise ValueError("Path must be absolute to create a file link.")
 
-    def compare_to(self, other: "File") -> Comparison:
+    def compare_to(
+        self, other: "File", trust_metadata=False, hash_fallback=False
+    ) -> Comparison:
         if self is other:
             raise ValueError(f"Attempted to compare file {repr(self)} to itself")
 
         # Compare traits
         same_name = self.name == other.name
         same_path = self.rel_path.parent == other.rel_path.parent
-        same_content = self.compare_content(other)
+        same_content = self.compare_content(other, trust_metadata, hash_fallback)
 
         # Assign comparison type
         for comp_type in CompType:
@@ -71,37 +147,78 @@ class File:
             f"No valid CompType found for comparison between {repr(self)} and {repr(other)}"
         )
 
-    def compare_content(self, other: "File"):
+    def is_hardlink_of(self, other: "File") -> bool:
+        return self.inode is not None and self.inode == other.inode
+
+    def compare_content(self, other: "File", trust_metadata=False, hash_fallback=False):
         # Quick size check
         if self.size != other.size:
             return False
 
+        # Assume files with the same size and mtime are copies, without reading them.
+        # Files with different mtimes are assumed to differ, unless hash_fallback
+        # asks to hash them, as copies that did not keep their mtime would be
+        if trust_metadata and (self.mtime_ns == other.mtime_ns or not hash_fallback):
+            return self.mtime_ns == other.mtime_ns
+
+        # Hardlinks share their data, only the quick hash is needed for indexing
+        if self.is_hardlink_of(other):
+            other.quick_hash = self.get_quick_hash()
+            return True
+
         # Quick hash comparison (about 4KB)
-        if not self.quick_hash:
-            self.quick_hash = self.__create_quick_hash()
-        if not other.quick_hash:
-            other.quick_hash = other.__create_quick_hash()
-        if self.quick_hash != other.quick_hash:
+        if self.get_quick_hash() != other.get_quick_hash():
             return False
 
         # Full hash comparison
+        return self.get_full_hash() == other.get_full_hash()
+
+    # Hashes are computed once per inode and shared with every hardlink
+    def get_quick_hash(self) -> str:
+        if not self.quick_hash:
+            quick_hash = self._create_quick_hash()
+            for file in self.hardlinks:
+                file.quick_hash = quick_hash
+        return self.quick_hash
+
+    def get_full_hash(self) -> str:
         if not self.full_hash:
-            self.full_hash = self.__create_full_hash()
-        if not other.full_hash:
-            other.full_hash = other.__create_full_hash()
-        if self.full_hash != other.full_hash:
-            return False
+            self.set_full_hash(self._create_full_hash())
+        return self.full_hash
+
+    def set_full_hash(self, full_hash: str):
+        for file in self.hardlinks:
+            file.full_hash = full_hash
+
+    # Reading, copying and hashing go through these so other sources can override them
+    def open(self):
+        return open(self.abs_path, "rb")
+
+    def read_chunks(self) -> Iterator[memoryview]:
+        return reader.iter_path(self.abs_path, self.size)
+
+    def read_head(self, length: int) -> bytes:
+        return reader.read_head(self.abs_path, length, self.size)
+
+    def copy_to(self, output_path: Path):
+        if get_governor().is_limited:
+            # Stream the copy through the reader so it is throttled
+            with open(output_path, "wb") as dst:
+                for chunk in self.read_chunks():
+                    dst.write(chunk)
+            self.copy_stat_to(output_path)
+        else:
+            shutil.copy2(self.abs_path, output_path)
+            reader.drop_cache(self.abs_path)
 
-        return self.full_hash == other.full_hash
+    def copy_stat_to(self, output_path: Path):
+        shutil.copystat(self.abs_path, output_path)
 
-    def __create_quick_hash(self, chunk_size=4096):
-        with open(self.abs_path, "rb") as file:
-            fingerprint = file.read(chunk_size)
-        return hashlib.md5(fingerprint).hexdigest()
+    def _create_quick_hash(self, chunk_size=QUICK_HASH_SIZE):
+        return hashlib.md5(self.read_head(chunk_size)).hexdigest()
 
-    def __create_full_hash(self, algorithm="sha256", chunk_size=8192):
+    def _create_full_hash(self, algorithm=FULL_HASH_ALGORITHM):
         hasher = hashlib.new(algorithm)
-        with open(self.abs_path, "rb") as file:
-            while chunk := file.read(chunk_size):
-                hasher.update(chunk)
+        for chunk in self.read_chunks():
+            hasher.update(chunk)
         return hasher.hexdigest()
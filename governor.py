@@ -0,0 +1,210 @@
+import os
+import json
+import time
+import signal
+import logging
+import threading
+
+from pathlib import Path
+from typing import List
+
+import config
+
+HAS_AFFINITY = hasattr(os, "sched_setaffinity")
+
+
+class TokenBucket:
+    """
+    Allows `rate` units per second on average, with bursts of up to `capacity`.
+    A request larger than the remaining tokens runs the bucket into debt and
+    sleeps until the debt is repaid, so large reads are never blocked forever.
+    """
+
+    def __init__(self, rate: float, capacity: float = None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def consume(self, amount: float):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(
+                self.capacity, self.tokens + (now - self.updated) * self.rate
+            )
+            self.updated = now
+            self.tokens -= amount
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+        if wait:
+            time.sleep(wait)
+
+    def set_rate(self, rate: float, capacity: float = None):
+        """Changes the rate, keeping the tokens earned so far at the old rate"""
+        with self.lock:
+            now = time.monotonic()
+            self.tokens += (now - self.updated) * self.rate
+            self.updated = now
+            self.rate = rate
+            self.capacity = capacity or rate
+            self.tokens = min(self.capacity, self.tokens)
+
+
+class Governor:
+    """
+    Limits the disk and CPU used by hashing and copying, so a run can share a
+    host with other work.
+
+    Args:
+        bytes_per_sec (int, optional): Average read budget in bytes per second.
+        iops (int, optional): Average reads per second.
+        cpu_workers (int, optional): CPUs this process may use. Affinity is per
+            process, so each worker process must make its own Governor with
+            the same cpu_workers and all_cpus to be pinned too.
+        control_file (Path, optional): JSON file with any of the limits above,
+            re-read when it changes or when the process receives SIGUSR1.
+        all_cpus (list of int, optional): CPUs to take cpu_workers from,
+            defaults to the CPUs this process may use when it starts.
+        share (int, optional): Processes the read budgets are split between,
+            each getting an equal share, including the limits of the control file.
+    """
+
+    def __init__(
+        self,
+        bytes_per_sec: int = None,
+        iops: int = None,
+        cpu_workers: int = None,
+        control_file: Path = None,
+        all_cpus: List[int] = None,
+        share: int = 1,
+    ):
+        self.control_file = Path(control_file) if control_file else None
+        self._control_mtime_ns = None
+        self._next_control_check = 0.0
+        self._reload_requested = False
+        self.share = share
+        self.all_cpus = all_cpus
+        if HAS_AFFINITY and all_cpus is None:
+            self.all_cpus = sorted(os.sched_getaffinity(0))
+
+        self.byte_bucket: TokenBucket = None
+        self.io_bucket: TokenBucket = None
+        self.cpu_workers: int = None
+        self.configure(bytes_per_sec, iops, cpu_workers)
+        self._check_control_file()
+
+    def __repr__(self):
+        return (
+            f"Governor(bytes_per_sec={self.bytes_per_sec}, iops={self.iops}, "
+            f"cpu_workers={self.cpu_workers}, share={self.share})"
+        )
+
+    @property
+    def bytes_per_sec(self):
+        """The whole read budget, of which this process has its share"""
+        return self.byte_bucket.rate * self.share if self.byte_bucket else None
+
+    @property
+    def iops(self):
+        return self.io_bucket.rate * self.share if self.io_bucket else None
+
+    @property
+    def is_limited(self) -> bool:
+        return self.byte_bucket is not None or self.io_bucket is not None
+
+    @property
+    def max_workers(self) -> int:
+        return self.cpu_workers or os.cpu_count() or 1
+
+    def configure(self, bytes_per_sec: int = None, iops: int = None, cpu_workers=None):
+        # Buckets are updated in place, so a reload keeps their burst credit and debt
+        self.byte_bucket = self._get_bucket(self.byte_bucket, bytes_per_sec)
+        self.io_bucket = self._get_bucket(self.io_bucket, iops)
+        if HAS_AFFINITY and (cpu_workers or self.cpu_workers):
+            set_process_affinity(self.all_cpus[:cpu_workers])
+        self.cpu_workers = cpu_workers or None
+        logging.info(f"Using {repr(self)}")
+
+    def _get_bucket(self, bucket: TokenBucket, limit: int) -> TokenBucket:
+        if not limit:
+            return None
+        if bucket is None:
+            return TokenBucket(limit / self.share)
+        bucket.set_rate(limit / self.share)
+        return bucket
+
+    def throttle(self, nbytes: int):
+        """Accounts for one read of nbytes, sleeping if it is over budget"""
+        self._check_control_file()
+        if self.byte_bucket:
+            self.byte_bucket.consume(nbytes)
+        if self.io_bucket:
+            self.io_bucket.consume(1)
+
+    def request_reload(self, signum=None, frame=None):
+        self._reload_requested = True
+        self._next_control_check = 0.0
+
+    def _check_control_file(self):
+        if self.control_file is None or time.monotonic() < self._next_control_check:
+            return
+        self._next_control_check = (
+            time.monotonic() + config.GOVERNOR_CONTROL_CHECK_INTERVAL
+        )
+        try:
+            mtime_ns = self.control_file.stat().st_mtime_ns
+            if mtime_ns == self._control_mtime_ns and not self._reload_requested:
+                return
+            self._control_mtime_ns = mtime_ns
+            self._reload_requested = False
+            limits = json.loads(self.control_file.read_text())
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            logging.warning(
+                f"Ignoring unreadable control file {self.control_file}: {e}"
+            )
+            return
+
+        logging.info(f"Reloading limits from {self.control_file}")
+        self.configure(
+            bytes_per_sec=limits.get("bytes_per_sec"),
+            iops=limits.get("iops"),
+            cpu_workers=limits.get("cpu_workers"),
+        )
+
+
+def set_process_affinity(cpus: List[int]):
+    """
+    Pins every thread of this process to cpus. sched_setaffinity only pins the
+    thread that calls it, and new threads copy it from the thread that starts
+    them, so threads already running are pinned one by one from /proc.
+    """
+    try:
+        thread_ids = [int(thread_id) for thread_id in os.listdir("/proc/self/task")]
+    except OSError as e:
+        # Without /proc, only the calling thread and threads it starts are pinned
+        logging.debug(
+            f"Pinning only the calling thread, as threads can't be listed: {e}"
+        )
+        thread_ids = [0]
+    for thread_id in thread_ids:
+        try:
+            os.sched_setaffinity(thread_id, cpus)
+        except ProcessLookupError:
+            # The thread exited since it was listed
+            continue
+
+
+_governor = Governor()
+
+
+def set_governor(governor: Governor):
+    global _governor
+    _governor = governor
+    if governor.control_file and hasattr(signal, "SIGUSR1"):
+        signal.signal(signal.SIGUSR1, governor.request_reload)
+
+
+def get_governor() -> Governor:
+    return _governor
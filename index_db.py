@@ -0,0 +1,229 @@
+import sqlite3
+import logging
+
+from pathlib import Path
+from typing import Iterable, List
+
+import utils
+from dir_index import DirIndex
+from comparison import Comparison, CompType
+from comparison_manager import ComparisonManager
+
+SCHEMA = """
+CREATE TABLE files (
+    file_id INTEGER PRIMARY KEY,
+    name TEXT,
+    rel_path TEXT,
+    rel_dir TEXT,
+    base_path TEXT,
+    abs_path TEXT,
+    size INTEGER,
+    mtime_ns INTEGER,
+    quick_hash TEXT,
+    full_hash TEXT
+);
+CREATE TABLE comparisons (
+    file_a INTEGER,
+    file_b INTEGER,
+    comp_type TEXT
+);
+CREATE TABLE groups (
+    comp_type TEXT,
+    group_key TEXT,
+    file_id INTEGER
+);
+"""
+
+INDEXES = """
+CREATE INDEX files_name ON files (name);
+CREATE INDEX files_rel_path ON files (rel_path);
+CREATE INDEX files_abs_path ON files (abs_path);
+CREATE INDEX files_quick_hash ON files (quick_hash);
+CREATE INDEX files_full_hash ON files (full_hash);
+CREATE INDEX comparisons_file_a ON comparisons (file_a);
+CREATE INDEX comparisons_file_b ON comparisons (file_b);
+CREATE INDEX comparisons_comp_type ON comparisons (comp_type);
+CREATE INDEX groups_comp_type ON groups (comp_type, group_key);
+CREATE INDEX groups_file_id ON groups (file_id);
+"""
+
+FILE_COLUMNS = (
+    "files.file_id, files.rel_path, files.abs_path, files.size, files.full_hash"
+)
+
+
+def export_index(
+    output_dir: Path, dir_index: DirIndex, comparison_manager: ComparisonManager
+) -> Path:
+    """
+    Writes the files, comparisons and comparison groups of a run to a new
+    timestamped SQLite database in output_dir, with indexes for lookups.
+    """
+    utils.ensure_path_exists(output_dir)
+    timestamp = utils.get_timestamp()
+    db_path = output_dir / f"INDEX-{timestamp}.sqlite"
+    # Exports made in the same second get a numbered suffix
+    suffix = 1
+    while db_path.exists():
+        db_path = output_dir / f"INDEX-{timestamp}-{suffix}.sqlite"
+        suffix += 1
+    print(f"Making new output at: {db_path}")
+
+    connection = sqlite3.connect(db_path)
+    with connection:
+        connection.executescript(SCHEMA)
+        connection.executemany(
+            "INSERT INTO files VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (
+                (
+                    file.file_id,
+                    file.name,
+                    file.rel_path.as_posix(),
+                    file.rel_path.parent.as_posix(),
+                    str(file.base_path),
+                    str(file.abs_path),
+                    file.size,
+                    file.mtime_ns,
+                    file.quick_hash,
+                    file.full_hash,
+                )
+                for file in dir_index.file_list
+            ),
+        )
+        connection.executemany(
+            "INSERT INTO comparisons VALUES (?, ?, ?)",
+            (
+                (file_a_id, file_b_id, comp_type.name)
+                for file_a_id, file_b_id, comp_type in map(
+                    Comparison.unpack_record, comparison_manager.comparison_cache
+                )
+            ),
+        )
+        connection.executemany(
+            "INSERT INTO groups VALUES (?, ?, ?)",
+            (
+                (comp_type.name, str(key), file.file_id)
+                for comp_type, comparison_index in comparison_manager.comparisons.items()
+                for key, file_list in comparison_index.index.items()
+                for file in file_list
+            ),
+        )
+        connection.executescript(INDEXES)
+    connection.close()
+
+    logging.info(f"Exported {len(dir_index.file_list)} files to {db_path}")
+    return db_path
+
+
+def get_most_recent_export(output_dir: Path) -> Path:
+    exports = list(output_dir.glob("INDEX-*.sqlite"))
+    if not exports:
+        raise FileNotFoundError(f"No exported index found in {output_dir}")
+    # Suffixed names don't sort after the export they follow, so go by mtime
+    return max(exports, key=lambda path: path.stat().st_mtime_ns)
+
+
+class IndexDB:
+    """
+    Read-only lookups against an index exported by export_index. The database
+    is opened on the first query and read through a memory map.
+    """
+
+    def __init__(self, db_path: Path):
+        self.db_path = Path(db_path)
+        self._connection = None
+
+    def __repr__(self):
+        return f"IndexDB(db_path={str(self.db_path)!r})"
+
+    @property
+    def connection(self) -> sqlite3.Connection:
+        if self._connection is None:
+            utils.ensure_path_exists(self.db_path, create_if_missing=False)
+            self._connection = sqlite3.connect(
+                f"{self.db_path.resolve().as_uri()}?mode=ro", uri=True
+            )
+            self._connection.execute("PRAGMA mmap_size = 1073741824")
+        return self._connection
+
+    def close(self):
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+    def find_by_path(self, path: str) -> List[tuple]:
+        """Files whose relative or absolute path is `path`"""
+        return self.connection.execute(
+            f"SELECT {FILE_COLUMNS} FROM files WHERE rel_path = ? OR abs_path = ?",
+            (path, path),
+        ).fetchall()
+
+    def find_by_name(self, name: str) -> List[tuple]:
+        return self.connection.execute(
+            f"SELECT {FILE_COLUMNS} FROM files WHERE name = ?", (name,)
+        ).fetchall()
+
+    def find_by_hash(self, file_hash: str) -> List[tuple]:
+        """Files whose quick or full hash is `file_hash`"""
+        return self.connection.execute(
+            f"SELECT {FILE_COLUMNS} FROM files WHERE full_hash = ? "
+            f"UNION SELECT {FILE_COLUMNS} FROM files WHERE quick_hash = ?",
+            (file_hash, file_hash),
+        ).fetchall()
+
+    def find_unhashed(self, sizes: Iterable[int]) -> List[tuple]:
+        """
+        Files of the given sizes that were never fully hashed, so find_by_hash
+        can not match them
+        """
+        sizes = list(sizes)
+        return self.connection.execute(
+            f"SELECT {FILE_COLUMNS} FROM files WHERE full_hash IS NULL "
+            f"AND size IN ({', '.join('?' * len(sizes))})",
+            sizes,
+        ).fetchall()
+
+    def count_unhashed(self) -> int:
+        return self.connection.execute(
+            "SELECT COUNT(*) FROM files WHERE full_hash IS NULL"
+        ).fetchone()[0]
+
+    def find_copies(self, path: str) -> List[tuple]:
+        """Files with the same content as the file at `path`"""
+        partner_query = (
+            "SELECT {partner} FROM comparisons "
+            "JOIN files AS target ON target.file_id = {target} "
+            "WHERE (target.rel_path = ? OR target.abs_path = ?) "
+            f"AND comp_type IN ({_content_comp_types()})"
+        )
+        return self.connection.execute(
+            f"SELECT {FILE_COLUMNS} FROM files WHERE file_id IN ("
+            f"{partner_query.format(partner='file_b', target='file_a')} UNION "
+            f"{partner_query.format(partner='file_a', target='file_b')})",
+            (path, path, path, path),
+        ).fetchall()
+
+    def find_by_comp_type(self, comp_type: CompType) -> List[tuple]:
+        """Files in the groups of a CompType, ordered by group"""
+        return self.connection.execute(
+            f"SELECT group_key, {FILE_COLUMNS} FROM groups "
+            "JOIN files ON files.file_id = groups.file_id "
+            "WHERE comp_type = ? ORDER BY groups.rowid",
+            (comp_type.name,),
+        ).fetchall()
+
+    def top_dirs(self, comp_type: CompType, limit=10) -> List[tuple]:
+        """Directories with the most files in the groups of a CompType"""
+        return self.connection.execute(
+            "SELECT base_path, rel_dir, COUNT(*) AS file_count FROM groups "
+            "JOIN files ON files.file_id = groups.file_id "
+            "WHERE comp_type = ? GROUP BY base_path, rel_dir "
+            "ORDER BY file_count DESC LIMIT ?",
+            (comp_type.name, limit),
+        ).fetchall()
+
+
+def _content_comp_types() -> str:
+    return ", ".join(
+        f"'{comp_type.name}'" for comp_type in CompType if comp_type.value["content"]
+    )
@@ -1,16 +1,108 @@
+import copy
+import json
+import atexit
 import logging
+import logging.handlers
+import queue
 
 from pathlib import Path
 
 import utils
 import config
 
+# Attributes present on every LogRecord, anything else was passed with `extra`
+_RECORD_ATTRS = set(vars(logging.makeLogRecord({}))) | {"message", "asctime"}
 
-def setup_logging():
+
+class LazyQueueHandler(logging.handlers.QueueHandler):
+    """
+    Queues records without formatting them, so the formatter only runs on the
+    background listener thread rather than inside the caller's loop.
+    """
+
+    def prepare(self, record):
+        # Only `msg % args` is done now, as mutable args could change before
+        # the listener formats the record
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+
+class SampleFilter(logging.Filter):
+    """Passes 1 of every `rate` DEBUG records, and every record above DEBUG"""
+
+    def __init__(self, rate: int):
+        super().__init__()
+        self.rate = max(1, rate)
+        self.count = 0
+
+    def filter(self, record):
+        if record.levelno > logging.DEBUG or self.rate == 1:
+            return True
+        self.count += 1
+        return self.count % self.rate == 1
+
+
+class JsonFormatter(logging.Formatter):
+    """Formats each record as a single line JSON object"""
+
+    def format(self, record):
+        entry = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRS:
+                entry[key] = value
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+def _stop_listener(listener: logging.handlers.QueueListener):
+    # Flush remaining records, unless the listener was already stopped
+    if listener._thread is not None:
+        listener.stop()
+
+
+def setup_logging(
+    level=config.LOG_LEVEL,
+    sample_rate=config.LOG_SAMPLE_RATE,
+    json_format=False,
+):
+    """
+    Sets up logging to a timestamped file in config.LOG_PATH.
+
+    Records are handed to a queue and written by a background thread. Records
+    below `level` are discarded before any formatting is done.
+
+    Args:
+        level (int | str): Minimum level to log. Per-file detail is logged at DEBUG.
+        sample_rate (int, optional): Only keep 1 of every `sample_rate` DEBUG records.
+        json_format (bool, optional): Write one JSON object per record instead of plain text.
+
+    Returns:
+        logging.handlers.QueueListener: The running listener, stopped at exit.
+    """
     utils.ensure_path_exists(config.LOG_PATH)
-    log_path = Path(config.LOG_PATH) / Path(f"log-{utils.get_timestamp()}.txt")
+    extension = "jsonl" if json_format else "txt"
+    log_path = Path(config.LOG_PATH) / Path(f"log-{utils.get_timestamp()}.{extension}")
     file_handler = logging.FileHandler(log_path, mode="w")
-    file_handler.setFormatter(logging.Formatter("%(message)s"))
+    if json_format:
+        file_handler.setFormatter(JsonFormatter())
+    else:
+        file_handler.setFormatter(logging.Formatter("%(message)s"))
+
+    log_queue = queue.SimpleQueue()
+    queue_handler = LazyQueueHandler(log_queue)
+    queue_handler.addFilter(SampleFilter(sample_rate))
+    listener = logging.handlers.QueueListener(log_queue, file_handler)
+    listener.start()
+    atexit.register(_stop_listener, listener)
 
-    logging.basicConfig(level=logging.INFO, handlers=[file_handler])
+    logging.basicConfig(level=level, handlers=[queue_handler], force=True)
     print(f"Logging to: {log_path}")
+    return listener
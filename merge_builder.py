@@ -2,20 +2,35 @@ import logging
 import sys
 import shutil
 import os
+import glob
+import json
+import hashlib
 
 from collections import defaultdict
-from pathlib import Path
+from pathlib import Path, PurePosixPath
 from typing import List, Dict
 
+import config
+import reader
 import utils
-from file import File
+from file import File, FULL_HASH_ALGORITHM
 from comparison_manager import ComparisonManager
 from comparison_index import ComparisonIndex
+from merge_journal import MergeJournal
 
 
 class MergeBuilder:
     def __init__(self, comparison_manager: ComparisonManager):
+        # The one source chosen for each destination relative path, and the
+        # same sources grouped by their source dir for the report
+        self.plan: Dict[str:File] = {}
         self.merge: Dict[Path : List[File]] = defaultdict(list)
+        # Sources with different content for the same destination, the first
+        # of which is the one in the plan. A merge with conflicts is not written
+        self.conflicts: Dict[str : List[File]] = {}
+        self.duplicate_count = 0
+        # Entries written by a verified merge, keyed by relative path
+        self.manifest: Dict[str:dict] = {}
         self.comparison_manager = comparison_manager
         self.build_merge()
 
@@ -31,10 +46,26 @@ class MergeBuilder:
         utils.write_to_file(
             "MERGE", output_path / "MERGE", str(self), is_timestamped=True
         )
+        if self.conflicts:
+            utils.write_to_file(
+                "MERGE_CONFLICTS",
+                output_path / "MERGE_CONFLICTS",
+                self.get_conflicts_msg(),
+                is_timestamped=True,
+            )
 
-    def _setup_root(self, target_dir):
+    def get_conflicts_msg(self) -> str:
+        msg = [f"Merge conflicts: {len(self.conflicts)}\n"]
+        for rel_path, file_list in self.conflicts.items():
+            msg.append(f"{rel_path}:\n")
+            for file in file_list:
+                msg.append(f"\t{file.abs_path}\n")
+        return "".join(msg)
+
+    def _commit_root(self, staging_path: Path, target_dir) -> Path:
+        """Atomically renames a fully written staging dir to a new timestamped root"""
         root_path = Path(f"{target_dir}-{utils.get_timestamp()}")
-        logging.info(f"Setting up root at {root_path}")
+        logging.info(f"Committing {staging_path} to root at {root_path}")
 
         if root_path.exists():
             msg = f"Aborting build: root directory {root_path} already exists"
@@ -42,7 +73,8 @@ class MergeBuilder:
             logging.error(msg)
             sys.exit(1)
         try:
-            root_path.mkdir(parents=True)
+            os.rename(staging_path, root_path)
+            utils.fsync_path(root_path.parent)
             logging.info(f"Created root dir at: {root_path}")
         except Exception as e:
             msg = f"Failed to create root directory due to {e}"
@@ -53,20 +85,554 @@ class MergeBuilder:
         return root_path
 
     def build_merge(self):
+        """
+        Plans one source for each destination path. A file kept in several
+        indexes is only planned once, and a file with the same destination as
+        a planned file is skipped as a duplicate when it has the same content.
+        When it doesn't, it is a conflict, and the merge is not written.
+        """
+        trust_metadata = self.comparison_manager.trust_metadata
+        hash_fallback = self.comparison_manager.hash_fallback
+        planned_ids = set()
         for comparison_index in self.comparison_manager.comparisons.values():
             comparison_index: ComparisonIndex
             for file_list in comparison_index.index.values():
                 if type(file_list) == list:
                     for file in file_list:
                         file: File
-                        output_path = Path(file.dir_path)
-                        self.merge[output_path].append(file)
+                        if file.file_id in planned_ids:
+                            continue
+                        planned_ids.add(file.file_id)
 
-    def write_merge_to_disk(self, output_dir):
-        root_path = self._setup_root(output_dir)
-        for path, file_list in self.merge.items():
-            for file in file_list:
-                file: File
-                output_path = Path(root_path / file.rel_path)
+                        rel_path = file.rel_path.as_posix()
+                        planned_file = self.plan.get(rel_path)
+                        if planned_file is None:
+                            self.plan[rel_path] = file
+                            self.merge[Path(file.dir_path)].append(file)
+                        elif planned_file.compare_content(
+                            file, trust_metadata, hash_fallback
+                        ):
+                            self.duplicate_count += 1
+                        else:
+                            self.conflicts.setdefault(rel_path, [planned_file])
+                            self.conflicts[rel_path].append(file)
+        logging.info(
+            f"Planned {len(self.plan)} files, skipped {self.duplicate_count} "
+            f"duplicates and {len(self.conflicts)} conflicting paths"
+        )
+
+    def _abort_if_conflicts(self):
+        """
+        Stops before anything is copied when several sources with different
+        content were kept for one path, as only one of them could be written
+        """
+        if not self.conflicts:
+            return
+        msg = (
+            f"Aborting build: {len(self.conflicts)} paths have sources with "
+            f"different content. Keep one version of each and merge again"
+        )
+        print(msg)
+        logging.error(f"{msg}:\n{self.get_conflicts_msg()}")
+        sys.exit(1)
+
+    @staticmethod
+    def get_manifest_path(root_path: Path) -> Path:
+        return Path(f"{root_path}.manifest.json")
+
+    @staticmethod
+    def get_journal_path(staging_path: Path) -> Path:
+        return Path(f"{staging_path}.journal")
+
+    @staticmethod
+    def get_completion_marker_path(root_path: Path) -> Path:
+        return Path(f"{root_path}.complete")
+
+    def write_merge_to_disk(self, output_dir, preserve_hardlinks=False, verify=False):
+        """
+        Copies every file in the merge to a staging dir next to output_dir,
+        renames it to a new timestamped root once every file is on disk, and
+        writes a manifest of the copied files and a completion marker next to
+        the root. A root without a completion marker is not a finished merge.
+
+        Files are synced in batches and then recorded in a journal, so running
+        the same merge again after a crash resumes from the last journaled
+        batch instead of copying everything again. Each journaled file is kept
+        only if its source is unchanged, so a source edited in the meantime is
+        copied again. A staging dir left by a merge planned for other
+        destinations or sources is discarded, and anything in it that is not
+        in the plan is removed before it is committed.
+
+        With `verify`, each copy is read back and checked against the full_hash
+        of its source, which is recorded in the manifest.
+        """
+        self._abort_if_conflicts()
+        staging_path = Path(f"{output_dir}.staging")
+        journal = MergeJournal(self.get_journal_path(staging_path))
+        plan_fingerprint = self._get_plan_fingerprint()
+        is_resumed = staging_path.exists()
+        if is_resumed and journal.get_plan_fingerprint() != plan_fingerprint:
+            msg = f"Discarding interrupted merge of a different plan in {staging_path}"
+            print(msg)
+            logging.warning(msg)
+            shutil.rmtree(staging_path)
+            is_resumed = False
+        if is_resumed:
+            msg = f"Resuming interrupted merge in {staging_path}"
+            print(msg)
+            logging.info(msg)
+        else:
+            staging_path.mkdir(parents=True)
+            journal.start(plan_fingerprint)
+
+        files = list(self.plan.values())
+        failed = self._write_files(
+            staging_path, files, preserve_hardlinks, verify, journal
+        )
+        if failed:
+            # Leave the staging dir and journal for the next run to resume
+            self._write_manifest(staging_path)
+            self._abort_if_failed(failed)
+        if is_resumed:
+            self._remove_unplanned(staging_path)
+
+        root_path = self._commit_root(staging_path, output_dir)
+        self._write_manifest(root_path)
+        self._write_completion_marker(root_path)
+        journal.remove()
+
+    def update_merge_on_disk(
+        self, target_dir: Path, preserve_hardlinks=False, verify=False
+    ):
+        """
+        Updates a previous merge so it matches this merge, copying only files
+        that are new or changed. Unchanged files are hardlinked from the
+        previous merge into a staging dir, which then replaces target_dir.
+
+        The two dirs are swapped atomically where renameat2 is available.
+        Elsewhere the swap is two renames, and a previous merge left aside by
+        a crash between them is restored on the next update.
+        """
+        self._abort_if_conflicts()
+        target_dir = Path(target_dir)
+        self._recover_interrupted_swap(target_dir)
+        utils.ensure_path_exists(target_dir, create_if_missing=False)
+        previous_manifest = {}
+        if self.get_completion_marker_path(target_dir).exists():
+            previous_manifest = self._read_manifest(target_dir)
+        else:
+            logging.warning(
+                f"{target_dir} has no completion marker, ignoring its manifest"
+            )
+        staging_path = Path(f"{target_dir}.staging")
+        if staging_path.exists():
+            logging.warning(f"Removing stale staging dir: {staging_path}")
+            shutil.rmtree(staging_path)
+        staging_path.mkdir()
+
+        to_copy = []
+        # Unchanged files checked by size and mtime, as they have no previous hash
+        metadata_count = 0
+        for rel_path, file in self.plan.items():
+            existing_path = target_dir / rel_path
+            output_path = staging_path / rel_path
+            entry = previous_manifest.get(rel_path, {})
+            if self._is_unchanged(file, existing_path, entry):
                 os.makedirs(output_path.parent, exist_ok=True)
-                shutil.copy2(Path(file.abs_path), Path(output_path))
+                if self._link_file(existing_path, output_path):
+                    metadata_count += not entry.get(FULL_HASH_ALGORITHM)
+                    self._add_manifest_entry(
+                        file,
+                        output_path,
+                        "unchanged",
+                        full_hash=entry.get(FULL_HASH_ALGORITHM),
+                    )
+                    continue
+            to_copy.append(file)
+
+        unchanged_count = len(self.plan) - len(to_copy)
+        removed_count = sum(
+            1
+            for path in target_dir.rglob("*")
+            if path.is_file()
+            and path.relative_to(target_dir).as_posix() not in self.plan
+        )
+        failed = self._write_files(staging_path, to_copy, preserve_hardlinks, verify)
+        self._abort_if_failed(failed)
+
+        # Swap the staging dir in for the previous merge. Its manifest and
+        # marker only describe it again once they are rewritten below
+        self.get_completion_marker_path(target_dir).unlink(missing_ok=True)
+        if utils.exchange_paths(staging_path, target_dir):
+            shutil.rmtree(staging_path)
+        else:
+            old_path = Path(f"{target_dir}.old-{utils.get_timestamp()}")
+            target_dir.rename(old_path)
+            staging_path.rename(target_dir)
+            shutil.rmtree(old_path)
+        self._write_manifest(target_dir)
+        self._write_completion_marker(target_dir)
+
+        msg = (
+            f"Updated merge at {target_dir}: {len(to_copy)} copied, "
+            f"{unchanged_count} unchanged, {removed_count} removed"
+        )
+        if metadata_count:
+            msg += (
+                f" ({metadata_count} unchanged by size and mtime only, "
+                "as the previous manifest has no hash for them)"
+            )
+        print(msg)
+        logging.info(msg)
+
+    @staticmethod
+    def _recover_interrupted_swap(target_dir: Path):
+        """
+        Puts back a previous merge left at <target>.old-* when a swap was
+        interrupted before the staging dir was renamed to target_dir, or
+        removes it when the swap finished
+        """
+        old_paths = sorted(
+            target_dir.parent.glob(f"{glob.escape(target_dir.name)}.old-*")
+        )
+        if not old_paths:
+            return
+        if not target_dir.exists():
+            msg = f"Restoring {old_paths[-1]} left by an interrupted update"
+            print(msg)
+            logging.warning(msg)
+            old_paths.pop().rename(target_dir)
+        for old_path in old_paths:
+            logging.warning(f"Removing previous merge left by an update: {old_path}")
+            shutil.rmtree(old_path)
+
+    def _is_unchanged(self, file: File, existing_path: Path, entry: dict) -> bool:
+        """
+        Checks a file in a previous merge against its source, by hash when the
+        previous manifest has one, hashing the source if this run has not.
+        Otherwise only size and mtime can be checked, which is logged.
+        """
+        try:
+            existing_stat = existing_path.stat()
+        except FileNotFoundError:
+            return False
+        if existing_stat.st_size != file.size:
+            return False
+
+        previous_hash = entry.get(FULL_HASH_ALGORITHM)
+        if previous_hash:
+            return previous_hash == file.get_full_hash()
+        logging.debug(
+            "No previous hash for %s, checking it by size and mtime", file.abs_path
+        )
+        return existing_stat.st_mtime_ns == file.mtime_ns
+
+    def _get_plan_fingerprint(self) -> str:
+        """
+        A hash of the destination and source of every planned file. Sizes and
+        mtimes are left out, as _is_journaled checks them for each file.
+        """
+        hasher = hashlib.sha256()
+        for rel_path in sorted(self.plan):
+            file = self.plan[rel_path]
+            hasher.update(json.dumps([rel_path, str(file.abs_path)]).encode())
+        return hasher.hexdigest()
+
+    def _remove_unplanned(self, root_path: Path):
+        """Removes the files and dirs under root_path that the plan has no place for"""
+        planned_dirs = {
+            parent.as_posix()
+            for rel_path in self.plan
+            for parent in PurePosixPath(rel_path).parents
+        }
+        removed_count = 0
+        for dir_path, dir_names, file_names in os.walk(root_path, topdown=False):
+            rel_dir = Path(dir_path).relative_to(root_path)
+            for name in file_names:
+                if (rel_dir / name).as_posix() not in self.plan:
+                    os.unlink(os.path.join(dir_path, name))
+                    removed_count += 1
+            for name in dir_names:
+                path = os.path.join(dir_path, name)
+                rel_path = (rel_dir / name).as_posix()
+                if os.path.islink(path):
+                    if rel_path not in self.plan:
+                        os.unlink(path)
+                        removed_count += 1
+                elif rel_path not in planned_dirs:
+                    # Emptied already, as the walk is bottom up
+                    os.rmdir(path)
+        if removed_count:
+            logging.warning(
+                f"Removed {removed_count} files not in the plan from {root_path}"
+            )
+
+    def _write_files(
+        self,
+        root_path: Path,
+        files: List[File],
+        preserve_hardlinks,
+        verify,
+        journal: MergeJournal = None,
+    ) -> List[File]:
+        """
+        Writes files under root_path, returns the files that failed verification.
+
+        Files are written a dir at a time and synced in batches of about
+        MERGE_FSYNC_BATCH_SIZE files before the batch is appended to the
+        journal. Files already in the journal are kept.
+        """
+        journaled = journal.load() if journal else {}
+        # First output path written for each source inode
+        written_inodes: Dict[tuple:Path] = {}
+        failed: List[File] = []
+        written_dirs = set()
+        resumed_count = 0
+        # Written since the last sync
+        to_sync: List[Path] = []
+        dirs_to_sync = set()
+        entries: List[dict] = []
+        for dir_path, batch in self._iter_batches(root_path, files):
+            os.makedirs(dir_path, exist_ok=True)
+            written_dirs.add(dir_path)
+            for file in batch:
+                rel_path = file.rel_path.as_posix()
+                output_path = root_path / file.rel_path
+                entry = journaled.get(rel_path)
+                if entry is not None and self._is_journaled(file, output_path, entry):
+                    self._add_manifest_entry(
+                        file,
+                        output_path,
+                        entry["status"],
+                        full_hash=entry.get(FULL_HASH_ALGORITHM),
+                    )
+                    if file.inode is not None:
+                        written_inodes.setdefault(file.inode, output_path)
+                    resumed_count += 1
+                    continue
+
+                status = self._write_file(
+                    file, output_path, written_inodes, preserve_hardlinks, verify
+                )
+                if status == "failed":
+                    failed.append(file)
+                    continue
+                # A link shares the inode of a file that is already synced
+                if status != "linked":
+                    to_sync.append(output_path)
+                dirs_to_sync.add(dir_path)
+                entries.append(
+                    {
+                        "rel_path": rel_path,
+                        "source": str(file.abs_path),
+                        "size": file.size,
+                        "source_mtime_ns": file.mtime_ns,
+                        FULL_HASH_ALGORITHM: file.full_hash,
+                        "status": status,
+                    }
+                )
+
+            if len(entries) >= config.MERGE_FSYNC_BATCH_SIZE:
+                self._sync_batch(root_path, to_sync, dirs_to_sync, entries, journal)
+        self._sync_batch(root_path, to_sync, dirs_to_sync, entries, journal)
+
+        # Entries for the dirs created along the way, each synced once
+        created_dirs = {
+            parent
+            for dir_path in written_dirs
+            for parent in dir_path.parents
+            if parent.is_relative_to(root_path)
+        }
+        if not (config.MERGE_SYNC_FILESYSTEM and utils.sync_filesystem(root_path)):
+            for dir_path in created_dirs:
+                utils.fsync_path(dir_path)
+        if resumed_count:
+            logging.info(f"Kept {resumed_count} files written before the interruption")
+        return failed
+
+    @staticmethod
+    def _sync_batch(
+        root_path: Path,
+        paths: List[Path],
+        dir_paths: set,
+        entries: List[dict],
+        journal: MergeJournal = None,
+    ):
+        """
+        Makes the written files durable, then journals them and clears the
+        batch. Each file and then each of their dirs is fsynced, or with
+        MERGE_SYNC_FILESYSTEM the whole filesystem is synced in one call.
+        """
+        if not entries:
+            return
+        if not (config.MERGE_SYNC_FILESYSTEM and utils.sync_filesystem(root_path)):
+            for path in paths:
+                utils.fsync_path(path)
+            for dir_path in dir_paths:
+                utils.fsync_path(dir_path)
+        if journal is not None:
+            journal.append_batch(entries)
+        paths.clear()
+        dir_paths.clear()
+        entries.clear()
+
+    @staticmethod
+    def _iter_batches(root_path: Path, files: List[File]):
+        """
+        Yields (dir_path, files) batches of the files written to each dir, in
+        the order each dir is first written to, with at most
+        MERGE_FSYNC_BATCH_SIZE files per batch
+        """
+        batches: Dict[Path : List[File]] = defaultdict(list)
+        for file in files:
+            batches[root_path / file.rel_path.parent].append(file)
+        batch_size = config.MERGE_FSYNC_BATCH_SIZE
+        for dir_path, dir_files in batches.items():
+            for start in range(0, len(dir_files), batch_size):
+                yield dir_path, dir_files[start : start + batch_size]
+
+    def _write_file(
+        self,
+        file: File,
+        output_path: Path,
+        written_inodes: Dict[tuple, Path],
+        preserve_hardlinks,
+        verify,
+    ) -> str:
+        """Writes one file and adds its manifest entry, returns its status"""
+        # Never write through a partial file, which may be a link to another output
+        output_path.unlink(missing_ok=True)
+        if preserve_hardlinks and file.inode in written_inodes:
+            if self._link_file(written_inodes[file.inode], output_path):
+                self._add_manifest_entry(file, output_path, "linked")
+                return "linked"
+        if verify:
+            is_verified = self._copy_verified(file, output_path)
+            status = "verified" if is_verified else "failed"
+        else:
+            file.copy_to(output_path)
+            status = "copied"
+        self._add_manifest_entry(file, output_path, status)
+        if status != "failed" and file.inode is not None:
+            written_inodes.setdefault(file.inode, output_path)
+        return status
+
+    @staticmethod
+    def _is_journaled(file: File, output_path: Path, entry: dict) -> bool:
+        """Checks a journal entry is for the same source and its output is still there"""
+        if (
+            entry["source"] != str(file.abs_path)
+            or entry["size"] != file.size
+            or entry["source_mtime_ns"] != file.mtime_ns
+        ):
+            return False
+        try:
+            return output_path.stat().st_size == file.size
+        except FileNotFoundError:
+            return False
+
+    def _abort_if_failed(self, failed: List[File]):
+        if failed:
+            msg = f"Aborting build: {len(failed)} files failed verification"
+            print(msg)
+            logging.error(f"{msg}: {[str(file.abs_path) for file in failed]}")
+            sys.exit(1)
+
+    def _copy_verified(self, file: File, output_path: Path) -> bool:
+        """
+        Copies a file, then reads the copy back and hashes it. The copy must
+        match the full_hash already on the File, or when it has none, the hash
+        of the source data streamed while copying, which is then stored. The
+        source must also match its full_hash, or it changed during the copy.
+        Mismatched copies are retried.
+        """
+        for attempt in range(1, config.VERIFY_COPY_ATTEMPTS + 1):
+            hasher = hashlib.new(FULL_HASH_ALGORITHM)
+            with open(output_path, "wb") as dst:
+                for chunk in file.read_chunks():
+                    hasher.update(chunk)
+                    dst.write(chunk)
+            source_hash = hasher.hexdigest()
+            expected_hash = file.full_hash or source_hash
+
+            if source_hash != expected_hash:
+                logging.warning(
+                    f"Source changed while copying {file.abs_path} "
+                    f"(attempt {attempt}/{config.VERIFY_COPY_ATTEMPTS})"
+                )
+            elif self._hash_path(output_path) == expected_hash:
+                if file.full_hash is None:
+                    file.set_full_hash(source_hash)
+                file.copy_stat_to(output_path)
+                return True
+            else:
+                logging.warning(
+                    f"Hash mismatch copying {file.abs_path} "
+                    f"(attempt {attempt}/{config.VERIFY_COPY_ATTEMPTS})"
+                )
+
+        logging.error(f"Failed to verify copy of {file.abs_path}")
+        output_path.unlink(missing_ok=True)
+        return False
+
+    @staticmethod
+    def _hash_path(path: Path) -> str:
+        hasher = hashlib.new(FULL_HASH_ALGORITHM)
+        for chunk in reader.iter_path(path, path.stat().st_size):
+            hasher.update(chunk)
+        return hasher.hexdigest()
+
+    def _add_manifest_entry(
+        self, file: File, output_path: Path, status: str, full_hash: str = None
+    ):
+        output_stat = output_path.stat() if output_path.exists() else None
+        self.manifest[file.rel_path.as_posix()] = {
+            "source": str(file.abs_path),
+            "size": file.size,
+            "mtime_ns": output_stat.st_mtime_ns if output_stat else None,
+            FULL_HASH_ALGORITHM: file.full_hash or full_hash,
+            "status": status,
+        }
+
+    def _write_manifest(self, root_path: Path):
+        manifest_path = self.get_manifest_path(root_path)
+        print(f"Making new output at: {manifest_path}")
+        temp_path = Path(f"{manifest_path}.tmp")
+        with open(temp_path, "w", encoding="utf-8") as manifest_file:
+            json.dump(self.manifest, manifest_file, indent=2)
+            manifest_file.flush()
+            os.fsync(manifest_file.fileno())
+        os.replace(temp_path, manifest_path)
+
+    def _write_completion_marker(self, root_path: Path):
+        """Written last, once the root and its manifest are durable"""
+        marker_path = self.get_completion_marker_path(root_path)
+        counts = {}
+        for entry in self.manifest.values():
+            counts[entry["status"]] = counts.get(entry["status"], 0) + 1
+        with open(marker_path, "w", encoding="utf-8") as marker_file:
+            json.dump(
+                {"completed": utils.get_timestamp(), "files": counts}, marker_file
+            )
+            marker_file.flush()
+            os.fsync(marker_file.fileno())
+        utils.fsync_path(marker_path.parent)
+        logging.info(f"Marked merge at {root_path} complete: {counts}")
+
+    def _read_manifest(self, root_path: Path) -> Dict[str, dict]:
+        manifest_path = self.get_manifest_path(root_path)
+        if not manifest_path.exists():
+            logging.info(f"No manifest at {manifest_path}, comparing by size and mtime")
+            return {}
+        with open(manifest_path, "r", encoding="utf-8") as manifest_file:
+            return json.load(manifest_file)
+
+    def _link_file(self, existing_path: Path, output_path: Path) -> bool:
+        """Hardlinks output_path to an already written file, returns False on failure"""
+        try:
+            os.link(existing_path, output_path)
+            logging.debug("Hardlinked %s to %s", output_path, existing_path)
+            return True
+        except OSError as e:
+            logging.warning(f"Failed to hardlink {output_path}, copying instead: {e}")
+            return False
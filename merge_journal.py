@@ -0,0 +1,87 @@
+import os
+import json
+import logging
+
+from pathlib import Path
+from typing import Dict, List, Optional
+
+import utils
+
+
+class MergeJournal:
+    """
+    An append-only record of the files a merge has durably written, one JSON
+    entry per line. Entries are only appended once the files they describe and
+    their dir have been synced, so every entry can be trusted after a crash.
+    A torn last line from an interrupted append is dropped.
+
+    The first line holds a fingerprint of the merge plan, so the journal of a
+    merge planned for other files is never resumed.
+    """
+
+    def __init__(self, path: Path):
+        self.path = Path(path)
+
+    def __repr__(self):
+        return f"MergeJournal(path={str(self.path)!r})"
+
+    def exists(self) -> bool:
+        return self.path.exists()
+
+    def start(self, plan_fingerprint: str):
+        self.remove()
+        self.append_batch([{"plan": plan_fingerprint}])
+
+    def get_plan_fingerprint(self) -> Optional[str]:
+        """The fingerprint of the plan the journal was started for, if any"""
+        try:
+            with open(self.path, "rb") as journal_file:
+                entry = self._parse_entry(journal_file.readline())
+        except FileNotFoundError:
+            return None
+        return entry.get("plan") if entry else None
+
+    def load(self) -> Dict[str, dict]:
+        """The journaled entries keyed by relative path"""
+        entries: Dict[str:dict] = {}
+        if not self.path.exists():
+            return entries
+        with open(self.path, "r+b") as journal_file:
+            good_size = 0
+            for line in journal_file:
+                entry = self._parse_entry(line)
+                if entry is None:
+                    # Drop it so later appends start on a line of their own
+                    logging.warning(f"Dropping torn entry at the end of {self.path}")
+                    journal_file.truncate(good_size)
+                    break
+                if "rel_path" in entry:
+                    entries[entry["rel_path"]] = entry
+                good_size += len(line)
+        logging.info(f"Loaded {len(entries)} entries from {repr(self)}")
+        return entries
+
+    @staticmethod
+    def _parse_entry(line: bytes) -> Optional[dict]:
+        """An entry, or None for a line torn by an interrupted append"""
+        if not line.endswith(b"\n"):
+            return None
+        try:
+            return json.loads(line)
+        except json.JSONDecodeError:
+            return None
+
+    def append_batch(self, entries: List[dict]):
+        """Appends entries with a single fsync for the whole batch"""
+        if not entries:
+            return
+        is_new = not self.path.exists()
+        with open(self.path, "a", encoding="utf-8") as journal_file:
+            journal_file.write("".join(json.dumps(entry) + "\n" for entry in entries))
+            journal_file.flush()
+            os.fsync(journal_file.fileno())
+        if is_new:
+            utils.fsync_path(self.path.parent)
+
+    def remove(self):
+        self.path.unlink(missing_ok=True)
@@ -0,0 +1,203 @@
+import logging
+
+from array import array
+from collections import Counter, defaultdict
+from pathlib import Path
+from typing import Dict, List
+
+import utils
+from file import File
+from dir_index import DirIndex
+
+try:
+    import numpy
+
+    HAS_NUMPY = True
+except ImportError:
+    HAS_NUMPY = False
+
+MISSING = -1
+
+
+class PresenceMatrix:
+    """
+    Compares every root of a DirIndex at once. Each root has a column of content
+    class ids, one per relative path, where files in the same content class have
+    the same content and MISSING means the root has no file at that path.
+    """
+
+    def __init__(self, dir_index: DirIndex):
+        # A root passed more than once gets one column, which its files share
+        self.roots: List[Path] = list(dict.fromkeys(dir_index.base_dir_paths))
+        if len(self.roots) < len(dir_index.base_dir_paths):
+            logging.warning("Comparing each root passed more than once only once")
+        self.file_list: List[File] = dir_index.file_list
+
+        # Relative paths, in the order they were first indexed
+        self.paths: List[str] = []
+        self.path_ids: Dict[str:int] = {}
+
+        # root x path -> content class id, and root x path -> file id
+        self.matrix: List[array] = []
+        self.file_ids: List[array] = []
+        self.class_count = 0
+
+        # path -> content class id held by the most roots
+        self.consensus = array("l")
+        self.build(dir_index)
+
+    def __repr__(self):
+        return (
+            f"PresenceMatrix(roots={len(self.roots)}, paths={len(self.paths)}, "
+            f"content_classes={self.class_count})"
+        )
+
+    def __str__(self):
+        msg = [f"PresenceMatrix: {repr(self)}\n"]
+        for root_id, root in enumerate(self.roots):
+            msg.append(
+                f"Root {root_id + 1}: {root} "
+                f"(missing {len(self.get_missing(root_id))}, "
+                f"outliers {len(self.get_outliers(root_id))})\n"
+            )
+
+        consensus_files = self.get_consensus_files()
+        for path_id, path in enumerate(self.paths):
+            column = [
+                self.matrix[root_id][path_id] for root_id in range(len(self.roots))
+            ]
+            if len(set(column)) == 1:
+                continue
+            consensus = self.consensus[path_id]
+            msg.append(
+                f"Path: {path} (consensus held by "
+                f"{column.count(consensus)}/{len(self.roots)} roots)\n"
+                f"\tConsensus: {consensus_files[path_id].abs_path}\n"
+            )
+            for root_id, class_id in enumerate(column):
+                if class_id == MISSING:
+                    msg.append(f"\tMissing: {self.roots[root_id]}\n")
+                elif class_id != consensus:
+                    file = self.file_list[self.file_ids[root_id][path_id]]
+                    msg.append(f"\tOutlier: {file.abs_path}\n")
+        return "".join(msg)
+
+    def write_to_file(self, output_dir: Path):
+        utils.write_to_file("NWAY", output_dir / "NWAY", str(self), is_timestamped=True)
+
+    def build(self, dir_index: DirIndex):
+        root_ids = {root: root_id for root_id, root in enumerate(self.roots)}
+        for file in self.file_list:
+            self.path_ids.setdefault(file.rel_path.as_posix(), len(self.path_ids))
+        self.paths = list(self.path_ids)
+
+        self.matrix = [array("l", [MISSING]) * len(self.paths) for _ in self.roots]
+        self.file_ids = [array("l", [MISSING]) * len(self.paths) for _ in self.roots]
+        class_ids = self._get_class_ids(dir_index)
+        for file in self.file_list:
+            root_id = root_ids[file.base_path]
+            path_id = self.path_ids[file.rel_path.as_posix()]
+            self.matrix[root_id][path_id] = class_ids[file.file_id]
+            self.file_ids[root_id][path_id] = file.file_id
+
+        self._build_consensus()
+        logging.info(f"Built {repr(self)}")
+
+    def _get_class_ids(self, dir_index: DirIndex) -> array:
+        """
+        Assigns each file a content class id. Files are only hashed when another
+        file shares their size, and only fully hashed when they also share a
+        quick hash, so each file is read at most once per hash.
+        """
+        class_keys: Dict[tuple:int] = {}
+        class_ids = array("l", [MISSING]) * len(self.file_list)
+
+        quick_groups = defaultdict(list)
+        for size, file_list in dir_index.size_index.items():
+            if len(file_list) == 1:
+                key = ("file", file_list[0].file_id)
+                class_ids[file_list[0].file_id] = class_keys.setdefault(
+                    key, len(class_keys)
+                )
+                continue
+            for file in file_list:
+                quick_groups[(size, file.get_quick_hash())].append(file)
+
+        for (size, quick_hash), file_list in quick_groups.items():
+            for file in file_list:
+                if len(file_list) == 1:
+                    key = ("file", file.file_id)
+                else:
+                    key = (size, file.get_full_hash())
+                class_ids[file.file_id] = class_keys.setdefault(key, len(class_keys))
+
+        self.class_count = len(class_keys)
+        return class_ids
+
+    def _build_consensus(self):
+        if HAS_NUMPY:
+            self._build_consensus_vectorized()
+            return
+        self.consensus = array("l", [MISSING]) * len(self.paths)
+        for path_id in range(len(self.paths)):
+            counts = Counter(
+                column[path_id] for column in self.matrix if column[path_id] != MISSING
+            )
+            # Ties go to the class held by the earliest root
+            if counts:
+                top_count = max(counts.values())
+                self.consensus[path_id] = next(
+                    column[path_id]
+                    for column in self.matrix
+                    if counts.get(column[path_id]) == top_count
+                )
+
+    def _build_consensus_vectorized(self):
+        """
+        Builds the consensus for every path at once with numpy, from how many
+        roots share the class held by each root. Ties go to the earliest root,
+        as argmax returns the first of equal counts.
+        """
+        if not self.paths:
+            self.consensus = array("l")
+            return
+        matrix = numpy.vstack(
+            [numpy.frombuffer(column, dtype="l") for column in self.matrix]
+        )
+        counts = numpy.zeros(matrix.shape, dtype=numpy.intp)
+        for row in matrix:
+            counts += matrix == row
+        counts[matrix == MISSING] = -1
+        top_root_ids = counts.argmax(axis=0)
+        consensus = matrix[top_root_ids, numpy.arange(len(self.paths))]
+        self.consensus = array("l", consensus.tolist())
+
+    def get_missing(self, root_id: int) -> List[str]:
+        """Relative paths that other roots have but this root does not"""
+        column = self.matrix[root_id]
+        return [
+            path
+            for path_id, path in enumerate(self.paths)
+            if column[path_id] == MISSING
+        ]
+
+    def get_outliers(self, root_id: int) -> List[File]:
+        """Files in this root whose content differs from the consensus for their path"""
+        column = self.matrix[root_id]
+        return [
+            self.file_list[self.file_ids[root_id][path_id]]
+            for path_id in range(len(self.paths))
+            if column[path_id] not in (MISSING, self.consensus[path_id])
+        ]
+
+    def get_consensus_files(self) -> List[File]:
+        """One file holding the consensus content for each relative path"""
+        consensus_files = []
+        for path_id, class_id in enumerate(self.consensus):
+            root_id = next(
+                root_id
+                for root_id, column in enumerate(self.matrix)
+                if column[path_id] == class_id
+            )
+            consensus_files.append(self.file_list[self.file_ids[root_id][path_id]])
+        return consensus_files
@@ -0,0 +1,171 @@
+import os
+import mmap
+import errno
+import logging
+import threading
+
+from pathlib import Path
+from typing import IO, Iterator
+
+import config
+from governor import get_governor
+
+HAS_FADVISE = hasattr(os, "posix_fadvise")
+HAS_O_DIRECT = hasattr(os, "O_DIRECT")
+
+# Anonymous maps are shared with forked processes unless they are private
+MMAP_OPTIONS = {"flags": mmap.MAP_PRIVATE} if hasattr(mmap, "MAP_PRIVATE") else {}
+
+
+class ReadPolicy:
+    """
+    How file data is read for hashing and copying.
+
+    Args:
+        buffer_size (int): Bytes read per call, rounded down to a multiple of the page size.
+        use_fadvise (bool): Advise the kernel that reads are sequential, then drop
+            the file from the page cache once it has been read.
+        direct_io_min_size (int, optional): Read files at least this large with
+            O_DIRECT, bypassing the page cache. Defaults to never.
+    """
+
+    def __init__(
+        self,
+        buffer_size=config.READ_BUFFER_SIZE,
+        use_fadvise=config.READ_USE_FADVISE,
+        direct_io_min_size=config.DIRECT_IO_MIN_SIZE,
+    ):
+        self.buffer_size = max(
+            mmap.PAGESIZE, buffer_size // mmap.PAGESIZE * mmap.PAGESIZE
+        )
+        self.use_fadvise = use_fadvise and HAS_FADVISE
+        self.direct_io_min_size = direct_io_min_size if HAS_O_DIRECT else None
+
+    def __repr__(self):
+        return (
+            f"ReadPolicy(buffer_size={self.buffer_size}, "
+            f"use_fadvise={self.use_fadvise}, "
+            f"direct_io_min_size={self.direct_io_min_size})"
+        )
+
+
+_policy = ReadPolicy()
+_local = threading.local()
+
+
+def set_read_policy(policy: ReadPolicy):
+    global _policy
+    _policy = policy
+    logging.info(f"Using {repr(policy)}")
+
+
+def get_read_policy() -> ReadPolicy:
+    return _policy
+
+
+def _get_buffer() -> memoryview:
+    # One page aligned buffer per thread, reused for every read
+    if getattr(_local, "size", None) != _policy.buffer_size:
+        _local.buffer = mmap.mmap(-1, _policy.buffer_size, **MMAP_OPTIONS)
+        _local.view = memoryview(_local.buffer)
+        _local.size = _policy.buffer_size
+    return _local.view
+
+
+def iter_path(path: Path, size: int = None, limit: int = None) -> Iterator[memoryview]:
+    """
+    Yields the data of a file in views of a reused buffer. Each view is only
+    valid until the next one is yielded, and only one file can be read at a
+    time per thread. With `limit`, reading stops once that many bytes are read.
+    """
+    policy = _policy
+    use_direct = policy.direct_io_min_size is not None and (size or 0) >= (
+        policy.direct_io_min_size
+    )
+    fd = _open_fd(path, use_direct)
+    offset = 0
+    try:
+        if policy.use_fadvise and limit is None:
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        while True:
+            try:
+                with open(fd, "rb", buffering=0, closefd=False) as raw:
+                    for chunk in iter_stream(
+                        raw, None if limit is None else limit - offset
+                    ):
+                        offset += len(chunk)
+                        yield chunk
+                return
+            except OSError as e:
+                if not use_direct or e.errno != errno.EINVAL:
+                    raise
+                # Some filesystems accept O_DIRECT when opening, then reject reads
+                logging.debug("O_DIRECT reads failed for %s: %s", path, e)
+                os.close(fd)
+                fd = _open_fd(path, use_direct=False)
+                use_direct = False
+                os.lseek(fd, offset, os.SEEK_SET)
+                if policy.use_fadvise and limit is None:
+                    os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+    finally:
+        if policy.use_fadvise:
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+        os.close(fd)
+
+
+def iter_stream(stream: IO[bytes], limit: int = None) -> Iterator[memoryview]:
+    """
+    Yields the data of an open binary stream in views of a reused buffer, with
+    each read accounted to the governor. With `limit`, reading stops once that
+    many bytes are read, though the last view may hold more.
+    """
+    governor = get_governor()
+    view = _get_buffer()
+    if limit is not None:
+        # Whole pages, as O_DIRECT reads must be
+        view = view[: -(-limit // mmap.PAGESIZE) * mmap.PAGESIZE]
+    remaining = limit
+    while count := stream.readinto(view):
+        governor.throttle(count)
+        yield view[:count]
+        if remaining is not None:
+            remaining -= count
+            if remaining <= 0:
+                return
+
+
+def read_head(path: Path, length: int, size: int = None) -> bytes:
+    """The first `length` bytes of a file, read as iter_path reads it"""
+    return _join_head(iter_path(path, size, limit=length), length)
+
+
+def read_stream_head(stream: IO[bytes], length: int) -> bytes:
+    return _join_head(iter_stream(stream, limit=length), length)
+
+
+def _join_head(chunks: Iterator[memoryview], length: int) -> bytes:
+    head = bytearray()
+    for chunk in chunks:
+        head += chunk
+    return bytes(head[:length])
+
+
+def drop_cache(path: Path):
+    """Drops a file that has just been read from the page cache"""
+    if _policy.use_fadvise:
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+        finally:
+            os.close(fd)
+
+
+def _open_fd(path: Path, use_direct: bool) -> int:
+    flags = os.O_RDONLY | getattr(os, "O_BINARY", 0)
+    if use_direct:
+        try:
+            return os.open(path, flags | os.O_DIRECT)
+        except OSError as e:
+            # Some filesystems, such as tmpfs, don't support O_DIRECT
+            logging.debug("O_DIRECT unavailable for %s: %s", path, e)
+    return os.open(path, flags)
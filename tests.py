@@ -1,13 +1,49 @@
+import io
+import os
+import errno
+import json
+import queue
+import logging
+import re
+import random
+import shutil
+import signal
+import time
+import hashlib
+import tarfile
+import threading
+import tempfile
+import zipfile
 import unittest
+from array import array
 from unittest.mock import patch
 from pathlib import Path
 
+import cli
 import config
 import utils
-from log_config import setup_logging
-from dir_merge_runner import index_from_paths
-from comparison import CompType
-from typing import Optional
+import governor
+import reader
+import bloom
+import daemon
+import archive
+import index_db
+import chunking
+import presence_matrix
+from log_config import setup_logging, LazyQueueHandler
+from dir_merge import parse_query_args
+from dir_merge_runner import index_from_paths, query_index
+from comparison import Comparison, CompType, MAX_FILE_ID
+from file import File
+from archive import ArchiveFile
+from dir_index import DirIndex
+from walk_filter import WalkFilter, _glob_to_regex
+from comparison_manager import ComparisonManager
+from merge_builder import MergeBuilder
+from merge_journal import MergeJournal
+from union_builder import UnionBuilder, ViewMode
+from presence_matrix import PresenceMatrix, MISSING
+from typing import List, Optional
 
 
 # Run test suite: python -m unittest tests.py
@@ -112,5 +148,1450 @@ class TestUnion(unittest.TestCase):
         return False
 
 
+class TestLogConfig(unittest.TestCase):
+    """Test that queued records keep the message they were logged with"""
+
+    def test_args_frozen_when_queued(self):
+        log_queue = queue.SimpleQueue()
+        logger = logging.getLogger("tests.queue")
+        logger.propagate = False
+        logger.addHandler(LazyQueueHandler(log_queue))
+        try:
+            paths = ["a.txt"]
+            logger.warning("Skipping %s", paths)
+            paths.append("b.txt")
+        finally:
+            logger.handlers.clear()
+        record = log_queue.get_nowait()
+        self.assertEqual(record.getMessage(), "Skipping ['a.txt']")
+        self.assertIsNone(record.args)
+        # Formatting is still left to the listener's formatter
+        self.assertFalse(hasattr(record, "message"))
+
+
+class TestWalkFilter(unittest.TestCase):
+    """Test the glob and .gitignore translation of WalkFilter and the filtered walk"""
+
+    def test_glob_to_regex(self):
+        cases = {
+            "*.txt": (["a.txt", ".txt"], ["d/a.txt", "a.txt.bak"]),
+            "?.md": (["a.md"], ["ab.md", "/.md"]),
+            "**/build": (["build", "a/b/build"], ["abuild", "build/x"]),
+            "a/**/b": (["a/b", "a/x/y/b"], ["a/xb", "b"]),
+            "logs/**": (["logs/a", "logs/a/b"], ["logs", "other/a"]),
+            "[!a]bc": (["xbc"], ["abc", "/bc"]),
+            "[ab].py": (["a.py", "b.py"], ["c.py"]),
+            "a+b(1).txt": (["a+b(1).txt"], ["aab1.txt"]),
+        }
+        for pattern, (matches, non_matches) in cases.items():
+            regex = re.compile(_glob_to_regex(pattern))
+            for path in matches:
+                self.assertTrue(regex.fullmatch(path), f"{pattern} vs {path}")
+            for path in non_matches:
+                self.assertFalse(regex.fullmatch(path), f"{pattern} vs {path}")
+
+    def test_name_and_anchored_patterns(self):
+        walk_filter = WalkFilter(exclude=["*.log", "/top.txt", "docs/*.tmp"])
+        self.assertTrue(walk_filter.exclude_file("a/b/x.log", "x.log"))
+        self.assertTrue(walk_filter.exclude_file("top.txt", "top.txt"))
+        self.assertFalse(walk_filter.exclude_file("sub/top.txt", "top.txt"))
+        self.assertTrue(walk_filter.exclude_file("docs/a.tmp", "a.tmp"))
+        self.assertFalse(walk_filter.exclude_file("src/docs/a.tmp", "a.tmp"))
+
+    def test_negation_and_dir_only(self):
+        walk_filter = WalkFilter(exclude=["*.log", "!keep.log", "build/"])
+        self.assertTrue(walk_filter.exclude_file("a.log", "a.log"))
+        self.assertFalse(walk_filter.exclude_file("x/keep.log", "keep.log"))
+        self.assertTrue(walk_filter.exclude_dir("src/build", "build"))
+        self.assertFalse(walk_filter.exclude_file("build", "build"))
+
+    def test_ignore_file_and_extensions(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            ignore_path = Path(temp_dir) / ".gitignore"
+            ignore_path.write_text("# comment\n\nnode_modules/\n*.bak\n")
+            walk_filter = WalkFilter(
+                ignore_files=[ignore_path], extensions=["TXT", ".md"], max_size=10
+            )
+        self.assertEqual(len(walk_filter.exclude_rules), 2)
+        self.assertTrue(walk_filter.exclude_dir("a/node_modules", "node_modules"))
+        self.assertTrue(walk_filter.exclude_file("a.bak", "a.bak"))
+        self.assertFalse(walk_filter.exclude_file("a.txt", "a.txt"))
+        self.assertTrue(walk_filter.exclude_file("a.py", "a.py"))
+        self.assertTrue(walk_filter.exclude_size(11))
+        self.assertFalse(walk_filter.exclude_size(10))
+
+    def test_walk(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            root = Path(temp_dir) / "root"
+            outside = Path(temp_dir) / "outside"
+            for path in [
+                root / "keep.txt",
+                root / "skip.log",
+                root / ".hidden" / "a.txt",
+                root / "build" / "b.txt",
+                root / "sub" / "c.txt",
+                outside / "d.txt",
+            ]:
+                path.parent.mkdir(parents=True, exist_ok=True)
+                path.write_text(path.name)
+            os.symlink(outside, root / "linked_dir")
+            os.symlink(outside / "d.txt", root / "linked.txt")
+
+            dir_index = DirIndex(walk_filter=WalkFilter(exclude=["*.log", "build/"]))
+            found = {
+                abs_path.relative_to(root).as_posix()
+                for abs_path, _ in dir_index._walk(root)
+            }
+            self.assertEqual(found, {"keep.txt", "sub/c.txt", "linked.txt"})
+            self.assertEqual(dir_index.excluded_counts["dirs"], 1)
+            self.assertEqual(dir_index.excluded_counts["files"], 1)
+
+    def test_skips_paths_removed_mid_walk(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            root = Path(temp_dir)
+            write_tree(root, {"keep.txt": "k", "gone.txt": "g", "sub/c.txt": "c"})
+            dir_index = DirIndex()
+            walk = dir_index._walk
+
+            def remove_sub(dir_path: Path, rel_dir: str):
+                if rel_dir == "sub/":
+                    shutil.rmtree(dir_path)
+
+            def walk_removing(base_dir_path, on_dir=None):
+                for abs_path, stat_result in walk(base_dir_path, remove_sub):
+                    if abs_path.name == "gone.txt":
+                        abs_path.unlink()
+                    yield abs_path, stat_result
+
+            with patch.object(dir_index, "_walk", walk_removing):
+                with self.assertLogs(level="WARNING") as logs:
+                    dir_index.index_dir(root)
+            self.assertEqual([file.name for file in dir_index.file_list], ["keep.txt"])
+            self.assertEqual(len(logs.output), 2)
+
+
+def write_tree(root: Path, files: dict):
+    """Writes {relative path: text} under root"""
+    for rel_path, text in files.items():
+        path = root / rel_path
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(text)
+
+
+def build_merge(*dir_paths: Path) -> MergeBuilder:
+    dir_index = DirIndex()
+    for dir_path in dir_paths:
+        dir_index.index_dir(dir_path)
+    comparison_manager = ComparisonManager()
+    comparison_manager.add_dir_index(dir_index)
+    return MergeBuilder(comparison_manager)
+
+
+class TestComparisonRecords(unittest.TestCase):
+    """Test that comparisons pack into integer records and back"""
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        root = Path(self.temp_dir.name)
+        write_tree(root, {"a.txt": "a", "b.txt": "bb"})
+        self.file_a, self.file_b = (
+            File(root, root / name) for name in ["a.txt", "b.txt"]
+        )
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def test_round_trip(self):
+        for file_a_id, file_b_id in [(0, 1), (5, 3), (MAX_FILE_ID - 1, MAX_FILE_ID)]:
+            self.file_a.file_id, self.file_b.file_id = file_a_id, file_b_id
+            file_list = {file_a_id: self.file_a, file_b_id: self.file_b}
+            for comp_type in CompType:
+                record = Comparison(self.file_a, self.file_b, comp_type).to_record()
+                self.assertLess(record, 1 << 64)
+                self.assertEqual(
+                    Comparison.unpack_record(record), (file_a_id, file_b_id, comp_type)
+                )
+                comparison = Comparison.from_record(record, file_list)
+                self.assertIs(comparison.fileA, self.file_a)
+                self.assertIs(comparison.fileB, self.file_b)
+                self.assertIs(comparison.comp_type, comp_type)
+
+    def test_file_id_overflow(self):
+        self.file_b.file_id = 0
+        for file_id in [MAX_FILE_ID + 1, None]:
+            self.file_a.file_id = file_id
+            for comparison in [
+                Comparison(self.file_a, self.file_b, CompType.MATCH),
+                Comparison(self.file_b, self.file_a, CompType.MATCH),
+            ]:
+                with self.assertRaises(ValueError):
+                    comparison.to_record()
+
+
+class TestUpdateMerge(unittest.TestCase):
+    """Test that updating a merge swaps in the new merge and survives interruption"""
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.source = Path(self.temp_dir.name) / "source"
+        write_tree(self.source, {"a.txt": "a", "sub/b.txt": "bb", "sub/c.txt": "ccc"})
+        self.output = Path(self.temp_dir.name) / "out" / "MERGE"
+        build_merge(self.source).write_merge_to_disk(self.output)
+        self.root = next(path for path in self.output.parent.iterdir() if path.is_dir())
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def _update(self):
+        (self.source / "sub" / "b.txt").write_text("changed")
+        build_merge(self.source).update_merge_on_disk(self.root)
+        self.assertEqual((self.root / "sub" / "b.txt").read_text(), "changed")
+        self.assertEqual((self.root / "a.txt").read_text(), "a")
+        self.assertTrue(MergeBuilder.get_completion_marker_path(self.root).exists())
+        self.assertEqual(
+            sorted(path.name for path in self.output.parent.iterdir()),
+            sorted(
+                [
+                    self.root.name,
+                    f"{self.root.name}.complete",
+                    f"{self.root.name}.manifest.json",
+                ]
+            ),
+        )
+
+    def test_update(self):
+        self._update()
+
+    def test_update_without_exchange(self):
+        with patch("utils.exchange_paths", return_value=False):
+            self._update()
+
+    def test_recovers_interrupted_swap(self):
+        # A crash between the two renames leaves no merge at the target
+        self.root.rename(f"{self.root}.old-2000-01-01_00-00-00")
+        self._update()
+
+    def test_hashes_unhashed_source(self):
+        # An edit that kept the size and mtime is only caught by hash. The
+        # files are unique, so this run has not hashed them yet
+        shutil.rmtree(self.output.parent)
+        build_merge(self.source).write_merge_to_disk(self.output, verify=True)
+        self.root = next(path for path in self.output.parent.iterdir() if path.is_dir())
+        source_path = self.source / "a.txt"
+        stat_result = source_path.stat()
+        source_path.write_text("A")
+        os.utime(source_path, ns=(stat_result.st_atime_ns, stat_result.st_mtime_ns))
+        build_merge(self.source).update_merge_on_disk(self.root)
+        self.assertEqual((self.root / "a.txt").read_text(), "A")
+
+    def test_logs_metadata_fallback(self):
+        with self.assertLogs(level="DEBUG") as logs:
+            build_merge(self.source).update_merge_on_disk(self.root)
+        output = "\n".join(logs.output)
+        self.assertIn(f"No previous hash for {self.source / 'a.txt'}", output)
+        self.assertIn("3 unchanged by size and mtime only", output)
+
+
+class TestParallelCompare(unittest.TestCase):
+    """Test that comparing on a process pool gives the same result as serially"""
+
+    def _compare(self, roots: List[Path], workers: int):
+        dir_index = DirIndex()
+        for root in roots:
+            dir_index.index_dir(root)
+        comparison_manager = ComparisonManager()
+        with patch("config.COMPARE_PARALLEL_MIN_FILES", 0):
+            comparison_manager.add_dir_index(dir_index, workers=workers)
+        hashes = [(file.quick_hash, file.full_hash) for file in dir_index.file_list]
+        return comparison_manager, hashes
+
+    def test_parallel_matches_serial(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            roots = [Path(temp_dir) / "a", Path(temp_dir) / "b"]
+            write_tree(
+                roots[0],
+                {
+                    "same.txt": "same",
+                    "renamed.txt": "moved",
+                    "edited.txt": "one",
+                    "grown.txt": "short!",
+                    "sub/only_a.txt": "only in a",
+                },
+            )
+            write_tree(
+                roots[1],
+                {
+                    "same.txt": "same",
+                    "moved.txt": "moved",
+                    "edited.txt": "two",
+                    "grown.txt": "much longer",
+                    "sub/same.txt": "same",
+                },
+            )
+            serial, serial_hashes = self._compare(roots, workers=1)
+            parallel, parallel_hashes = self._compare(roots, workers=2)
+
+            self.assertEqual(parallel.comparison_cache, serial.comparison_cache)
+            self.assertEqual(parallel.has_dup, serial.has_dup)
+            self.assertEqual(parallel_hashes, serial_hashes)
+            for comp_type, index in serial.comparisons.items():
+                self.assertEqual(str(parallel.comparisons[comp_type]), str(index))
+
+    def test_shards_send_tuples(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            root = Path(temp_dir)
+            write_tree(root, {"a.txt": "same", "b/a.txt": "diff!", "c.txt": "same"})
+            os.link(root / "a.txt", root / "link.txt")
+            with zipfile.ZipFile(root / "d.zip", "w") as zip_archive:
+                zip_archive.writestr("a.txt", "same")
+            dir_index = DirIndex(index_archives=True)
+            dir_index.index_dir(root)
+            shards = ComparisonManager._make_shards(dir_index, 1)
+
+            ((size_groups, name_groups),) = shards
+            file_tuples = [
+                file_tuple
+                for group in size_groups + name_groups
+                for file_tuple in group
+            ]
+            self.assertTrue(
+                all(type(file_tuple) is tuple for file_tuple in file_tuples)
+            )
+            for file_tuple in file_tuples:
+                file = dir_index.file_list[file_tuple[0]]
+                rebuilt = type(file).from_tuple(file_tuple)
+                self.assertEqual(rebuilt.to_tuple(), file_tuple)
+                self.assertEqual(rebuilt.rel_path, file.rel_path)
+                self.assertEqual(rebuilt.hardlinks, [rebuilt])
+            member = next(
+                file for file in dir_index.file_list if isinstance(file, ArchiveFile)
+            )
+            rebuilt = ArchiveFile.from_tuple(member.to_tuple())
+            self.assertEqual(rebuilt.get_full_hash(), member.get_full_hash())
+
+
+class TestTrustMetadata(unittest.TestCase):
+    """Test that decisions made from size and mtime are marked, or hashed on request"""
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.roots = [Path(self.temp_dir.name) / "a", Path(self.temp_dir.name) / "b"]
+        # Copies that did not keep their mtime, and edits that did
+        write_tree(self.roots[0], {"copy.txt": "same", "edit.txt": "old"})
+        write_tree(self.roots[1], {"copy.txt": "same", "edit.txt": "new"})
+        os.utime(self.roots[0] / "copy.txt", ns=(1_000_000_000, 1_000_000_000))
+        for root in self.roots:
+            os.utime(root / "edit.txt", ns=(2_000_000_000, 2_000_000_000))
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def _compare(self, hash_fallback: bool) -> ComparisonManager:
+        dir_index = DirIndex()
+        for root in self.roots:
+            dir_index.index_dir(root)
+        comparison_manager = ComparisonManager(
+            trust_metadata=True, hash_fallback=hash_fallback
+        )
+        comparison_manager.add_dir_index(dir_index)
+        return comparison_manager
+
+    def _get_names(self, comparison_manager: ComparisonManager, comp_type: CompType):
+        return {
+            file.name
+            for group in comparison_manager.comparisons[comp_type].index.values()
+            for file in group
+        }
+
+    def test_assumed(self):
+        comparison_manager = self._compare(hash_fallback=False)
+        self.assertEqual(
+            self._get_names(comparison_manager, CompType.PATH_NAME_DUP), {"copy.txt"}
+        )
+        self.assertEqual(
+            self._get_names(comparison_manager, CompType.MATCH),
+            {"edit.txt"},
+        )
+        for comp_type in [CompType.PATH_NAME_DUP, CompType.MATCH]:
+            report = str(comparison_manager.comparisons[comp_type])
+            self.assertEqual(report.count(") [assumed]\n"), 2)
+
+    def test_hash_fallback(self):
+        comparison_manager = self._compare(hash_fallback=True)
+        self.assertEqual(
+            self._get_names(comparison_manager, CompType.MATCH),
+            {"copy.txt", "edit.txt"},
+        )
+        report = str(comparison_manager.comparisons[CompType.MATCH])
+        self.assertEqual(report.count(") [assumed]\n"), 2)
+        self.assertIn("copy.txt (copy.txt)\n", report)
+
+    def test_hash_fallback_keeps_one_group(self):
+        # Three copies, one of which did not keep its mtime, wherever it is
+        # in the order the files are compared
+        for odd_name in ["a.txt", "b.txt", "c.txt"]:
+            with tempfile.TemporaryDirectory() as temp_dir:
+                root = Path(temp_dir)
+                write_tree(root, {"a.txt": "copy", "b.txt": "copy", "c.txt": "copy"})
+                for name in ["a.txt", "b.txt", "c.txt"]:
+                    mtime_ns = 1_000_000_000 if name == odd_name else 2_000_000_000
+                    os.utime(root / name, ns=(mtime_ns, mtime_ns))
+                dir_index = DirIndex()
+                dir_index.index_dir(root)
+                comparison_manager = ComparisonManager(
+                    trust_metadata=True, hash_fallback=True
+                )
+                comparison_manager.add_dir_index(dir_index)
+
+                index = comparison_manager.comparisons[CompType.CONTENT_PATH_DUP]
+                self.assertEqual(len(index.index), 1)
+                group = next(iter(index.index.values()))
+                self.assertEqual(len(group), 3)
+                for file in dir_index.file_list:
+                    self.assertIs(index.get_group(file), group)
+
+
+class TestResolveClusters(unittest.TestCase):
+    """Test that dup groups sharing directories are resolved, and undone, together"""
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.roots = [Path(self.temp_dir.name) / "a", Path(self.temp_dir.name) / "b"]
+        # Three groups in photos/backup, one in docs/archive, and one that
+        # also has a copy in old, so its dir set differs
+        write_tree(
+            self.roots[0],
+            {
+                "photos/p1.jpg": "1",
+                "photos/p2.jpg": "22",
+                "photos/p3.jpg": "333",
+                "docs/q.txt": "4444",
+                "photos/r.txt": "55555",
+            },
+        )
+        write_tree(
+            self.roots[1],
+            {
+                "backup/p1.jpg": "1",
+                "backup/p2.jpg": "22",
+                "backup/p3.jpg": "333",
+                "archive/q.txt": "4444",
+                "backup/r.txt": "55555",
+                "old/r.txt": "55555",
+            },
+        )
+        dir_index = DirIndex()
+        for root in self.roots:
+            dir_index.index_dir(root)
+        self.comparison_manager = ComparisonManager()
+        self.comparison_manager.add_dir_index(dir_index)
+        self.index = self.comparison_manager.comparisons[CompType.CONTENT_NAME_DUP]
+        self.photos_dirs = [
+            (self.roots[0], Path("photos")),
+            (self.roots[1], Path("backup")),
+        ]
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def _get_state(self) -> dict:
+        return {
+            key: (
+                sorted(str(file.abs_path) for file in group),
+                set(self.index.member_ids[key]),
+            )
+            for key, group in self.index.index.items()
+        }
+
+    def _resolve(self, cluster_option, keep_dirs: list, review: list):
+        with patch("cli.display_cluster"), patch("cli.display_files"), patch(
+            "cli.prompt_cluster_options", return_value=cluster_option
+        ), patch("cli.prompt_keep_dirs", side_effect=keep_dirs), patch(
+            "cli.prompt_review_cluster", side_effect=review
+        ), patch(
+            "cli.prompt_keep_options", side_effect=lambda file_list: file_list
+        ) as prompt_keep_options:
+            self.comparison_manager.resolve_dups(CompType.CONTENT_NAME_DUP)
+        return prompt_keep_options
+
+    def test_cluster_grouping(self):
+        clusters = self.comparison_manager._cluster_by_dir_signature(self.index)
+        names = {
+            signature: sorted(self.index.index[key][0].name for key in keys)
+            for signature, keys in clusters.items()
+        }
+        self.assertEqual(
+            names,
+            {
+                tuple(sorted(self.photos_dirs)): ["p1.jpg", "p2.jpg", "p3.jpg"],
+                ((self.roots[0], Path("docs")), (self.roots[1], Path("archive"))): [
+                    "q.txt"
+                ],
+                (
+                    (self.roots[0], Path("photos")),
+                    (self.roots[1], Path("backup")),
+                    (self.roots[1], Path("old")),
+                ): ["r.txt"],
+            },
+        )
+
+    def test_undo_restores_groups(self):
+        original_state = self._get_state()
+        states = []
+
+        def keep_dirs(signature):
+            states.append(self._get_state())
+            return [signature[len(states) - 1]]
+
+        prompt_keep_options = self._resolve(
+            cli.ClusterOptions.APPLY_TO_CLUSTER,
+            keep_dirs=keep_dirs,
+            review=[cli.ClusterReviewOptions.UNDO, cli.ClusterReviewOptions.KEEP],
+        )
+        # The second choice was made from the groups as they were before the first
+        self.assertEqual(states, [original_state, original_state])
+        final_state = self._get_state()
+        for key, (paths, member_ids) in original_state.items():
+            if Path(paths[0]).name.startswith("p"):
+                kept = [path for path in paths if Path(path).parent.name == "backup"]
+                self.assertEqual(final_state[key][0], kept)
+                self.assertEqual(len(final_state[key][1]), 1)
+            else:
+                self.assertEqual(final_state[key], (paths, member_ids))
+        # Only the groups outside the cluster were prompted individually
+        self.assertEqual(prompt_keep_options.call_count, 2)
+
+    def test_empty_choice_removes_groups(self):
+        self._resolve(
+            cli.ClusterOptions.APPLY_TO_CLUSTER,
+            keep_dirs=[[]],
+            review=[cli.ClusterReviewOptions.KEEP],
+        )
+        self.assertEqual(
+            sorted(group[0].name for group in self.index.index.values()),
+            ["q.txt", "r.txt"],
+        )
+
+    def test_resolve_individually(self):
+        original_state = self._get_state()
+        prompt_keep_options = self._resolve(
+            cli.ClusterOptions.RESOLVE_INDIVIDUALLY, keep_dirs=[], review=[]
+        )
+        self.assertEqual(prompt_keep_options.call_count, 5)
+        self.assertEqual(self._get_state(), original_state)
+
+
+class TestHardlinks(unittest.TestCase):
+    """Test that hardlinks share their hashes, are not read twice, and stay linked"""
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.root = Path(self.temp_dir.name) / "root"
+        write_tree(self.root, {"a.txt": "linked", "c.txt": "linked"})
+        (self.root / "sub").mkdir()
+        os.link(self.root / "a.txt", self.root / "sub" / "b.txt")
+        self.dir_index = DirIndex()
+        self.dir_index.index_dir(self.root)
+        self.a, self.b, self.c = (
+            self.dir_index.name_index[name][0] for name in ["a.txt", "b.txt", "c.txt"]
+        )
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def test_inode_sharing(self):
+        self.assertIsNotNone(self.a.inode)
+        self.assertEqual(self.a.inode, self.b.inode)
+        self.assertIs(self.a.hardlinks, self.b.hardlinks)
+        self.assertEqual(self.a.hardlinks, [self.a, self.b])
+        self.assertIsNone(self.c.inode)
+        self.assertEqual(self.c.hardlinks, [self.c])
+
+    def test_linked_files_not_compared(self):
+        with patch.object(
+            File, "_create_quick_hash", autospec=True, return_value="quick"
+        ) as create_quick_hash, patch.object(
+            File, "_create_full_hash", autospec=True
+        ) as create_full_hash:
+            self.assertTrue(self.a.compare_content(self.b))
+        create_quick_hash.assert_called_once_with(self.a)
+        create_full_hash.assert_not_called()
+        self.assertEqual(self.b.quick_hash, "quick")
+
+    def test_hashes_shared(self):
+        comparison_manager = ComparisonManager()
+        with patch.object(
+            File, "_create_full_hash", autospec=True, wraps=File._create_full_hash
+        ) as create_full_hash:
+            comparison_manager.add_dir_index(self.dir_index)
+        # Once for the inode of a.txt and b.txt, once for c.txt
+        self.assertEqual(create_full_hash.call_count, 2)
+        self.assertEqual(self.a.full_hash, self.b.full_hash)
+        self.assertEqual(self.a.full_hash, self.c.full_hash)
+
+    def test_preserve_hardlinks(self):
+        output = Path(self.temp_dir.name) / "out" / "MERGE"
+        comparison_manager = ComparisonManager()
+        comparison_manager.add_dir_index(self.dir_index)
+        MergeBuilder(comparison_manager).write_merge_to_disk(
+            output, preserve_hardlinks=True
+        )
+        merge_root = next(output.parent.glob("MERGE-*[0-9]"))
+        self.assertTrue((merge_root / "a.txt").samefile(merge_root / "sub" / "b.txt"))
+        self.assertFalse((merge_root / "a.txt").samefile(merge_root / "c.txt"))
+
+
+class TestBloom(unittest.TestCase):
+    """Test that saved root filters are reused only while the root is unchanged"""
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        temp_path = Path(self.temp_dir.name)
+        self.root = temp_path / "root"
+        self.dir = temp_path / "new"
+        write_tree(
+            self.root,
+            {"a/same.txt": "same", "a/other.txt": "other!", "b/renamed.txt": "moved"},
+        )
+        write_tree(self.dir, {"same.txt": "same", "moved.txt": "moved", "new.txt": "n"})
+        self.bloom_patch = patch("config.BLOOM_DIR_PATH", temp_path / "BLOOM")
+        self.bloom_patch.start()
+
+    def tearDown(self):
+        self.bloom_patch.stop()
+        self.temp_dir.cleanup()
+
+    def _load(self, walk_filter: WalkFilter = None):
+        with patch.object(
+            bloom.RootFilter, "build", wraps=bloom.RootFilter.build
+        ) as build:
+            root_filter = bloom.RootFilter.load_or_build(self.root, walk_filter)
+        return root_filter, build.called
+
+    def test_rebuilds_when_stale(self):
+        self.assertTrue(self._load()[1])
+        root_filter, rebuilt = self._load()
+        self.assertFalse(rebuilt)
+        self.assertTrue(root_filter.may_match_name("same.txt"))
+
+        self.assertTrue(self._load(WalkFilter(exclude=["b/"]))[1])
+        self.assertFalse(self._load(WalkFilter(exclude=["b/"]))[1])
+        self.assertTrue(self._load()[1])
+
+        write_tree(self.root, {"a/added.txt": "added"})
+        root_filter, rebuilt = self._load()
+        self.assertTrue(rebuilt)
+        self.assertTrue(root_filter.may_match_name("added.txt"))
+
+    def test_prefilter(self):
+        root_filter, _ = self._load()
+        dir_index = DirIndex()
+        dir_index.index_dir(self.dir)
+        # Only the candidates are stat'ed, without walking the root again
+        with patch.object(DirIndex, "_walk", side_effect=AssertionError("walked")):
+            bloom.prefilter_index(dir_index, root_filter)
+        self.assertEqual(
+            sorted(file.rel_path.as_posix() for file in dir_index.file_list[3:]),
+            ["a/same.txt", "b/renamed.txt"],
+        )
+
+        comparison_manager = ComparisonManager()
+        comparison_manager.add_dir_index(dir_index)
+        new_files = bloom.get_new_files(dir_index, comparison_manager, self.root)
+        self.assertEqual([file.name for file in new_files], ["new.txt"])
+
+
+class TestResumeMerge(unittest.TestCase):
+    """Test that an interrupted merge resumes from its journal"""
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.source = Path(self.temp_dir.name) / "source"
+        self.files = {f"d{i % 3}/f{i}.txt": "x" * (i + 1) for i in range(12)}
+        write_tree(self.source, self.files)
+        self.output = Path(self.temp_dir.name) / "out" / "MERGE"
+        self.staging = Path(f"{self.output}.staging")
+        self.copy_count = 0
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def _merge(self, fail_at: int = None):
+        original_copy_to = File.copy_to
+
+        def copy_to(file, output_path):
+            self.copy_count += 1
+            if self.copy_count == fail_at:
+                raise OSError("interrupted")
+            original_copy_to(file, output_path)
+
+        with patch.object(File, "copy_to", copy_to):
+            with patch("config.MERGE_FSYNC_BATCH_SIZE", 2):
+                build_merge(self.source).write_merge_to_disk(self.output)
+
+    def _get_root(self) -> Path:
+        return next(
+            path
+            for path in self.output.parent.iterdir()
+            if path.is_dir() and path != self.staging
+        )
+
+    def test_resume(self):
+        with self.assertRaises(OSError):
+            self._merge(fail_at=7)
+        self.assertTrue(self.staging.exists())
+        # Left by something other than this merge
+        write_tree(self.staging, {"stale.txt": "stale", "d0/stale/x.txt": "x"})
+
+        self.copy_count = 0
+        self._merge()
+        # Files journaled before the interruption are not copied again
+        self.assertLess(self.copy_count, len(self.files))
+        self.assertFalse(self.staging.exists())
+        root = self._get_root()
+        self.assertEqual(
+            {
+                path.relative_to(root).as_posix(): path.read_text()
+                for path in root.rglob("*")
+                if path.is_file()
+            },
+            self.files,
+        )
+        self.assertTrue(MergeBuilder.get_completion_marker_path(root).exists())
+        self.assertFalse(MergeBuilder.get_journal_path(self.staging).exists())
+
+    def test_sync_filesystem_is_opt_in(self):
+        with patch("utils.sync_filesystem", return_value=True) as sync_filesystem:
+            with patch("utils.fsync_path") as fsync_path:
+                self._merge()
+        sync_filesystem.assert_not_called()
+        synced = {Path(call.args[0]).name for call in fsync_path.call_args_list}
+        self.assertTrue(synced.issuperset(Path(path).name for path in self.files))
+
+        shutil.rmtree(self.output.parent)
+        with patch("config.MERGE_SYNC_FILESYSTEM", True):
+            with patch("utils.sync_filesystem", return_value=True) as sync_filesystem:
+                self._merge()
+        sync_filesystem.assert_called()
+
+    def test_recopies_changed_source(self):
+        with self.assertRaises(OSError):
+            self._merge(fail_at=7)
+        journaled = MergeJournal(MergeBuilder.get_journal_path(self.staging)).load()
+        self.assertIn("d0/f0.txt", journaled)
+        (self.source / "d0" / "f0.txt").write_text("changed content")
+        self.files["d0/f0.txt"] = "changed content"
+
+        # Only the changed file is copied again, with the files never journaled
+        self.copy_count = 0
+        self._merge()
+        self.assertEqual(self.copy_count, len(self.files) - len(journaled) + 1)
+        root = self._get_root()
+        self.assertEqual((root / "d0" / "f0.txt").read_text(), "changed content")
+
+    def test_discards_other_plan(self):
+        with self.assertRaises(OSError):
+            self._merge(fail_at=7)
+        write_tree(self.source, {"d0/added.txt": "added content"})
+        self.files["d0/added.txt"] = "added content"
+
+        self.copy_count = 0
+        self._merge()
+        self.assertEqual(self.copy_count, len(self.files))
+        self.assertEqual(
+            (self._get_root() / "d0" / "added.txt").read_text(), "added content"
+        )
+
+
+class TestVerifiedCopy(unittest.TestCase):
+    """Test that verified copies are read back and checked against their source"""
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.source = Path(self.temp_dir.name) / "source"
+        write_tree(self.source, {"a.txt": "source data"})
+        self.output_path = Path(self.temp_dir.name) / "a.txt"
+        self.merge_builder = build_merge(self.source)
+        self.file = self.merge_builder.plan["a.txt"]
+        self.source_hash = hashlib.sha256(b"source data").hexdigest()
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def _copy(self, corrupt_count: int) -> bool:
+        """Copies with the first corrupt_count copies written corrupted"""
+
+        class CorruptWriter:
+            def __init__(self, dst):
+                self.dst = dst
+
+            def __enter__(self):
+                return self
+
+            def __exit__(self, *args):
+                self.dst.close()
+
+            def write(self, data):
+                self.dst.write(bytes(data).upper())
+
+        def corrupt_open(path, mode="r", *args, **kwargs):
+            nonlocal corrupt_count
+            dst = open(path, mode, *args, **kwargs)
+            if mode == "wb" and corrupt_count:
+                corrupt_count -= 1
+                return CorruptWriter(dst)
+            return dst
+
+        with patch("merge_builder.open", corrupt_open, create=True):
+            return self.merge_builder._copy_verified(self.file, self.output_path)
+
+    def test_retries_corrupt_copy(self):
+        self.assertIsNone(self.file.full_hash)
+        with self.assertLogs(level="WARNING") as logs:
+            self.assertTrue(self._copy(corrupt_count=1))
+        self.assertIn("Hash mismatch", logs.output[0])
+        self.assertEqual(self.output_path.read_text(), "source data")
+        self.assertEqual(self.file.full_hash, self.source_hash)
+
+    def test_fails_corrupt_copy(self):
+        with self.assertLogs(level="WARNING"):
+            self.assertFalse(self._copy(corrupt_count=config.VERIFY_COPY_ATTEMPTS))
+        self.assertFalse(self.output_path.exists())
+        # A hash of data that was never copied intact is not kept
+        self.assertIsNone(self.file.full_hash)
+
+    def test_fails_changed_source(self):
+        self.file.set_full_hash(hashlib.sha256(b"older data!").hexdigest())
+        with self.assertLogs(level="WARNING") as logs:
+            self.assertFalse(self._copy(corrupt_count=0))
+        self.assertIn("Source changed", logs.output[0])
+        self.assertFalse(self.output_path.exists())
+
+
+class TestMergeConflicts(unittest.TestCase):
+    """Test that kept versions of one path with different content stop the merge"""
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.roots = [Path(self.temp_dir.name) / "a", Path(self.temp_dir.name) / "b"]
+        write_tree(self.roots[0], {"same.txt": "same", "edit.txt": "old"})
+        write_tree(self.roots[1], {"same.txt": "same", "edit.txt": "new edit"})
+        self.output = Path(self.temp_dir.name) / "out" / "MERGE"
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def test_conflicts_abort_before_copying(self):
+        # Both versions of edit.txt are still kept, as nothing was resolved
+        merge_builder = build_merge(*self.roots)
+        self.assertEqual(merge_builder.duplicate_count, 1)
+        self.assertEqual(
+            [file.abs_path for file in merge_builder.conflicts["edit.txt"]],
+            [root / "edit.txt" for root in self.roots],
+        )
+        with patch("sys.stdout", io.StringIO()), self.assertLogs(level="ERROR"):
+            with self.assertRaises(SystemExit):
+                merge_builder.write_merge_to_disk(self.output)
+            self.output.parent.mkdir()
+            with self.assertRaises(SystemExit):
+                merge_builder.update_merge_on_disk(self.output.parent)
+        self.assertEqual(list(self.output.parent.iterdir()), [])
+
+    def test_one_kept_version(self):
+        dir_index = DirIndex()
+        for root in self.roots:
+            dir_index.index_dir(root)
+        comparison_manager = ComparisonManager()
+        comparison_manager.add_dir_index(dir_index)
+        comparison_index = comparison_manager.comparisons[CompType.PATH_NAME_DUP]
+        comparison_index.set_comparisons(
+            [next(iter(comparison_index.index.values()))[1]]
+        )
+        merge_builder = MergeBuilder(comparison_manager)
+        self.assertEqual(merge_builder.conflicts, {})
+        self.assertEqual(merge_builder.plan["edit.txt"].base_path, self.roots[1])
+        merge_builder.write_merge_to_disk(self.output)
+        root = next(self.output.parent.glob("MERGE-*[0-9]"))
+        self.assertEqual((root / "edit.txt").read_text(), "new edit")
+
+
+class TestReader(unittest.TestCase):
+    """Test that files are read, and quick hashed, with the read policy"""
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.path = Path(self.temp_dir.name) / "data.bin"
+        self.data = random.Random(0).randbytes(5 * 4096 + 100)
+        self.path.write_bytes(self.data)
+        self.policy = reader.get_read_policy()
+
+    def tearDown(self):
+        reader.set_read_policy(self.policy)
+        self.temp_dir.cleanup()
+
+    def _read(self, **kwargs) -> bytes:
+        return b"".join(bytes(chunk) for chunk in reader.iter_path(self.path, **kwargs))
+
+    def test_iter_path(self):
+        reader.set_read_policy(reader.ReadPolicy(buffer_size=4096))
+        self.assertEqual(self._read(), self.data)
+        self.assertEqual(self._read(limit=5000)[:5000], self.data[:5000])
+
+    @unittest.skipUnless(reader.HAS_O_DIRECT, "O_DIRECT is not available")
+    def test_direct_io_read_error_falls_back(self):
+        # Some filesystems accept O_DIRECT when opening, then reject reads
+        reader.set_read_policy(
+            reader.ReadPolicy(buffer_size=4096, direct_io_min_size=0)
+        )
+        original_iter_stream, original_open_fd = reader.iter_stream, reader._open_fd
+        opened_direct = []
+
+        def open_fd(path, use_direct):
+            opened_direct.append(use_direct)
+            return original_open_fd(path, use_direct=False)
+
+        def iter_stream(stream, limit=None):
+            chunks = original_iter_stream(stream, limit)
+            if len(opened_direct) == 1:
+                yield next(chunks)
+                raise OSError(errno.EINVAL, "Invalid argument")
+            yield from chunks
+
+        with patch("reader._open_fd", open_fd), patch(
+            "reader.iter_stream", iter_stream
+        ):
+            self.assertEqual(self._read(size=len(self.data)), self.data)
+        self.assertEqual(opened_direct, [True, False])
+
+    def test_read_error_without_direct_io_raises(self):
+        def iter_stream(stream, limit=None):
+            raise OSError(errno.EINVAL, "Invalid argument")
+            yield
+
+        with patch("reader.iter_stream", iter_stream):
+            with self.assertRaises(OSError):
+                self._read()
+
+    @unittest.skipUnless(reader.HAS_FADVISE, "posix_fadvise is not available")
+    def test_quick_hash_uses_read_policy(self):
+        file = File(self.path.parent, self.path, 0)
+        with patch("os.posix_fadvise", wraps=os.posix_fadvise) as fadvise, patch(
+            "governor.Governor.throttle"
+        ) as throttle:
+            quick_hash = file.get_quick_hash()
+        self.assertEqual(quick_hash, hashlib.md5(self.data[:4096]).hexdigest())
+        fadvise.assert_called_with(unittest.mock.ANY, 0, 0, os.POSIX_FADV_DONTNEED)
+        # Only the pages of the quick hash are read
+        self.assertEqual(sum(call.args[0] for call in throttle.call_args_list), 4096)
+
+
+class TestGovernor(unittest.TestCase):
+    """Test the token buckets and reloading limits from the control file"""
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.control_file = Path(self.temp_dir.name) / "limits.json"
+        self.now = 100.0
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def _write_limits(self, limits: dict, mtime_ns: int):
+        self.control_file.write_text(json.dumps(limits))
+        os.utime(self.control_file, ns=(mtime_ns, mtime_ns))
+
+    def test_bucket_math(self):
+        with patch("time.monotonic", lambda: self.now), patch("time.sleep") as sleep:
+            bucket = governor.TokenBucket(100)
+            # A burst of the capacity is free, then a larger read runs into debt
+            bucket.consume(100)
+            bucket.consume(50)
+            sleep.assert_called_once_with(0.5)
+            self.now += 1.5
+            bucket.consume(100)
+            self.assertEqual(sleep.call_count, 1)
+            # Credit is never more than the capacity
+            self.now += 10
+            bucket.consume(150)
+            sleep.assert_called_with(0.5)
+
+    def test_reload_keeps_burst_credit(self):
+        with patch("time.monotonic", lambda: self.now), patch("time.sleep") as sleep:
+            limits = governor.Governor(bytes_per_sec=100, share=2)
+            bucket = limits.byte_bucket
+            bucket.consume(40)
+            limits.configure(bytes_per_sec=400)
+            self.assertIs(limits.byte_bucket, bucket)
+            self.assertEqual((bucket.rate, bucket.tokens), (200, 10))
+            self.assertEqual(limits.bytes_per_sec, 400)
+            bucket.consume(30)
+            sleep.assert_called_once_with(0.1)
+            limits.configure(iops=10)
+            self.assertIsNone(limits.byte_bucket)
+            self.assertEqual(limits.io_bucket.rate, 5)
+
+    def test_control_file_reload(self):
+        self._write_limits({"bytes_per_sec": 1000}, 1_000_000_000)
+        with patch("config.GOVERNOR_CONTROL_CHECK_INTERVAL", 0):
+            limits = governor.Governor(control_file=self.control_file)
+            self.assertEqual(limits.bytes_per_sec, 1000)
+            self._write_limits({"iops": 5}, 2_000_000_000)
+            limits.throttle(1)
+            self.assertEqual((limits.bytes_per_sec, limits.iops), (None, 5))
+
+            self.control_file.write_text("{")
+            os.utime(self.control_file, ns=(3_000_000_000, 3_000_000_000))
+            with self.assertLogs(level="WARNING"):
+                limits.throttle(1)
+            self.assertEqual(limits.iops, 5)
+
+    @unittest.skipUnless(hasattr(signal, "SIGUSR1"), "SIGUSR1 is not available")
+    def test_sigusr1_reload(self):
+        self._write_limits({"iops": 5}, 1_000_000_000)
+        limits = governor.Governor(control_file=self.control_file)
+        previous = governor.get_governor()
+        previous_handler = signal.getsignal(signal.SIGUSR1)
+        try:
+            governor.set_governor(limits)
+            # An edit that kept the mtime is only seen after SIGUSR1
+            self._write_limits({"iops": 8}, 1_000_000_000)
+            limits.throttle(1)
+            self.assertEqual(limits.iops, 5)
+            os.kill(os.getpid(), signal.SIGUSR1)
+            limits.throttle(1)
+            self.assertEqual(limits.iops, 8)
+        finally:
+            governor.set_governor(previous)
+            signal.signal(signal.SIGUSR1, previous_handler)
+
+
+class TestView(unittest.TestCase):
+    """Test that a view's manifest has the keys and mtimes of a merge manifest"""
+
+    def test_manifest_matches_merge(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            source = Path(temp_dir) / "source"
+            write_tree(source, {"a.txt": "a", "sub/b.txt": "bb"})
+            os.utime(source / "a.txt", ns=(1_000_000_000, 1_000_000_000))
+
+            output = Path(temp_dir) / "out" / "MERGE"
+            build_merge(source).write_merge_to_disk(output)
+            merge_root = next(path for path in output.parent.iterdir() if path.is_dir())
+            merge_manifest = json.loads(
+                MergeBuilder.get_manifest_path(merge_root).read_text()
+            )
+            for mode in [ViewMode.SYMLINK, ViewMode.MANIFEST]:
+                view_root = UnionBuilder(build_merge(source), mode).build_view(
+                    Path(temp_dir) / mode.value / "VIEW"
+                )
+                view_manifest = json.loads(
+                    MergeBuilder.get_manifest_path(view_root).read_text()
+                )
+                self.assertEqual(view_manifest.keys(), merge_manifest.keys())
+                for rel_path, entry in view_manifest.items():
+                    self.assertEqual(entry.keys(), merge_manifest[rel_path].keys())
+                    if mode is ViewMode.SYMLINK:
+                        self.assertEqual(
+                            entry["mtime_ns"], merge_manifest[rel_path]["mtime_ns"]
+                        )
+                    else:
+                        self.assertIsNone(entry["mtime_ns"])
+
+
+class TestDaemon(unittest.TestCase):
+    """Test the requests served by an IndexDaemon over its socket"""
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        temp_path = Path(self.temp_dir.name)
+        self.roots = [temp_path / "a", temp_path / "b"]
+        write_tree(self.roots[0], {"x.txt": "same", "y.txt": "other!"})
+        write_tree(self.roots[1], {"x.txt": "same"})
+        self.socket_path = temp_path / "daemon.sock"
+        self.output_patch = patch("config.OUTPUT_DIR_PATH", temp_path / "results")
+        self.output_patch.start()
+        self.index_daemon = daemon.IndexDaemon(self.roots)
+        self.thread = threading.Thread(
+            target=self.index_daemon.serve, args=(self.socket_path,)
+        )
+        self.thread.start()
+        for _ in range(100):
+            if self.socket_path.exists() and daemon.is_listening(self.socket_path):
+                break
+            time.sleep(0.01)
+
+    def tearDown(self):
+        if self.thread.is_alive():
+            self._request("shutdown")
+            self.thread.join()
+        self.output_patch.stop()
+        self.temp_dir.cleanup()
+
+    def _request(self, command: str, **request):
+        return daemon.send_request(self.socket_path, {"command": command, **request})
+
+    def test_socket_is_private(self):
+        self.assertEqual(self.socket_path.stat().st_mode & 0o777, 0o600)
+
+    def test_report_output_dir(self):
+        output_root = Path(self.temp_dir.name) / "results"
+        response = self._request("report", output_dir=str(output_root / "daemon"))
+        self.assertTrue(response["ok"])
+        self.assertTrue((output_root / "daemon" / "MATCH").is_dir())
+
+        outside = Path(self.temp_dir.name) / "elsewhere"
+        for output_dir in [outside, output_root / ".." / "elsewhere"]:
+            response = self._request("report", output_dir=str(output_dir))
+            self.assertFalse(response["ok"])
+            self.assertIn("must be inside", response["error"])
+        self.assertFalse(outside.exists())
+
+    def test_requests(self):
+        status = self._request("status")["result"]
+        self.assertEqual(status["files"], 3)
+        self.assertEqual(status["groups"]["MATCH"], 1)
+
+        lookup = self._request("lookup", path=str(self.roots[0] / "x.txt"))["result"]
+        self.assertEqual(len(lookup), 1)
+        self.assertEqual(
+            [other["abs_path"] for other in lookup[0]["groups"]["MATCH"]],
+            [str(self.roots[1] / "x.txt")],
+        )
+        self.assertEqual(len(self._request("lookup", path="x.txt")["result"]), 2)
+
+        probe = Path(self.temp_dir.name) / "probe.txt"
+        probe.write_text("same")
+        contains = self._request("contains", path=str(probe))["result"]
+        self.assertEqual(
+            sorted(file["rel_path"] for file in contains), ["x.txt", "x.txt"]
+        )
+
+        write_tree(self.roots[1], {"z.txt": "added content"})
+        self.assertEqual(self._request("rescan")["result"]["files"], 4)
+
+        response = self._request("unknown")
+        self.assertFalse(response["ok"])
+        self.assertIn("Unknown command", response["error"])
+
+        self.assertTrue(self._request("shutdown")["ok"])
+        self.thread.join(timeout=5)
+        self.assertFalse(self.thread.is_alive())
+        self.assertFalse(self.socket_path.exists())
+
+
+class TestArchives(unittest.TestCase):
+    """Test that archive members are indexed, hashed and extracted like plain files"""
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.root = Path(self.temp_dir.name) / "root"
+        self.members = {f"dir/m{i}.txt": f"member {i}\n" * (i + 1) for i in range(20)}
+        write_tree(self.root, {"plain/m3.txt": self.members["dir/m3.txt"]})
+        with tarfile.open(self.root / "a.tar.gz", "w:gz") as archive:
+            for name, text in self.members.items():
+                info = tarfile.TarInfo(name)
+                info.size = len(text.encode())
+                archive.addfile(info, io.BytesIO(text.encode()))
+        with zipfile.ZipFile(self.root / "b.zip", "w") as archive:
+            for name, text in self.members.items():
+                archive.writestr(name, text)
+        self.dir_index = DirIndex(index_archives=True)
+        self.dir_index.index_dir(self.root)
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def test_members_indexed(self):
+        members = [
+            file for file in self.dir_index.file_list if isinstance(file, ArchiveFile)
+        ]
+        self.assertEqual(len(members), 2 * len(self.members))
+        member = next(file for file in members if file.archive_path.name == "b.zip")
+        self.assertEqual(member.rel_path.parent, Path("b.zip/dir"))
+        self.assertIsNone(member.inode)
+        self.assertEqual(member.hardlinks, [member])
+
+    def test_members_hashed_in_one_pass(self):
+        with patch(
+            "archive._hash_members", wraps=archive._hash_members
+        ) as hash_members:
+            for file in self.dir_index.file_list:
+                file.get_quick_hash()
+                file.get_full_hash()
+        # Only the tar is hashed in one pass, zip members are hashed on demand
+        self.assertEqual(hash_members.call_count, 1)
+
+        plain = self.dir_index.name_index["m3.txt"]
+        self.assertEqual(len(plain), 3)
+        for file in plain:
+            self.assertEqual(
+                file.full_hash,
+                hashlib.sha256(self.members["dir/m3.txt"].encode()).hexdigest(),
+            )
+            self.assertTrue(plain[0] is file or plain[0].compare_content(file))
+        self.assertEqual(len({file.quick_hash for file in plain}), 1)
+
+    def test_digest_cache_is_bounded(self):
+        with patch("config.ARCHIVE_DIGEST_CACHE_SIZE", 2):
+            for i in range(3):
+                shutil.copy(self.root / "a.tar.gz", self.root / f"copy{i}.tar.gz")
+                archive.get_member_digests(self.root / f"copy{i}.tar.gz")
+            self.assertEqual(
+                [key[0].name for key in archive._member_digests],
+                ["copy1.tar.gz", "copy2.tar.gz"],
+            )
+
+    def test_unreadable_member(self):
+        # Mark one member encrypted in the central directory, as zipfile can
+        # not write encrypted members
+        zip_path = self.root / "c.zip"
+        with zipfile.ZipFile(zip_path, "w") as zip_archive:
+            zip_archive.writestr("secret.txt", "secret")
+            zip_archive.writestr("open.txt", "opened")
+        data = bytearray(zip_path.read_bytes())
+        header = data.index(b"PK\x01\x02")
+        data[header + 8] |= 0x1
+        zip_path.write_bytes(data)
+
+        dir_index = DirIndex(index_archives=True)
+        dir_index.index_dir(self.root)
+        secret, open_file = (
+            dir_index.name_index[name][0] for name in ["secret.txt", "open.txt"]
+        )
+        with self.assertLogs(level="WARNING"):
+            self.assertEqual(secret.get_full_hash(), f"unreadable:{secret.abs_path}")
+        self.assertFalse(secret.compare_content(open_file))
+        self.assertEqual(
+            open_file.get_full_hash(), hashlib.sha256(b"opened").hexdigest()
+        )
+
+    def test_diff_paths_extracts_members(self):
+        tar_member, _, plain = sorted(
+            self.dir_index.name_index["m3.txt"], key=lambda file: str(file.abs_path)
+        )
+        with cli.diff_paths([tar_member, plain]) as paths:
+            self.assertTrue(all(path.is_file() for path in paths))
+            self.assertEqual(paths[1], plain.abs_path.resolve())
+            self.assertIsNone(utils.make_unified_diff(*paths))
+        self.assertFalse(paths[0].exists())
+
+
+class TestIndexDB(unittest.TestCase):
+    """Test exporting an index to SQLite and querying it"""
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.root = Path(self.temp_dir.name) / "root"
+        write_tree(
+            self.root, {"a/x.txt": "same", "b/x.txt": "same", "c/y.txt": "other"}
+        )
+        self.dir_index = DirIndex()
+        self.dir_index.index_dir(self.root)
+        self.comparison_manager = ComparisonManager()
+        self.comparison_manager.add_dir_index(self.dir_index)
+        self.output_dir = Path(self.temp_dir.name) / "INDEX"
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def test_exports_in_the_same_second(self):
+        with patch("utils.get_timestamp", return_value="2000-01-01_00-00-00"):
+            paths = [
+                index_db.export_index(
+                    self.output_dir, self.dir_index, self.comparison_manager
+                )
+                for _ in range(3)
+            ]
+        self.assertEqual(len(set(paths)), 3)
+        self.assertEqual(index_db.get_most_recent_export(self.output_dir), paths[-1])
+
+    def test_queries(self):
+        db = index_db.IndexDB(
+            index_db.export_index(
+                self.output_dir, self.dir_index, self.comparison_manager
+            )
+        )
+        self.assertEqual(len(db.find_by_name("x.txt")), 2)
+        self.assertEqual([row[1] for row in db.find_copies("a/x.txt")], ["b/x.txt"])
+        self.assertEqual(len(db.top_dirs(CompType.CONTENT_NAME_DUP)), 2)
+        db.close()
+
+    def test_query_reports_unhashed_candidates(self):
+        # Copies compared by size and mtime are never hashed
+        dir_index = DirIndex()
+        dir_index.index_dir(self.root)
+        comparison_manager = ComparisonManager(trust_metadata=True)
+        comparison_manager.add_dir_index(dir_index)
+        same_hash = hashlib.sha256(b"same").hexdigest()
+        hashed, unhashed = sorted(
+            dir_index.name_index["x.txt"], key=lambda file: file.rel_path
+        )
+        hashed.set_full_hash(same_hash)
+        db_path = index_db.export_index(self.output_dir, dir_index, comparison_manager)
+        with patch("sys.stdout", io.StringIO()) as stdout:
+            query_index(db_path, file_hash=same_hash)
+        lines = [line.split("\t") for line in stdout.getvalue().splitlines()]
+        self.assertEqual(lines[0][1:3], ["a/x.txt", str(hashed.abs_path)])
+        self.assertEqual(lines[2][1:3], ["b/x.txt", str(unhashed.abs_path)])
+        self.assertEqual(
+            lines[3],
+            [
+                "1 unhashed files the size of a result may also match, "
+                "of 2 files never hashed"
+            ],
+        )
+
+    def test_top_dirs_requires_type(self):
+        with patch("sys.stderr", io.StringIO()):
+            with self.assertRaises(SystemExit):
+                parse_query_args(["--path", "a", "--top-dirs", "3"])
+        args = parse_query_args(["--type", "NAME_DUP", "--top-dirs", "3"])
+        self.assertEqual(args.top_dirs, 3)
+
+
+class TestPresenceMatrix(unittest.TestCase):
+    """Test consensus, outliers and missing files across several roots"""
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.roots = [Path(self.temp_dir.name) / f"root{i}" for i in range(3)]
+        write_tree(self.roots[0], {"a.txt": "v1", "b.txt": "same", "c.txt": "c"})
+        write_tree(self.roots[1], {"a.txt": "v2 edit", "b.txt": "same"})
+        write_tree(self.roots[2], {"a.txt": "v1", "b.txt": "same"})
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def _build(self, roots: List[Path], has_numpy=presence_matrix.HAS_NUMPY):
+        dir_index = DirIndex()
+        for root in roots:
+            dir_index.index_dir(root)
+        with patch("presence_matrix.HAS_NUMPY", has_numpy):
+            return PresenceMatrix(dir_index)
+
+    def test_consensus(self):
+        for has_numpy in {presence_matrix.HAS_NUMPY, False}:
+            matrix = self._build(self.roots, has_numpy)
+            consensus = {
+                file.rel_path.as_posix(): file.base_path
+                for file in matrix.get_consensus_files()
+            }
+            self.assertEqual(
+                consensus,
+                {
+                    "a.txt": self.roots[0],
+                    "b.txt": self.roots[0],
+                    "c.txt": self.roots[0],
+                },
+            )
+            self.assertEqual(
+                [file.abs_path for file in matrix.get_outliers(1)],
+                [self.roots[1] / "a.txt"],
+            )
+            self.assertEqual(matrix.get_missing(2), ["c.txt"])
+            report = str(matrix)
+            self.assertIn(f"Consensus: {self.roots[0] / 'a.txt'}", report)
+            self.assertNotIn("Path: b.txt", report)
+
+    @unittest.skipUnless(presence_matrix.HAS_NUMPY, "numpy is not installed")
+    def test_vectorized_matches_counter(self):
+        # Many roots, few classes and some missing files, so most paths have ties
+        matrix = self._build(self.roots)
+        rand = random.Random(0)
+        matrix.paths = [str(path_id) for path_id in range(500)]
+        matrix.matrix = [
+            array("l", [rand.randint(MISSING, 3) for _ in matrix.paths])
+            for _ in range(7)
+        ]
+        matrix._build_consensus_vectorized()
+        vectorized = list(matrix.consensus)
+        with patch("presence_matrix.HAS_NUMPY", False):
+            matrix._build_consensus()
+        self.assertEqual(vectorized, list(matrix.consensus))
+
+    def test_repeated_root(self):
+        matrix = self._build([self.roots[0], self.roots[1], self.roots[0]])
+        self.assertEqual(matrix.roots, self.roots[:2])
+        self.assertEqual(matrix.get_missing(0), [])
+        self.assertEqual(matrix.get_missing(1), ["c.txt"])
+
+
+class TestChunking(unittest.TestCase):
+    """Test content-defined chunk boundaries and the chunk store and report"""
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.data = random.Random(0).randbytes(2 * 1024 * 1024)
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def _chunk(self, data: bytes, has_numpy=chunking.HAS_NUMPY) -> List[bytes]:
+        with patch("chunking.HAS_NUMPY", has_numpy):
+            return list(chunking.iter_chunks(io.BytesIO(data)))
+
+    def test_chunk_sizes(self):
+        chunks = self._chunk(self.data)
+        self.assertEqual(b"".join(chunks), self.data)
+        for chunk in chunks[:-1]:
+            self.assertGreaterEqual(len(chunk), config.CHUNK_MIN_SIZE)
+            self.assertLessEqual(len(chunk), config.CHUNK_MAX_SIZE)
+        self.assertEqual(self._chunk(b""), [])
+
+    @unittest.skipUnless(chunking.HAS_NUMPY, "numpy is not installed")
+    def test_vectorized_matches_pure_python(self):
+        for data in [self.data, self.data[:70000], bytes(600000), b"short"]:
+            self.assertEqual(self._chunk(data, True), self._chunk(data, False))
+
+    def test_block_size_does_not_change_chunks(self):
+        blocks = [self.data[i : i + 5000] for i in range(0, len(self.data), 5000)]
+        self.assertEqual(
+            list(chunking.iter_block_chunks(blocks)), self._chunk(self.data)
+        )
+
+    def test_insert_only_changes_nearby_chunks(self):
+        edited = self.data[:1000000] + b"inserted" + self.data[1000000:]
+        chunks, edited_chunks = set(self._chunk(self.data)), self._chunk(edited)
+        changed = [chunk for chunk in edited_chunks if chunk not in chunks]
+        self.assertLessEqual(len(changed), 2)
+
+    def test_store_and_report(self):
+        root = Path(self.temp_dir.name)
+        (root / "a").mkdir()
+        (root / "b").mkdir()
+        (root / "a" / "big.bin").write_bytes(self.data)
+        (root / "b" / "big.bin").write_bytes(self.data[:1500000] + b"tail")
+        dir_index = DirIndex()
+        dir_index.index_dir(root)
+        comparison_manager = ComparisonManager()
+        comparison_manager.add_dir_index(dir_index)
+
+        chunk_store = chunking.ChunkStore(root / "chunks.sqlite")
+        # Files are read with the read policy, as for hashing
+        with patch("reader.iter_path", wraps=reader.iter_path) as iter_path:
+            report = chunking.ChunkReport(comparison_manager, chunk_store, 1024)
+        self.assertEqual(iter_path.call_count, 2)
+        self.assertEqual(chunk_store.chunked_count, 2)
+        ((_, _, pair_ratios, _, _),) = report.groups
+        self.assertGreater(pair_ratios[0][2], 0.6)
+
+        chunking.ChunkReport(comparison_manager, chunk_store, 1024)
+        self.assertEqual(chunk_store.cached_count, 2)
+        chunk_store.close()
+        with patch("chunking.get_chunker_id", return_value="other"):
+            chunk_store = chunking.ChunkStore(root / "chunks.sqlite")
+            chunking.ChunkReport(comparison_manager, chunk_store, 1024)
+            chunk_store.close()
+        self.assertEqual(chunk_store.chunked_count, 2)
+
+        with patch("chunking.HAS_NUMPY", False):
+            with patch("config.CHUNK_PURE_PYTHON_MAX_SIZE", 1024 * 1024):
+                chunk_store = chunking.ChunkStore(root / "chunks.sqlite")
+                report = chunking.ChunkReport(comparison_manager, chunk_store, 1024)
+                chunk_store.close()
+        self.assertEqual(len(report.skipped_files), 2)
+        self.assertEqual(report.groups, [])
+
+
 if __name__ == "__main__":
     unittest.main()
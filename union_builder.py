@@ -1,86 +1,108 @@
-# Duplicates: Choose which duplicates to keep and which to get rid of
-# Match/DNE: Copy over
-# Diff: Choose which version to keep
-
-# 1) Combine MATCH with DNE and use them to generate base dir
-# 2) For each DUP, choose which paths to keep
-# 3) For each DIFF, choose which version to keep
+# Builds a view of a merge plan without copying any file data, so a merge can
+# be inspected before it is written to disk with MergeBuilder
 
 import sys
 import os
+import json
+import errno
 import logging
-import shutil
 
-from typing import Dict, List
-from datetime import datetime
+from enum import Enum
+from typing import Dict
 from pathlib import Path
 
 import utils
+from file import File, FULL_HASH_ALGORITHM
+from archive import ArchiveFile
+from merge_builder import MergeBuilder
+
 
-BASE_ROOT_PATH = (
-    r"C:\Users\trjji\Documents\Coding Projects\obsidian-helpers\combined\test"
-)
+class ViewMode(Enum):
+    # Hardlinks to the sources, falling back to symlinks across filesystems
+    HARDLINK = "hardlink"
+    # Symlinks to the sources
+    SYMLINK = "symlink"
+    # Only the manifest of destination paths and their sources
+    MANIFEST = "manifest"
 
 
 class UnionBuilder:
-    def __init__(self):
-        root_path = self.__setup_root()
-        self.union_path = root_path
-
-    # Add files with matching content to union
-    # TODO: Unionbuilder only MATCHES files with same relative path, so choosing between path here never matters
-    def add_matches(self, match_index: Dict[str, List[str]]):
-        for _, abs_paths in match_index.items():
-            # Generate relative paths
-            rel_paths = []
-            for path in abs_paths:
-                rel_paths.append(utils.get_relative_to_base_path(path))
-
-            # User decides what path to keep
-            rel_path, abs_path = self.__gather_match_input(rel_paths, abs_paths)
-
-            # Print and log chosen match
-            match_msg = self.__get_match_msg(rel_paths, abs_paths)
-            chosen_msg = f"Chosen path: {rel_path}\n\t{abs_path}"
-            print(chosen_msg)
-            logging.info(match_msg)
-            logging.info(chosen_msg)
-
-            # Copy file from selected path
-            output_path = Path(self.union_path / rel_path)
-            os.makedirs(output_path.parent, exist_ok=True)
-            print(abs_path, output_path)
-            shutil.copy2(Path(abs_path), Path(output_path))
-
-    def __gather_match_input(self, rel_paths, abs_paths):
-        while True:
-            print(self.__get_match_msg(rel_paths, abs_paths))
+    def __init__(self, merge_builder: MergeBuilder, mode: ViewMode = ViewMode.SYMLINK):
+        self.plan: Dict[str:File] = merge_builder.plan
+        self.mode = mode
+        # Destination relative path -> source and how it was added to the view
+        self.manifest: Dict[str:dict] = {}
+
+    def __repr__(self):
+        return f"UnionBuilder(mode={self.mode.value!r}, files={len(self.plan)})"
+
+    def build_view(self, target_dir: Path) -> Path:
+        """
+        Builds the view in a new timestamped root, or only its manifest in
+        MANIFEST mode, and returns the root. The manifest is written next to
+        the root with the same keys as a MergeBuilder manifest. As there, its
+        mtime_ns is that of the file at the destination, here the linked
+        source, or None when nothing was linked, and its hash is None for
+        files that were not hashed.
+        """
+        timestamp = utils.get_timestamp()
+        root_path = Path(f"{target_dir}-{timestamp}")
+        if self.mode is not ViewMode.MANIFEST:
+            self.__setup_root(root_path)
+
+        for rel_path, file in self.plan.items():
+            output_path = root_path / rel_path
+            status = "planned"
+            if self.mode is not ViewMode.MANIFEST:
+                status = self.__link_file(file, output_path)
+            is_linked = status in ("hardlinked", "symlinked")
+            self.manifest[rel_path] = {
+                "source": str(file.abs_path),
+                "size": file.size,
+                "mtime_ns": output_path.stat().st_mtime_ns if is_linked else None,
+                FULL_HASH_ALGORITHM: file.full_hash,
+                "status": status,
+            }
+        self.__write_manifest(root_path)
+
+        counts = {}
+        for entry in self.manifest.values():
+            counts[entry["status"]] = counts.get(entry["status"], 0) + 1
+        msg = f"Built {self.mode.value} view of {len(self.plan)} files: {counts}"
+        print(msg)
+        logging.info(f"{msg} at {root_path}")
+        return root_path
+
+    def __link_file(self, file: File, output_path: Path) -> str:
+        # Archive members have no file of their own to link to
+        if isinstance(file, ArchiveFile):
+            logging.warning(f"Skipping archive member in view: {file.abs_path}")
+            return "skipped"
+
+        os.makedirs(output_path.parent, exist_ok=True)
+        source_path = file.abs_path.resolve()
+        if self.mode is ViewMode.HARDLINK:
             try:
-                user_input = int(input("Input # of path to keep: "))
-                if 0 <= user_input < len(rel_paths):
-                    return rel_paths[user_input], abs_paths[user_input]
-                else:
-                    raise ValueError(
-                        f"Invalid selection: {user_input}. Must be between 0 and {len(abs_paths) - 1}"
-                    )
-            except ValueError as e:
-                print(
-                    f"Error: {e}. Please enter an integer between {0} - {len(rel_paths) - 1}"
-                )
-
-    @staticmethod
-    def __get_match_msg(rel_paths, abs_paths):
-        msg = "MATCH: Choose path to keep:\n"
-        for i, (rel_path, abs_path) in enumerate(zip(rel_paths, abs_paths)):
-            msg += f"\t{i}) {rel_path}\n"
-            msg += f"\t\tLink: {utils.make_link(abs_path)}\n"
-        return msg
+                os.link(source_path, output_path)
+                return "hardlinked"
+            except OSError as e:
+                if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+                    raise
+                logging.debug("Symlinking %s instead: %s", source_path, e)
+        os.symlink(source_path, output_path)
+        return "symlinked"
+
+    def __write_manifest(self, root_path: Path):
+        manifest_path = MergeBuilder.get_manifest_path(root_path)
+        utils.ensure_path_exists(manifest_path.parent)
+        print(f"Making new output at: {manifest_path}")
+        temp_path = Path(f"{manifest_path}.tmp")
+        with open(temp_path, "w", encoding="utf-8") as file:
+            json.dump(self.manifest, file, indent=2)
+        os.replace(temp_path, manifest_path)
 
     # Given the root_path, create it if it doesn't already exist
-    def __setup_root(self):
-        timestamp = datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
-        root = Path(f"{BASE_ROOT_PATH}-{timestamp}")
-
+    def __setup_root(self, root: Path):
         if root.exists():
             msg = f"Aborting build: root directory {root} already exists"
             print(msg)
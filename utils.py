@@ -1,3 +1,7 @@
+import os
+import sys
+import errno
+import ctypes
 import filecmp
 import difflib
 
@@ -68,6 +72,15 @@ def is_hidden(path: Path):
     return False
 
 
+# Parse a size such as "512", "64K" or "2G" into a number of bytes
+def parse_size(size: str) -> int:
+    units = {"K": 1024, "M": 1024**2, "G": 1024**3, "T": 1024**4}
+    size = size.strip().upper().removesuffix("B")
+    if size and size[-1] in units:
+        return int(float(size[:-1]) * units[size[-1]])
+    return int(size)
+
+
 def write_to_file(filename: str, output_dir: Path, msg: str, is_timestamped=False):
     """
     Writes a message to a text file in the specified output directory.
@@ -108,3 +121,69 @@ def ensure_path_exists(path: Path, create_if_missing=True):
         return path
     else:
         raise FileNotFoundError(f"Path does not exist: {path}")
+
+
+# Flush a written file, or the entries of a dir, to disk.
+# Dirs can't be opened on Windows, so their entries aren't flushed there
+def fsync_path(path: Path):
+    if os.name == "nt":
+        if path.is_dir():
+            return
+        flags = os.O_RDWR
+    else:
+        flags = os.O_RDONLY
+    fd = os.open(path, flags)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+# Flushes every pending write to the filesystem holding path with syncfs, one
+# call instead of an fsync per file, but for every process writing to it.
+# Returns False where it isn't available
+def sync_filesystem(path: Path) -> bool:
+    if not sys.platform.startswith("linux"):
+        return False
+    syncfs = getattr(ctypes.CDLL(None, use_errno=True), "syncfs", None)
+    if syncfs is None:
+        return False
+    syncfs.argtypes = [ctypes.c_int]
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        result = syncfs(fd)
+    finally:
+        os.close(fd)
+    if result == 0:
+        return True
+    error = ctypes.get_errno()
+    if error == errno.ENOSYS:
+        return False
+    raise OSError(error, os.strerror(error), str(path))
+
+
+# Atomically swap two paths with renameat2(RENAME_EXCHANGE).
+# Returns False where the platform or filesystem doesn't support it
+def exchange_paths(path_a: Path, path_b: Path) -> bool:
+    if not sys.platform.startswith("linux"):
+        return False
+    renameat2 = getattr(ctypes.CDLL(None, use_errno=True), "renameat2", None)
+    if renameat2 is None:
+        return False
+    renameat2.argtypes = [
+        ctypes.c_int,
+        ctypes.c_char_p,
+        ctypes.c_int,
+        ctypes.c_char_p,
+        ctypes.c_uint,
+    ]
+    at_fdcwd, rename_exchange = -100, 2
+    result = renameat2(
+        at_fdcwd, os.fsencode(path_a), at_fdcwd, os.fsencode(path_b), rename_exchange
+    )
+    if result == 0:
+        return True
+    error = ctypes.get_errno()
+    if error in (errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP):
+        return False
+    raise OSError(error, os.strerror(error), str(path_a), None, str(path_b))
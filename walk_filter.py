@@ -0,0 +1,190 @@
+import re
+import json
+import hashlib
+
+from pathlib import Path
+from typing import Iterable, List, Optional
+
+import utils
+
+
+class WalkFilter:
+    """
+    Include/exclude rules compiled once and applied while walking a directory.
+
+    Patterns use glob syntax. A pattern without a "/" matches an entry's name at
+    any depth, otherwise it matches the path relative to the indexed directory.
+    A leading "!" re-includes entries matched by an earlier pattern, and a
+    trailing "/" only matches directories, as in a .gitignore file.
+    """
+
+    def __init__(
+        self,
+        exclude: Iterable[str] = (),
+        include: Iterable[str] = (),
+        ignore_files: Iterable[Path] = (),
+        extensions: Iterable[str] = (),
+        exclude_extensions: Iterable[str] = (),
+        min_size: Optional[int] = None,
+        max_size: Optional[int] = None,
+    ):
+        patterns = list(exclude)
+        for ignore_file in ignore_files:
+            patterns.extend(self._read_ignore_file(ignore_file))
+
+        self.exclude_rules = [self._compile_rule(pattern) for pattern in patterns]
+        self.include_rules = [self._compile_rule(pattern) for pattern in include]
+        self.extensions = {self._normalize_ext(ext) for ext in extensions}
+        self.exclude_extensions = {
+            self._normalize_ext(ext) for ext in exclude_extensions
+        }
+        self.min_size = min_size
+        self.max_size = max_size
+
+        # Identifies the rules, so results saved with another filter are not reused
+        settings = [
+            patterns,
+            list(include),
+            sorted(self.extensions),
+            sorted(self.exclude_extensions),
+            min_size,
+            max_size,
+        ]
+        self.signature = hashlib.blake2b(
+            json.dumps(settings).encode(), digest_size=16
+        ).hexdigest()
+
+    def __repr__(self):
+        return (
+            f"WalkFilter(exclude_rules={len(self.exclude_rules)}, "
+            f"include_rules={len(self.include_rules)}, "
+            f"extensions={sorted(self.extensions)}, "
+            f"exclude_extensions={sorted(self.exclude_extensions)}, "
+            f"min_size={self.min_size}, max_size={self.max_size})"
+        )
+
+    @classmethod
+    def from_config_file(cls, config_path: Path, **overrides) -> "WalkFilter":
+        """
+        Builds a filter from a JSON file, e.g.
+            {"exclude": ["node_modules/", "*.vmdk"], "max_size": "2G"}
+
+        Lists given in `overrides` are added to those in the file, other
+        values given in `overrides` replace the file's value.
+        """
+        with open(config_path, "r", encoding="utf-8") as config_file:
+            settings = json.load(config_file)
+
+        for key in ("min_size", "max_size"):
+            if isinstance(settings.get(key), str):
+                settings[key] = utils.parse_size(settings[key])
+        for key, value in overrides.items():
+            if isinstance(value, (list, tuple)):
+                settings[key] = list(settings.get(key, [])) + list(value)
+            elif value is not None:
+                settings[key] = value
+
+        return cls(**settings)
+
+    @property
+    def needs_size(self) -> bool:
+        return self.min_size is not None or self.max_size is not None
+
+    def exclude_dir(self, rel_path: str, name: str) -> bool:
+        """Returns True if the directory should not be descended into"""
+        return self._is_excluded(rel_path, name, is_dir=True)
+
+    def exclude_file(self, rel_path: str, name: str) -> bool:
+        """Returns True if the file is excluded by its path, name or extension"""
+        if self._is_excluded(rel_path, name, is_dir=False):
+            return True
+        if self.include_rules and not any(
+            self._matches(rule, rel_path, name) for rule in self.include_rules
+        ):
+            return True
+
+        ext = self._normalize_ext(Path(name).suffix)
+        if self.extensions and ext not in self.extensions:
+            return True
+        return ext in self.exclude_extensions
+
+    def exclude_size(self, size: int) -> bool:
+        """Returns True if the file size is outside of the min/max size"""
+        if self.min_size is not None and size < self.min_size:
+            return True
+        return self.max_size is not None and size > self.max_size
+
+    def _is_excluded(self, rel_path: str, name: str, is_dir: bool) -> bool:
+        # The last matching rule decides, so "!" rules can re-include entries
+        for rule in reversed(self.exclude_rules):
+            _, _, is_negated, dir_only = rule
+            if dir_only and not is_dir:
+                continue
+            if self._matches(rule, rel_path, name):
+                return not is_negated
+        return False
+
+    @staticmethod
+    def _matches(rule: tuple, rel_path: str, name: str) -> bool:
+        regex, name_only, _, _ = rule
+        return regex.fullmatch(name if name_only else rel_path) is not None
+
+    @staticmethod
+    def _compile_rule(pattern: str) -> tuple:
+        """Compiles a pattern into (regex, name_only, is_negated, dir_only)"""
+        is_negated = pattern.startswith("!")
+        pattern = pattern.removeprefix("!")
+        dir_only = pattern.endswith("/")
+        pattern = pattern.rstrip("/")
+
+        # Patterns without a "/" are matched against the name at any depth
+        name_only = "/" not in pattern
+        regex = re.compile(_glob_to_regex(pattern.lstrip("/")))
+        return regex, name_only, is_negated, dir_only
+
+    @staticmethod
+    def _read_ignore_file(ignore_file: Path) -> List[str]:
+        patterns = []
+        with open(ignore_file, "r", encoding="utf-8") as file:
+            for line in file:
+                line = line.strip()
+                if line and not line.startswith("#"):
+                    patterns.append(line)
+        return patterns
+
+    @staticmethod
+    def _normalize_ext(ext: str) -> str:
+        ext = ext.lower()
+        return ext if ext.startswith(".") or not ext else f".{ext}"
+
+
+def _glob_to_regex(pattern: str) -> str:
+    """Translates a glob into a regex where only "**" matches across "/" """
+    regex = []
+    i = 0
+    while i < len(pattern):
+        char = pattern[i]
+        if pattern.startswith("**/", i):
+            regex.append("(?:.*/)?")
+            i += 3
+            continue
+        if pattern.startswith("**", i):
+            regex.append(".*")
+            i += 2
+            continue
+        if char == "*":
+            regex.append("[^/]*")
+        elif char == "?":
+            regex.append("[^/]")
+        elif char == "[" and "]" in pattern[i + 1 :]:
+            end = pattern.index("]", i + 1)
+            body = pattern[i + 1 : end].replace("\\", "\\\\")
+            # A negated class never matches "/", like "*" and "?"
+            if body.startswith("!"):
+                body = "^/" + body[1:]
+            regex.append(f"[{body}]")
+            i = end
+        else:
+            regex.append(re.escape(char))
+        i += 1
+    return "".join(regex)